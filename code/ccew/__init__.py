@@ -0,0 +1 @@
+"""Tools for working with the Charity Commission register extracts."""
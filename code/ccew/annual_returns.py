@@ -0,0 +1,293 @@
+"""Vectorised lookups of annual returns by charity number and financial year.
+
+The annual return history is sorted once by (charity number, start year of
+the financial period) into NumPy arrays. Looking up any window of years
+around a batch of events is then a single `searchsorted` call, instead of
+one hash merge of the whole annual return frame per year and per role.
+
+`FinancialPeriodIndex` does the same by date: it finds the financial period
+containing each event date, and the periods around it, whatever calendar
+year they start in.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.extracts import DATA_DIR, parquet_path
+from ccew.numbers import MAX_DIGITS
+
+VALUE_COLUMNS = ('total_gross_income', 'total_gross_expenditure')
+# composite keys: charity number * YEAR_FACTOR + year, charity number * DAY_FACTOR + day
+YEAR_FACTOR = 10_000
+DAY_FACTOR = 100_000
+# days are shifted so that dates from 1833 to 2106 give keys in [0, DAY_FACTOR)
+DAY_SHIFT = 50_000
+
+
+def as_charity_numbers(values):
+    """Float array of charity numbers, NaN where a value is not a plain number.
+
+    Accepts ints, categoricals and the string labels of the merger register
+    (`'1082947'`, `'1053467-01'`, `'exempt'`...); only plain numbers of up
+    to `MAX_DIGITS` digits match the annual returns, so a note made of
+    digits is not taken for a number.
+    """
+    values = pd.Series(values, copy=False)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(values.cat.categories.dtype)
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.to_numpy(dtype='float64', na_value=np.nan)
+    values = values.astype('string').str.strip()
+    values = values.where(values.str.fullmatch(rf'\d{{1,{MAX_DIGITS}}}').fillna(False))
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+
+def _read_periods(path, value_columns):
+    if path is None:
+        path = parquet_path('charity_annual_return_history', DATA_DIR)
+    table = pq.read_table(path, columns=[
+        'registered_charity_number',
+        'fin_period_start_date',
+        'fin_period_end_date',
+        *value_columns,
+    ])
+    keep = pc.and_(
+        pc.is_valid(table.column('registered_charity_number')),
+        pc.is_valid(table.column('fin_period_start_date')),
+    )
+    table = table.filter(keep)
+    return (
+        table.column('registered_charity_number').to_numpy(),
+        _days(table.column('fin_period_start_date').to_pandas()),
+        _days(table.column('fin_period_end_date').to_pandas()),
+        {c: table.column(c).to_numpy() for c in value_columns},
+    )
+
+
+def _days(dates):
+    """datetime64[D] array of `dates`, NaT where missing."""
+    return pd.to_datetime(pd.Series(dates, copy=False)).to_numpy(dtype='datetime64[D]')
+
+
+class AnnualReturnIndex:
+    """Annual returns sorted by (charity number, financial year start).
+
+    When a charity has several financial periods starting in the same year,
+    the one ending last is kept.
+    """
+
+    def __init__(self, numbers, years, values, ends=None):
+        numbers = np.asarray(numbers, dtype='int64')
+        years = np.asarray(years, dtype='int64')
+        if ends is None:
+            ends = np.zeros(len(numbers), dtype='int64')
+        # NaT sorts first, so a period with a missing end is never preferred
+        ends = np.asarray(ends).astype('int64')
+        order = np.lexsort((ends, years, numbers))
+        keys = numbers[order] * YEAR_FACTOR + years[order]
+        # keep the last period of each (number, year)
+        last = np.append(keys[1:] != keys[:-1], True)
+        self.keys = keys[last]
+        self.values = {
+            column: np.asarray(array, dtype='float64')[order][last]
+            for column, array in values.items()
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_frame(cls, df, value_columns=VALUE_COLUMNS):
+        """Build from a frame with the annual return history columns."""
+        if 'fin_start_year' in df.columns:
+            years = df['fin_start_year']
+        else:
+            years = pd.to_datetime(df['fin_period_start_date']).dt.year
+        ends = None
+        if 'fin_period_end_date' in df.columns:
+            ends = _days(df['fin_period_end_date'])
+        numbers = as_charity_numbers(df['registered_charity_number'])
+        keep = ~np.isnan(numbers) & years.notna().to_numpy()
+        values = {
+            column: df[column].to_numpy(dtype='float64', na_value=np.nan)[keep]
+            for column in value_columns
+            if column in df.columns
+        }
+        return cls(
+            numbers[keep],
+            years.to_numpy()[keep],
+            values,
+            None if ends is None else ends[keep],
+        )
+
+    @classmethod
+    def from_parquet(cls, path=None, value_columns=VALUE_COLUMNS):
+        """Build from the converted annual return history, reading only the needed columns."""
+        numbers, starts, ends, values = _read_periods(path, value_columns)
+        return cls(numbers, starts.astype('datetime64[Y]').astype('int64') + 1970, values, ends)
+
+    def positions(self, numbers, years, offsets=(0,)):
+        """Row positions of (number, year + offset), -1 when there is no return."""
+        numbers = as_charity_numbers(numbers)
+        years = pd.Series(years, copy=False).to_numpy(dtype='float64', na_value=np.nan)
+        offsets = np.asarray(offsets, dtype='int64')
+        valid = ~(np.isnan(numbers) | np.isnan(years))
+        keys = (
+            np.where(valid, numbers, 0).astype('int64') * YEAR_FACTOR
+            + np.where(valid, years, 0).astype('int64')
+        )
+        wanted = keys[:, None] + offsets[None, :]
+        if not len(self.keys):
+            return np.full(wanted.shape, -1)
+        pos = np.minimum(np.searchsorted(self.keys, wanted), len(self.keys) - 1)
+        found = (self.keys[pos] == wanted) & valid[:, None]
+        return np.where(found, pos, -1)
+
+    def lookup(self, numbers, years, offsets=(0, 1), column='total_gross_income'):
+        """Values of `column` for each event and offset, shape (events, offsets).
+
+        Missing returns are NaN.
+        """
+        pos = self.positions(numbers, years, offsets)
+        values = self.values[column]
+        return np.where(pos >= 0, values[np.maximum(pos, 0)], np.nan)
+
+    def window(self, numbers, years, offsets=(0, 1), columns=None, names=None):
+        """Frame of `columns` (default: all) for each offset, named `<column>_<name>`.
+
+        `names` defaults to the signed offsets, e.g. `total_gross_income_+1`.
+        """
+        if columns is None:
+            columns = list(self.values)
+        if names is None:
+            names = [f'{offset:+d}' for offset in offsets]
+        pos = self.positions(numbers, years, offsets)
+        index = getattr(numbers, 'index', None)
+        frame = {}
+        for column in columns:
+            values = self.values[column]
+            looked_up = np.where(pos >= 0, values[np.maximum(pos, 0)], np.nan)
+            for i, name in enumerate(names):
+                frame[f'{column}_{name}'] = looked_up[:, i]
+        return pd.DataFrame(frame, index=index)
+
+
+class FinancialPeriodIndex:
+    """Financial periods sorted by (charity number, period start date).
+
+    Unlike `AnnualReturnIndex`, periods are matched to event dates by
+    interval rather than by calendar year of their start. Of the periods a
+    charity has starting on the same day, only the one ending last is kept,
+    and one with a missing end only when no other has an end, so that
+    offsets step from one distinct period to the next. A missing end is
+    open, up to the start of the next period.
+    """
+
+    def __init__(self, numbers, starts, ends, values):
+        numbers = np.asarray(numbers, dtype='int64')
+        starts = np.asarray(starts, dtype='datetime64[D]')
+        ends = np.asarray(ends, dtype='datetime64[D]')
+        keys = _day_keys(numbers, starts)
+        # NaT as int64 sorts first, so a period with a missing end comes before
+        # the periods starting on the same day with an end
+        order = np.lexsort((ends.astype('int64'), keys))
+        # keep the last period of each (number, start)
+        last = np.append(keys[order][1:] != keys[order][:-1], True)
+        order = order[last]
+        self.keys = keys[order]
+        self.numbers = numbers[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.values = {
+            column: np.asarray(array, dtype='float64')[order] for column, array in values.items()
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_frame(cls, df, value_columns=VALUE_COLUMNS):
+        """Build from a frame with the annual return history columns."""
+        numbers = as_charity_numbers(df['registered_charity_number'])
+        starts = _days(df['fin_period_start_date'])
+        keep = ~np.isnan(numbers) & ~np.isnat(starts)
+        values = {
+            column: df[column].to_numpy(dtype='float64', na_value=np.nan)[keep]
+            for column in value_columns
+            if column in df.columns
+        }
+        return cls(numbers[keep], starts[keep], _days(df['fin_period_end_date'])[keep], values)
+
+    @classmethod
+    def from_parquet(cls, path=None, value_columns=VALUE_COLUMNS):
+        """Build from the converted annual return history, reading only the needed columns."""
+        return cls(*_read_periods(path, value_columns))
+
+    def positions(self, numbers, dates, offsets=(0, 1)):
+        """Row positions of the periods around each event date, -1 when there is none.
+
+        Offset 0 is the period containing the date (start <= date <= end,
+        with no end meaning open), 1 the period after it, -1 the one before,
+        and so on. When the date falls between two periods, offset 0 is
+        missing, 1 is the first period starting after the date and -1 the
+        last one ending before it.
+        """
+        numbers = as_charity_numbers(numbers)
+        dates = _days(dates)
+        offsets = np.asarray(offsets, dtype='int64')
+        valid = ~np.isnan(numbers) & ~np.isnat(dates)
+        keys = _day_keys(np.where(valid, numbers, 0).astype('int64'), dates)
+        if not len(self.keys):
+            return np.full((len(keys), len(offsets)), -1)
+        # last period starting on or before the date
+        last = np.searchsorted(self.keys, keys, side='right') - 1
+        number = np.where(valid, numbers, -1).astype('int64')
+        contains = (
+            (last >= 0)
+            & (self.numbers[np.maximum(last, 0)] == number)
+            & (
+                np.isnat(self.ends[np.maximum(last, 0)])
+                | (self.ends[np.maximum(last, 0)] >= dates)
+            )
+        )
+        # between two periods, offset 0 is missing and offsets count from the gap
+        gap = ~contains[:, None]
+        pos = last[:, None] + offsets[None, :] + (gap & (offsets[None, :] < 0))
+        pos = np.where(gap & (offsets[None, :] == 0), -1, pos)
+        clipped = np.clip(pos, 0, len(self.keys) - 1)
+        found = (pos >= 0) & (pos < len(self.keys)) & (self.numbers[clipped] == number[:, None])
+        return np.where(found & valid[:, None], pos, -1)
+
+    def match(self, numbers, dates, offsets=(0, 1), columns=None, names=None):
+        """Frame of period dates and `columns` (default: all) for each offset.
+
+        Columns are named `<column>_<name>`, with `names` defaulting to the
+        signed offsets, e.g. `total_gross_income_+1`.
+        """
+        if columns is None:
+            columns = list(self.values)
+        if names is None:
+            names = [f'{offset:+d}' for offset in offsets]
+        pos = self.positions(numbers, dates, offsets)
+        found = pos >= 0
+        at = np.maximum(pos, 0)
+        index = getattr(numbers, 'index', None)
+        frame = {}
+        for i, name in enumerate(names):
+            frame[f'fin_period_start_date_{name}'] = np.where(
+                found[:, i], self.starts[at[:, i]], np.datetime64('NaT')
+            )
+            frame[f'fin_period_end_date_{name}'] = np.where(
+                found[:, i], self.ends[at[:, i]], np.datetime64('NaT')
+            )
+            for column in columns:
+                frame[f'{column}_{name}'] = np.where(found[:, i], self.values[column][at[:, i]], np.nan)
+        return pd.DataFrame(frame, index=index)
+
+
+def _day_keys(numbers, days):
+    days = np.asarray(days, dtype='datetime64[D]')
+    offset = np.where(np.isnat(days), 0, days.astype('int64') + DAY_SHIFT)
+    return np.asarray(numbers, dtype='int64') * DAY_FACTOR + offset
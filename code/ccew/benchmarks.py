@@ -0,0 +1,543 @@
+"""Benchmarks on synthetic data shaped like the register extracts.
+
+Run from the `code` directory, e.g. `python -m ccew.benchmarks numbers --rows 1000000`.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ccew.annual_returns import AnnualReturnIndex, FinancialPeriodIndex
+from ccew.data import CharityNumbers, load_annual_returns, load_trustees, sort_extract
+from ccew.effects import effect_panel
+from ccew.extracts import DATA_DIR, SCHEMAS, parquet_path
+from ccew.mergers import merger_effects
+from ccew.numbers import extract_charity_numbers
+from ccew.status import normalise_status
+from ccew.trustees import link_trustees, repeat_trustees, trustee_counts
+
+NOTES = [
+    'exempt charity',
+    'Excepted charity',
+    'unregistered place of worship',
+    'not registered',
+    'unincorporated association',
+    'CIO',
+]
+
+
+def synthetic_merger_register(rows, seed=42):
+    """Merger register with names formatted like the published CSV."""
+    rng = np.random.default_rng(seed)
+    numbers = rng.integers(200_000, 1_200_000, size=(2, rows)).astype(str)
+    frames = {}
+    for i, column in enumerate(['transferor', 'transferee']):
+        names = pd.Series(
+            [f'Charity {n}' for n in range(rows)], dtype=object
+        )
+        kind = rng.integers(0, 10, size=rows)
+        suffix = rng.integers(1, 10, size=rows).astype(str)
+        note = np.array(NOTES)[rng.integers(0, len(NOTES), size=rows)]
+        label = np.where(
+            kind < 7, '(' + numbers[i] + ')',
+            np.where(kind < 8, '(' + numbers[i] + '-' + suffix + ')',
+                     np.where(kind < 9, '(' + note + ')', 'no ' + numbers[i])),
+        )
+        frames[column] = names + ' ' + label
+    return pd.DataFrame(frames)
+
+
+FORENAMES = [
+    'John', 'David', 'Michael', 'Peter', 'Paul', 'Susan', 'Margaret', 'Sarah',
+    'Elizabeth', 'Jane', 'Richard', 'Andrew', 'Mary', 'Helen', 'James', 'Ann',
+    'Robert', 'Christopher', 'Catherine', 'Patricia', 'Stephen', 'Rachel',
+    'Mohammed', 'Fatima', 'Priya', 'Rajesh', 'Olusegun', 'Chloe', 'Gareth', 'Sian',
+]
+SYLLABLES = [
+    'ash', 'brad', 'car', 'ford', 'ley', 'ton', 'wood', 'son', 'ham', 'well',
+    'field', 'ridge', 'mor', 'gan', 'pat', 'el', 'khan', 'ade', 'bay', 'row',
+    'den', 'wick', 'by', 'stone', 'hill', 'man', 'ker', 'lan', 'ing', 'ow',
+    'ber', 'ric', 'sh', 'tay', 'lor', 'win', 'dale', 'ers', 'ock', 'moor',
+]
+TITLES = ['', '', '', '', 'Mr ', 'Mrs ', 'Dr ', 'Revd ', 'Ms ']
+HONOURS = ['', '', '', '', '', '', '', '', '', ' OBE', ' MBE', ' JP']
+
+
+def synthetic_trustees(rows, charities=None, seed=42):
+    """Trustee extract with ~6 trustees per charity and repeat trustees.
+
+    People holding several trusteeships sometimes get a new `trustee_id`
+    and a variant of their name (initials, title, honours), as in the
+    register. The `person` column is the ground truth for those variants.
+    """
+    rng = np.random.default_rng(seed)
+    charities = charities or max(rows // 6, 1)
+    people = max(rows * 4 // 5, 1)
+    person = rng.integers(0, people, size=rows)
+
+    # one name per person
+    syllables = np.array(SYLLABLES)
+    surnames = pd.Series(
+        syllables[rng.integers(0, len(SYLLABLES), people)]
+        + syllables[rng.integers(0, len(SYLLABLES), people)]
+        + np.where(rng.random(people) < 0.7, syllables[rng.integers(0, len(SYLLABLES), people)], '')
+    ).str.capitalize().to_numpy()
+    forenames = np.array(FORENAMES)[rng.integers(0, len(FORENAMES), people)]
+    middles = np.where(
+        rng.random(people) < 0.5, np.array(list('ABCDEFGHJKLMNPRSTW'))[rng.integers(0, 18, people)], ''
+    )
+
+    # variants per appointment
+    forename = forenames[person]
+    forename = np.where(rng.random(rows) < 0.15, np.char.add(np.char.upper(forename.astype(str)), ''), forename)
+    forename = np.where(rng.random(rows) < 0.15, [f[0] for f in forename], forename)
+    middle = np.where(rng.random(rows) < 0.3, '', middles[person])
+    title = np.array(TITLES)[rng.integers(0, len(TITLES), rows)]
+    honours = np.array(HONOURS)[rng.integers(0, len(HONOURS), rows)]
+    names = pd.Series(title, dtype=object) + forename + ' ' + np.where(
+        middle == '', '', np.char.add(middle.astype(str), ' ')
+    ) + surnames[person] + honours
+    names = names.where(rng.random(rows) < 0.8, names.str.upper())
+
+    # most repeat appointments reuse the person's id, some get a new one
+    new_id = rng.random(rows) < 0.3
+    trustee_id = np.where(new_id, 10_000_000 + np.arange(rows), 1_000_000 + person)
+    appointed = pd.to_datetime('1990-01-01') + pd.to_timedelta(
+        rng.integers(0, 365 * 34, size=rows), unit='D'
+    )
+    return pd.DataFrame({
+        'date_of_extract': pd.Timestamp('2024-09-10'),
+        'organisation_number': rng.integers(1, 6_000_000, size=rows),
+        'registered_charity_number': 200_000 + rng.integers(0, charities, size=rows),
+        'linked_charity_number': 0,
+        'trustee_id': trustee_id,
+        'trustee_name': names,
+        'trustee_is_chair': rng.random(rows) < 0.15,
+        'individual_or_organisation': np.where(rng.random(rows) < 0.97, 'P', 'O'),
+        'trustee_date_of_appointment': appointed,
+        'person': person,
+    })
+
+
+def synthetic_annual_returns(charities, years=range(2008, 2024), seed=42):
+    """Annual return history with one April-March financial period per charity and year."""
+    rng = np.random.default_rng(seed)
+    years = np.asarray(years)
+    numbers = np.repeat(200_000 + np.arange(charities), len(years))
+    start_years = np.tile(years, charities)
+    starts = pd.to_datetime(pd.Series(start_years.astype(str)) + '-04-01')
+    income = rng.lognormal(10, 2, size=len(numbers))
+    # charities stop reporting at random, as transferors do after a merger
+    income[rng.random(len(numbers)) < 0.1] = np.nan
+    return pd.DataFrame({
+        'registered_charity_number': numbers,
+        'fin_period_start_date': starts,
+        'fin_period_end_date': starts + pd.DateOffset(years=1) - pd.Timedelta(days=1),
+        'total_gross_income': income,
+        'total_gross_expenditure': income * rng.uniform(0.7, 1.2, size=len(numbers)),
+    })
+
+
+def synthetic_events(rows, charities, seed=42):
+    """Merger events between charities of `synthetic_annual_returns`."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'transferor_number': (200_000 + rng.integers(0, charities, size=rows)).astype(str),
+        'transferee_number': (200_000 + rng.integers(0, charities, size=rows)).astype(str),
+        'date_transferred': pd.to_datetime('2009-01-01') + pd.to_timedelta(
+            rng.integers(0, 365 * 14, size=rows), unit='D'
+        ),
+    }).assign(merger_year=lambda df: df['date_transferred'].dt.year)
+
+
+def _legacy_numbers(df, column):
+    # chained passes from the notebook before `extract_charity_number`
+    number = df[column].str.lower().str.extract(pat=r'\(([^\(]+?)\)$')[0]
+    number = number.str.replace(pat=r'[\-\.\/]', repl='-', regex=True)
+    return number.combine_first(df[column].str.extract(pat=r'(\d{5,})')[0])
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_numbers(rows):
+    df = synthetic_merger_register(rows)
+    legacy = _timed(
+        lambda: [_legacy_numbers(df, column) for column in ['transferor', 'transferee']]
+    )
+    vectorised = _timed(extract_charity_numbers, df)
+    names = 2 * rows
+    return {
+        'names': names,
+        'legacy_s': round(legacy, 3),
+        'extract_charity_numbers_s': round(vectorised, 3),
+        'names_per_s': round(names / vectorised),
+        'speedup': round(legacy / vectorised, 1),
+    }
+
+
+def _legacy_status(notes):
+    # regex replace chain from the notebook before `normalise_status`
+    return notes.replace(
+        to_replace={
+            'unregistered .*': 'unregistered',
+            'exempt.*': 'exempt',
+            '.*excepted.*': 'excepted',
+            'unincorporated .*': 'unincorporated',
+            'not registered': 'unregistered',
+        },
+        regex=True,
+    ).replace(to_replace={'cio': 'other', 'picpus': 'other'})
+
+
+def bench_status(rows, uniques=3000):
+    rng = np.random.default_rng(42)
+    distinct = np.array([
+        f'{NOTES[i % len(NOTES)].lower()} {i}' for i in range(uniques)
+    ], dtype=object)
+    notes = pd.Series(distinct[rng.integers(0, uniques, size=rows)])
+    legacy = _timed(_legacy_status, notes)
+    normalised = _timed(normalise_status, notes)
+    return {
+        'rows': rows,
+        'uniques': uniques,
+        'legacy_s': round(legacy, 3),
+        'normalise_status_s': round(normalised, 3),
+        'speedup': round(legacy / normalised, 1),
+    }
+
+
+def _legacy_trustees(path):
+    # loading steps from the notebook before `load_trustees`, with object
+    # strings as pandas < 3 reads them
+    df = pd.read_parquet(path).astype({'trustee_name': object, 'individual_or_organisation': object})
+    df['trustee_date_of_appointment'] = df['trustee_date_of_appointment'].apply(pd.to_datetime)
+    df['trustee_name'] = df['trustee_name'].apply(str).astype(object)
+    df['individual_or_organisation'] = df['individual_or_organisation'].apply(str).astype(object)
+    df['registered_charity_number'] = df['registered_charity_number'].apply(str).apply(str.strip).astype(object)
+    return df
+
+
+def _groupby_seconds(df):
+    start = time.perf_counter()
+    for _ in range(3):
+        df.groupby('registered_charity_number', observed=True).size()
+        df['trustee_name'].value_counts()
+    return (time.perf_counter() - start) / 3
+
+
+def bench_categoricals(rows):
+    """Memory and groupby time of the trustee extract, object vs categorical.
+
+    Uses the converted trustee extract in `data/` when there is one, else a
+    synthetic extract of `rows` rows.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = DATA_DIR
+        if not parquet_path('charity_trustee', DATA_DIR).exists():
+            data_dir = tmp
+            table = pa.Table.from_pandas(
+                synthetic_trustees(rows).drop(columns='person'),
+                schema=SCHEMAS['charity_trustee'],
+                preserve_index=False,
+            )
+            pq.write_table(table, parquet_path('charity_trustee', data_dir))
+        path = parquet_path('charity_trustee', data_dir)
+
+        start = time.perf_counter()
+        legacy = _legacy_trustees(path)
+        legacy_load = time.perf_counter() - start
+        start = time.perf_counter()
+        encoded = load_trustees(numbers=CharityNumbers.build(data_dir), data_dir=data_dir)
+        encoded_load = time.perf_counter() - start
+
+        legacy_mb = float(legacy.memory_usage(deep=True).sum()) / 1e6
+        encoded_mb = float(encoded.memory_usage(deep=True).sum()) / 1e6
+        legacy_groupby = _groupby_seconds(legacy)
+        encoded_groupby = _groupby_seconds(encoded)
+    return {
+        'source': 'data' if data_dir == DATA_DIR else 'synthetic',
+        'rows': len(encoded),
+        'object_mb': round(legacy_mb, 1),
+        'categorical_mb': round(encoded_mb, 1),
+        'memory_reduction': round(legacy_mb / encoded_mb, 1),
+        'object_load_s': round(legacy_load, 3),
+        'categorical_load_s': round(encoded_load, 3),
+        'object_groupby_s': round(legacy_groupby, 3),
+        'categorical_groupby_s': round(encoded_groupby, 3),
+        'groupby_speedup': round(legacy_groupby / encoded_groupby, 1),
+    }
+
+
+def _legacy_merge(df, df_ar, role):
+    # double left merge from the notebook before `AnnualReturnIndex`
+    return df.merge(
+        df_ar,
+        left_on=[f'{role}_number', 'merger_year'],
+        right_on=['registered_charity_number', 'fin_start_year'],
+        how='left',
+    ).merge(
+        df_ar,
+        left_on=[f'{role}_number', 'merger_year_next'],
+        right_on=['registered_charity_number', 'fin_start_year'],
+        how='left',
+        suffixes=['_current', '_next'],
+    )
+
+
+def bench_annual_returns(rows, charities=170_000):
+    df_ar = synthetic_annual_returns(charities)
+    events = synthetic_events(rows, charities)
+
+    legacy_ar = df_ar.assign(
+        registered_charity_number=df_ar['registered_charity_number'].astype(str),
+        fin_start_year=df_ar['fin_period_start_date'].dt.year,
+    )[['registered_charity_number', 'fin_start_year', 'total_gross_income']]
+    legacy_events = events.assign(merger_year_next=events['merger_year'] + 1)
+    legacy = _timed(lambda: [
+        _legacy_merge(legacy_events, legacy_ar, role) for role in ['transferor', 'transferee']
+    ])
+
+    start = time.perf_counter()
+    index = AnnualReturnIndex.from_frame(df_ar)
+    build = time.perf_counter() - start
+    offsets = list(range(-2, 4))
+    lookup = _timed(lambda: [
+        index.lookup(events[f'{role}_number'], events['merger_year'], offsets)
+        for role in ['transferor', 'transferee']
+    ])
+
+    start = time.perf_counter()
+    periods = FinancialPeriodIndex.from_frame(df_ar)
+    period_build = time.perf_counter() - start
+    period_match = _timed(lambda: [
+        periods.match(events[f'{role}_number'], events['date_transferred'], [0, 1])
+        for role in ['transferor', 'transferee']
+    ])
+    return {
+        'annual_returns': len(df_ar),
+        'events': rows,
+        'legacy_2_years_s': round(legacy, 3),
+        'index_build_s': round(build, 3),
+        'index_lookup_6_years_s': round(lookup, 3),
+        'period_index_build_s': round(period_build, 3),
+        'period_match_2_periods_s': round(period_match, 3),
+    }
+
+
+def bench_effects(rows, charities=170_000):
+    df_ar = synthetic_annual_returns(charities)
+    events = synthetic_events(rows, charities)
+    periods = FinancialPeriodIndex.from_frame(df_ar)
+
+    legacy_ar = df_ar.assign(
+        registered_charity_number=df_ar['registered_charity_number'].astype(str),
+        fin_start_year=df_ar['fin_period_start_date'].dt.year,
+    )[['registered_charity_number', 'fin_start_year', 'total_gross_income']]
+    legacy_events = events.assign(merger_year_next=events['merger_year'] + 1)
+
+    def legacy():
+        # the notebook's double merge per role, then its percent change
+        for role in ['transferor', 'transferee']:
+            merger_effects.uncached(_legacy_merge(legacy_events, legacy_ar, role))
+
+    panel = _timed(lambda: effect_panel(events, periods, pre=3, post=3))
+    return {
+        'events': rows,
+        'annual_returns': len(df_ar),
+        'next_year_effects_s': round(_timed(legacy), 3),
+        'panel_3_3_periods_s': round(panel, 3),
+        'panel_columns': effect_panel(events.head(1), periods).shape[1],
+    }
+
+
+def _write_annual_returns(df_ar, data_dir):
+    # full extract schema, as converted by `ccew.extracts`
+    schema = SCHEMAS['charity_annual_return_history']
+    rows = len(df_ar)
+    df = df_ar.assign(
+        date_of_extract=pd.Timestamp('2024-09-10'),
+        organisation_number=df_ar['registered_charity_number'],
+        ar_cycle_reference='AR' + (df_ar['fin_period_start_date'].dt.year % 100).astype(str),
+        reporting_due_date=df_ar['fin_period_end_date'] + pd.Timedelta(days=300),
+        date_annual_return_received=df_ar['fin_period_end_date'] + pd.Timedelta(days=200),
+        date_accounts_received=df_ar['fin_period_end_date'] + pd.Timedelta(days=200),
+        accounts_qualified=np.zeros(rows, dtype=bool),
+        suppression_ind=np.zeros(rows, dtype=bool),
+        suppression_type=None,
+    )
+    path = parquet_path('charity_annual_return_history', data_dir)
+    pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), path)
+    sort_extract('charity_annual_return_history', data_dir)
+    CharityNumbers.build(data_dir).save(data_dir)
+
+
+def _load_in_child(loader, data_dir, numbers):
+    start = time.perf_counter()
+    if loader == 'legacy':
+        # full read from the notebook before `load_annual_returns`
+        df = pd.read_parquet(parquet_path('charity_annual_return_history', data_dir))
+        df = df[[
+            'registered_charity_number',
+            'fin_period_start_date',
+            'fin_period_end_date',
+            'total_gross_income',
+            'total_gross_expenditure',
+        ]]
+    else:
+        df = load_annual_returns(
+            columns=['registered_charity_number', 'fin_period_start_date',
+                     'fin_period_end_date', 'total_gross_income'],
+            years=(2007, None),
+            charity_numbers=numbers,
+            data_dir=data_dir,
+        )
+    seconds = time.perf_counter() - start
+    return seconds, len(df), _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    # ru_maxrss survives exec on Linux, VmHWM is reset with the new address space
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _in_fresh_process(func, *args):
+    # a spawned process starts with a clean heap, so its peak RSS is the load's own
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(func, *args).result()
+
+
+def bench_loaders(rows, charities=170_000):
+    """Cold load of the annual returns for the merger analysis, full read vs pushdown."""
+    df_ar = synthetic_annual_returns(charities, years=range(1995, 2024))
+    events = synthetic_events(rows, charities)
+    numbers = pd.concat([events['transferor_number'], events['transferee_number']]).unique()
+    with tempfile.TemporaryDirectory() as data_dir:
+        _write_annual_returns(df_ar, data_dir)
+        legacy_s, legacy_rows, legacy_mb = _in_fresh_process(_load_in_child, 'legacy', data_dir, numbers)
+        pushdown_s, pushdown_rows, pushdown_mb = _in_fresh_process(_load_in_child, 'pushdown', data_dir, numbers)
+    return {
+        'annual_returns': len(df_ar),
+        'charities_wanted': len(numbers),
+        'full_read_s': round(legacy_s, 3),
+        'full_read_rows': legacy_rows,
+        'full_read_peak_rss_mb': round(legacy_mb),
+        'pushdown_s': round(pushdown_s, 3),
+        'pushdown_rows': pushdown_rows,
+        'pushdown_peak_rss_mb': round(pushdown_mb),
+    }
+
+
+def _count_in_child(method, data_dir):
+    start = time.perf_counter()
+    if method == 'frame':
+        # whole frame as loaded in the notebook, then the same tables as `TrusteeCounts`
+        df = load_trustees(data_dir=data_dir)
+        per_charity = df.groupby('registered_charity_number', observed=True).size()
+        per_year = df.groupby(
+            [df['trustee_date_of_appointment'].dt.year, 'registered_charity_number'], observed=True
+        ).size()
+        per_year.groupby(level=0).quantile(0.5)
+        median = per_charity.median()
+    else:
+        median = trustee_counts(parquet_path('charity_trustee', data_dir)).summary().loc['all', 'p50']
+    return time.perf_counter() - start, float(median), _peak_rss_mb()
+
+
+def bench_trustee_counts(rows):
+    """Median trustees per charity, from the loaded frame vs a streaming pass."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        table = pa.Table.from_pandas(
+            synthetic_trustees(rows).drop(columns='person'),
+            schema=SCHEMAS['charity_trustee'],
+            preserve_index=False,
+        )
+        pq.write_table(table, parquet_path('charity_trustee', data_dir))
+        sort_extract('charity_trustee', data_dir)
+        CharityNumbers.build(data_dir).save(data_dir)
+        frame_s, frame_median, frame_mb = _in_fresh_process(_count_in_child, 'frame', data_dir)
+        stream_s, stream_median, stream_mb = _in_fresh_process(_count_in_child, 'stream', data_dir)
+    return {
+        'rows': rows,
+        'frame_s': round(frame_s, 3),
+        'frame_median': frame_median,
+        'frame_peak_rss_mb': round(frame_mb),
+        'stream_s': round(stream_s, 3),
+        'stream_median': stream_median,
+        'stream_peak_rss_mb': round(stream_mb),
+    }
+
+
+def _pairs(groups):
+    sizes = groups.value_counts().to_numpy()
+    return int((sizes * (sizes - 1) // 2).sum())
+
+
+def bench_trustees(rows):
+    """Runtime of `link_trustees` on a synthetic trustee extract, and pairwise
+    precision and recall of the clusters against the known people."""
+    df = synthetic_trustees(rows)
+    df = df.loc[df['individual_or_organisation'] == 'P']
+    start = time.perf_counter()
+    links = link_trustees(df)
+    seconds = time.perf_counter() - start
+    person = df.drop_duplicates('trustee_id').set_index('trustee_id')['person']
+    links = links.assign(person=links['trustee_id'].map(person).to_numpy())
+    linked = _pairs(links['cluster'])
+    correct = _pairs(links['cluster'].astype(str) + '|' + links['person'].astype(str))
+    true = _pairs(links['person'])
+    repeats = repeat_trustees(df, links)
+    return {
+        'rows': len(df),
+        'trustee_ids': len(links),
+        'clusters': int(links['cluster'].nunique()),
+        'repeat_clusters': len(repeats),
+        'link_s': round(seconds, 3),
+        'precision': round(correct / max(linked, 1), 3),
+        'recall': round(correct / max(true, 1), 3),
+    }
+
+
+BENCHMARKS = {
+    'numbers': bench_numbers,
+    'status': bench_status,
+    'categoricals': bench_categoricals,
+    'annual_returns': bench_annual_returns,
+    'effects': bench_effects,
+    'loaders': bench_loaders,
+    'trustees': bench_trustees,
+    'trustee_counts': bench_trustee_counts,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', help=f'any of {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(name, BENCHMARKS[name](args.rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Content-addressed on-disk cache for the analysis steps.
+
+`@cached` stores the frame returned by a function in an Arrow IPC file
+named after a hash of:
+
+- the function's qualified name and source code;
+- its arguments: frames and series by content, paths (`Path`, `str` or
+  any `os.PathLike`) to existing files by the content of the file,
+  anything else by `repr`;
+- the content of the files listed in `inputs` (data and rule tables the
+  function reads), or `ABSENT` for those that do not exist yet;
+- the source files of the modules listed in `modules` (code the function
+  calls), so that editing them also invalidates its entries.
+
+A step is recomputed only when one of these changes, e.g. after a kernel
+restart the notebook reloads its intermediate frames from the cache as long
+as the source data and the code are the same. File contents are hashed once
+per (size, modification time). The cache is kept under a size budget by
+evicting the least recently used entries.
+"""
+
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from ccew.extracts import DATA_DIR, READ_SIZE
+
+CACHE_DIR = DATA_DIR / 'cache'
+# override with the CCEW_CACHE_DIR and CCEW_CACHE_BUDGET environment variables
+BUDGET = 2 << 30
+SUFFIX = '.arrow'
+FILE_HASHES = 'file_hashes.json'
+# pandas object kind, stored in the Arrow schema metadata
+KIND_KEY = b'ccew_cache_kind'
+# digest of an input file that does not exist (e.g. one the function creates)
+ABSENT = 'absent'
+
+
+def cache_dir():
+    return Path(os.environ.get('CCEW_CACHE_DIR', CACHE_DIR))
+
+
+def cache_budget():
+    return int(os.environ.get('CCEW_CACHE_BUDGET', BUDGET))
+
+
+_file_hashes = {}
+
+
+def file_digest(path, directory=None):
+    """sha256 of a file's content, recomputed only when its size or mtime change."""
+    path = Path(path).resolve()
+    stat = path.stat()
+    signature = [stat.st_size, stat.st_mtime_ns]
+    directory = cache_dir() if directory is None else Path(directory)
+    if not _file_hashes:
+        try:
+            _file_hashes.update(json.loads((directory / FILE_HASHES).read_text()))
+        except (OSError, ValueError):
+            pass
+    known = _file_hashes.get(str(path))
+    if known and known[0] == signature:
+        return known[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+    _file_hashes[str(path)] = [signature, digest.hexdigest()]
+    directory.mkdir(parents=True, exist_ok=True)
+    # pipeline stages run in parallel processes: each writes its own tmp file
+    tmp_path = directory / f'{FILE_HASHES}.{os.getpid()}.tmp'
+    tmp_path.write_text(json.dumps(_file_hashes, indent=1))
+    tmp_path.replace(directory / FILE_HASHES)
+    return digest.hexdigest()
+
+
+def value_digest(value):
+    """Hash of an argument: by content for pandas objects and paths to files, else by repr."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest = hashlib.sha256()
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        columns = value.columns if isinstance(value, pd.DataFrame) else [value.name]
+        dtypes = value.dtypes if isinstance(value, pd.DataFrame) else [value.dtype]
+        labels = (list(columns), list(value.index.names), list(map(str, dtypes)))
+        digest.update(repr(labels).encode())
+        return digest.hexdigest()
+    if isinstance(value, (str, os.PathLike)) and os.path.isfile(value):
+        return file_digest(value)
+    if isinstance(value, (list, tuple)):
+        return repr([value_digest(item) for item in value])
+    if isinstance(value, dict):
+        return repr({key: value_digest(item) for key, item in sorted(value.items())})
+    return repr(value)
+
+
+def _source(func):
+    try:
+        return inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        # no source file (e.g. defined in a REPL): fall back to the bytecode
+        code = func.__code__
+        return code.co_code + repr(code.co_consts).encode()
+
+
+def module_path(module):
+    """Source file of a module, given as a module or its dotted name."""
+    if isinstance(module, str):
+        module = importlib.import_module(module)
+    return Path(module.__file__)
+
+
+def cache_key(func, args, kwargs, inputs=(), modules=()):
+    """Hash of a call: function source, arguments, input files and module sources."""
+    digest = hashlib.sha256()
+    digest.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    digest.update(_source(func))
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    for name, value in bound.arguments.items():
+        digest.update(f'{name}={value_digest(value)}'.encode())
+    for path in inputs:
+        digest.update((file_digest(path) if Path(path).exists() else ABSENT).encode())
+    for module in modules:
+        digest.update(file_digest(module_path(module)).encode())
+    return digest.hexdigest()
+
+
+def write_entry(path, result):
+    """Write a frame or series to an Arrow IPC file, atomically."""
+    if isinstance(result, pd.Series):
+        kind, frame = b'series', result.to_frame()
+    elif isinstance(result, pd.DataFrame):
+        kind, frame = b'frame', result
+    else:
+        raise TypeError(f'only DataFrames and Series can be cached, got {type(result).__name__}')
+    table = pa.Table.from_pandas(frame, preserve_index=True)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), KIND_KEY: kind})
+    tmp_path = path.with_suffix('.tmp')
+    with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    tmp_path.replace(path)
+
+
+def read_entry(path):
+    """Read a frame or series written by `write_entry`."""
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    frame = table.to_pandas()
+    # restore the dtypes that Arrow maps back to pandas defaults:
+    # object columns of strings, and pyarrow-backed columns
+    for column in table.schema.pandas_metadata['columns']:
+        name, numpy_type = column['name'], column['numpy_type']
+        if name not in frame.columns:
+            continue
+        if numpy_type == 'object':
+            frame[name] = frame[name].astype(object)
+        elif numpy_type.endswith('[pyarrow]'):
+            frame[name] = table.column(column['field_name']).to_pandas(
+                types_mapper=pd.ArrowDtype
+            ).set_axis(frame.index)
+    if table.schema.metadata.get(KIND_KEY) == b'series':
+        return frame.iloc[:, 0]
+    return frame
+
+
+def evict(directory=None, budget=None):
+    """Delete the least recently used entries until the cache fits in `budget` bytes."""
+    directory = cache_dir() if directory is None else Path(directory)
+    budget = cache_budget() if budget is None else budget
+    entries = sorted(directory.glob(f'*{SUFFIX}'), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in entries)
+    removed = 0
+    for path in entries:
+        if total <= budget:
+            break
+        total -= path.stat().st_size
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed
+
+
+def cached(func=None, *, inputs=(), modules=()):
+    """Cache the frame returned by `func` on disk, keyed on its code and inputs.
+
+    `inputs` lists files the function reads that are not among its
+    arguments, and `modules` the modules (or their dotted names) whose code
+    it calls. Use as `@cached` or `@cached(inputs=[path], modules=['ccew.x'])`.
+    Calling `func.uncached(...)` bypasses the cache.
+    """
+    if func is None:
+        return functools.partial(cached, inputs=inputs, modules=modules)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        directory = cache_dir()
+        key = cache_key(func, args, kwargs, [Path(p) for p in inputs], modules)
+        path = directory / f'{func.__name__}-{key[:32]}{SUFFIX}'
+        if path.exists():
+            # the modification time orders entries for LRU eviction
+            os.utime(path)
+            return read_entry(path)
+        result = func(*args, **kwargs)
+        directory.mkdir(parents=True, exist_ok=True)
+        write_entry(path, result)
+        evict(directory)
+        return result
+
+    wrapper.uncached = func
+    return wrapper
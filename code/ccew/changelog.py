@@ -0,0 +1,284 @@
+"""Change log between two daily snapshots of an extract.
+
+Rows of the old and the new snapshot are matched on the key of their
+extract (`KEYS`): a key only in the new snapshot is `added`, a key only in
+the old one `removed`, and a key in both whose values differ gives one
+`changed` event per field that differs, with the old and new values as
+text. `date_of_extract` is ignored. A charity name change is then a
+`changed` event on `charity_name` of `charity`, a new registration an
+`added` charity, and so on.
+
+Both snapshots are streamed in record batches and hash partitioned on the
+key into `partitions` spill files (Arrow IPC, in a temporary directory);
+partitions are then joined one pair at a time, so memory use is bounded by
+a batch and a partition rather than by the size of the extract. Events
+are written to Parquet as each partition is joined, grouped by partition
+rather than sorted.
+
+    python -m ccew.changelog charity old/publicextract.charity.zip publicextract.charity.zip
+    python -m ccew.changelog charity --date 2024-09-11    # a stored day against the one before
+    python -m ccew.changelog                              # the newest stored day of each extract
+"""
+
+import argparse
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.extracts import DATA_DIR, ROW_GROUP_SIZE
+from ccew.snapshots import DATE_COLUMN, STORE_DIR, load_index, snapshot
+from ccew.warehouse import iter_source as iter_extract
+
+CHANGES_DIR = 'changes'
+KEYS = {
+    'charity': ['organisation_number'],
+    'charity_other_names': ['organisation_number', 'charity_name_id'],
+    'charity_trustee': ['organisation_number', 'trustee_id'],
+}
+# columns kept on every event, to link them to the register
+CHARITY_COLUMNS = ['registered_charity_number', 'linked_charity_number']
+PARTITIONS = 16
+OCCURRENCE = '_occurrence'
+
+
+@dataclass
+class ChangeLog:
+    """Number of events of each type between two snapshots of an extract."""
+
+    name: str
+    path: Path
+    added: int = 0
+    removed: int = 0
+    changed: int = 0
+    fields: dict = field(default_factory=dict)
+    seconds: float = 0.0
+
+    def __str__(self):
+        fields = ', '.join(f'{name} {count}' for name, count in sorted(
+            self.fields.items(), key=lambda item: -item[1]
+        ))
+        return (
+            f'{self.name}: +{self.added} -{self.removed} ~{self.changed} '
+            f'({fields or "no field changes"}) in {self.seconds:.1f}s -> {self.path}'
+        )
+
+
+def changes_path(name, day, data_dir=DATA_DIR):
+    """Path of the change log of extract `name` on `day`."""
+    return Path(data_dir) / CHANGES_DIR / f'{name}.{day}.parquet'
+
+
+def iter_source(source, batch_size=ROW_GROUP_SIZE):
+    """Record batches of a snapshot: an extract zip, a Parquet file or an Arrow table."""
+    if isinstance(source, pa.Table):
+        yield from source.to_batches(max_chunksize=batch_size)
+    else:
+        yield from iter_extract(source, batch_size=batch_size)
+
+
+def partition_of(batch, key, partitions):
+    """Partition of each row of a batch: a hash of its key modulo `partitions`."""
+    keys = pd.DataFrame(
+        {column: batch.column(column).to_numpy(zero_copy_only=False) for column in key}
+    )
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy() % np.uint64(partitions)
+
+
+def spill(batches, key, partitions, directory, prefix):
+    """Write `batches` to one Arrow IPC file per partition; returns their paths and schema."""
+    paths = [Path(directory) / f'{prefix}.{i}.arrow' for i in range(partitions)]
+    writers, schema = None, None
+    try:
+        for batch in batches:
+            if writers is None:
+                schema = batch.schema
+                writers = [pa.ipc.new_stream(str(path), schema) for path in paths]
+            batch = batch.cast(schema) if batch.schema != schema else batch
+            parts = partition_of(batch, key, partitions)
+            order = np.argsort(parts, kind='stable')
+            bounds = np.searchsorted(parts[order], np.arange(partitions + 1))
+            batch = batch.take(pa.array(order))
+            for i, writer in enumerate(writers):
+                if bounds[i + 1] > bounds[i]:
+                    writer.write_batch(batch.slice(bounds[i], bounds[i + 1] - bounds[i]))
+    finally:
+        for writer in writers or []:
+            writer.close()
+    if writers is None:
+        raise ValueError(f'{prefix} snapshot has no rows')
+    return paths, schema
+
+
+def _read_partition(path, key):
+    with pa.ipc.open_stream(str(path)) as reader:
+        df = reader.read_pandas()
+    df = df.drop(columns=[DATE_COLUMN], errors='ignore')
+    # rank among rows with the same key, so duplicated keys are matched in order
+    df[OCCURRENCE] = df.groupby(key, dropna=False).cumcount()
+    return df
+
+
+def _text(values):
+    return values.astype('string')
+
+
+def diff_partition(old, new, key):
+    """Events of one pair of partitions, as a DataFrame."""
+    on = key + [OCCURRENCE]
+    merged = old.merge(new, on=on, how='outer', suffixes=('_old', '_new'), indicator=True)
+    events = []
+    for change, side, suffix in [
+        ('added', 'right_only', '_new'), ('removed', 'left_only', '_old')
+    ]:
+        rows = merged[merged['_merge'] == side]
+        events.append(pd.DataFrame({
+            'change': change,
+            **{column: rows[column] for column in key},
+            **{column: rows[column + suffix] for column in CHARITY_COLUMNS if column not in key},
+        }))
+
+    both = merged[merged['_merge'] == 'both']
+    for column in old.columns:
+        if column in on or column + '_new' not in both.columns:
+            continue
+        before, after = both[column + '_old'], both[column + '_new']
+        same = (before == after).fillna(False) | (before.isna() & after.isna())
+        rows = both[~same.to_numpy(dtype=bool)]
+        if rows.empty:
+            continue
+        events.append(pd.DataFrame({
+            'change': 'changed',
+            **{column: rows[column] for column in key},
+            **{c: rows[c + '_new'] for c in CHARITY_COLUMNS if c not in key},
+            'field': column,
+            'old_value': _text(rows[column + '_old']),
+            'new_value': _text(rows[column + '_new']),
+        }))
+    return pd.concat([e for e in events if len(e)] or events[:1], ignore_index=True)
+
+
+def event_schema(schema, key):
+    """Schema of the change log of an extract with record schema `schema`."""
+    columns = key + [column for column in CHARITY_COLUMNS if column not in key]
+    return pa.schema(
+        [('date', pa.date32()), ('change', pa.dictionary(pa.int8(), pa.string()))]
+        + [schema.field(column) for column in columns if column in schema.names]
+        + [('field', pa.string()), ('old_value', pa.string()), ('new_value', pa.string())]
+    )
+
+
+def _latest_date(batches, found):
+    # pass batches through, keeping the latest date_of_extract in found[0]
+    for batch in batches:
+        if DATE_COLUMN in batch.schema.names:
+            latest = pc.max(batch.column(DATE_COLUMN)).as_py()
+            if latest is not None and (found[0] is None or latest > found[0]):
+                found[0] = latest
+        yield batch
+
+
+def diff_snapshots(name, old, new, out_path=None, day=None, partitions=PARTITIONS,
+                   data_dir=DATA_DIR):
+    """Write the change log from snapshot `old` to snapshot `new` of extract `name`.
+
+    `old` and `new` are extract zips, Parquet files or Arrow tables. `day`,
+    the date of the events, defaults to the `date_of_extract` of `new`, and
+    `out_path` to `changes_path(name, day)`.
+    """
+    start = time.perf_counter()
+    key = KEYS.get(name)
+    if key is None:
+        raise KeyError(f'no key for extract {name!r}: one of {", ".join(KEYS)}')
+    with tempfile.TemporaryDirectory(prefix='ccew-changelog-') as directory:
+        old_paths, _ = spill(iter_source(old), key, partitions, directory, 'old')
+        latest = [None]
+        new_paths, schema = spill(
+            _latest_date(iter_source(new), latest), key, partitions, directory, 'new'
+        )
+        if day is None:
+            day = latest[0].date().isoformat() if latest[0] is not None else 'latest'
+        if out_path is None:
+            out_path = changes_path(name, day, data_dir)
+        out_path = Path(out_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = out_path.with_suffix('.tmp')
+
+        schema = event_schema(schema, key)
+        log = ChangeLog(name, out_path)
+        event_day = pd.Timestamp(day).date() if day != 'latest' else None
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            for old_path, new_path in zip(old_paths, new_paths):
+                events = diff_partition(
+                    _read_partition(old_path, key), _read_partition(new_path, key), key
+                )
+                if events.empty:
+                    continue
+                events.insert(0, 'date', event_day)
+                for column in schema.names:
+                    if column not in events.columns:
+                        events[column] = None
+                writer.write_table(
+                    pa.Table.from_pandas(events[schema.names], schema=schema, preserve_index=False)
+                )
+                counts = events['change'].value_counts()
+                log.added += int(counts.get('added', 0))
+                log.removed += int(counts.get('removed', 0))
+                log.changed += int(counts.get('changed', 0))
+                for column, count in events['field'].value_counts().items():
+                    log.fields[column] = log.fields.get(column, 0) + int(count)
+        tmp_path.replace(out_path)
+    log.seconds = time.perf_counter() - start
+    return log
+
+
+def diff_stored_day(name, day=None, store_dir=STORE_DIR, data_dir=DATA_DIR,
+                    partitions=PARTITIONS):
+    """Change log of a day of the snapshot store (default: the newest) against the day before."""
+    days = [entry['date'] for entry in load_index(name, store_dir)]
+    if day is None:
+        day = days[-1] if days else None
+    if day not in days or days.index(day) == 0:
+        raise KeyError(f'{name!r} has no stored day before {day}')
+    previous = days[days.index(day) - 1]
+    return diff_snapshots(
+        name, snapshot(name, previous, store_dir), snapshot(name, day, store_dir),
+        day=day, partitions=partitions, data_dir=data_dir,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('name', nargs='?', choices=list(KEYS), help='extract (default: all)')
+    parser.add_argument('old', nargs='?', type=Path, help='old snapshot: zip or Parquet file')
+    parser.add_argument('new', nargs='?', type=Path, help='new snapshot: zip or Parquet file')
+    parser.add_argument(
+        '--date', help='stored day to compare with the day before (default: the newest)'
+    )
+    parser.add_argument('--out', type=Path, help='change log path (default: data/changes/)')
+    parser.add_argument('--partitions', type=int, default=PARTITIONS)
+    parser.add_argument('--store-dir', type=Path, default=STORE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    if args.old is not None:
+        if args.name is None or args.new is None:
+            parser.error('give an extract and both the old and the new snapshot')
+        print(diff_snapshots(args.name, args.old, args.new, args.out, args.date,
+                             args.partitions, args.data_dir))
+        return
+    for name in [args.name] if args.name else KEYS:
+        if len(load_index(name, args.store_dir)) < 2:
+            print(f'{name}: fewer than two stored days')
+            continue
+        print(diff_stored_day(name, args.date, args.store_dir, args.data_dir, args.partitions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""Load the converted extracts with compact, shared dtypes.
+
+String columns are read from Parquet as Arrow dictionary arrays, so they
+arrive in pandas as categoricals without materialising one Python string per
+row, and whitespace is stripped once per distinct value. Charity number
+columns of every table are encoded with one shared categorical dtype, so
+that joins, `value_counts` and `groupby` across tables run on integer codes.
+
+Column selections and row filters (years, charity numbers) are pushed down
+to the Parquet reader. Row groups whose statistics exclude the filter are
+skipped; `sort_extract` clusters a table on its filter columns so that
+this happens as often as possible.
+"""
+
+import argparse
+import tempfile
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: the dictionary is written without a lock
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from ccew.annual_returns import as_charity_numbers
+from ccew.extracts import DATA_DIR, EXTRACTS, ROW_GROUP_SIZE, parquet_path
+
+NUMBERS_FILE = 'charity_numbers.parquet'
+NUMBERS_LOCK = 'charity_numbers.lock'
+# rows sorted in memory at once by `sort_extract`
+RUN_SIZE = 2_000_000
+
+NUMBER_COLUMNS = (
+    'registered_charity_number',
+    'assoc_registered_charity_number',
+    'transferor_number',
+    'transferee_number',
+)
+
+# string columns read as categoricals, per extract
+CATEGORY_COLUMNS = {
+    'charity': [
+        'charity_name', 'charity_type', 'charity_registration_status',
+        'charity_reporting_status', 'charity_is_cdf_or_cif',
+    ],
+    'charity_annual_return_history': ['ar_cycle_reference', 'suppression_type'],
+    'charity_area_of_operation': [
+        'geographic_area_type', 'geographic_area_description',
+        'parent_geographic_area_type', 'parent_geographic_area_description',
+    ],
+    'charity_classification': ['classification_type', 'classification_description'],
+    'charity_event_history': ['charity_name', 'event_type', 'reason', 'assoc_charity_name'],
+    'charity_governing_document': ['governing_document_description'],
+    'charity_other_names': ['charity_name_type', 'charity_name'],
+    'charity_other_regulators': ['regulator_name', 'regulator_web_url'],
+    'charity_policy': ['policy_name'],
+    'charity_published_report': ['report_name'],
+    'charity_trustee': ['trustee_name', 'individual_or_organisation'],
+}
+
+# columns each extract is sorted on by `sort_extract`, so that row group
+# statistics on them are selective
+SORT_KEYS = {
+    'charity_annual_return_history': ['fin_period_start_date', 'registered_charity_number'],
+    'charity_trustee': ['registered_charity_number'],
+    'charity_event_history': ['date_of_event', 'registered_charity_number'],
+}
+
+
+class CharityNumbers:
+    """Append-only dictionary of charity numbers shared by every table.
+
+    Codes never change once assigned, so tables encoded at different times
+    stay comparable. A dictionary loaded from a data directory saves itself
+    there whenever `encode` appends numbers, so the codes it hands out are
+    the ones the next process loads. The stored dictionary is read, extended
+    and written under a file lock, and numbers other processes stored in the
+    meantime keep their codes: pipeline stages run in parallel processes.
+    """
+
+    def __init__(self, numbers=(), data_dir=None):
+        self.categories = pd.Index(pd.unique(np.asarray(numbers, dtype='int64')))
+        # where the dictionary is stored, if it was loaded from there
+        self.data_dir = data_dir
+
+    def __len__(self):
+        return len(self.categories)
+
+    @property
+    def dtype(self):
+        return pd.CategoricalDtype(self.categories)
+
+    @classmethod
+    def _read(cls, data_dir):
+        path = Path(data_dir) / NUMBERS_FILE
+        numbers = pq.read_table(path).column('number').to_numpy() if path.exists() else ()
+        return cls(numbers, data_dir)
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR, names=EXTRACTS):
+        """Stored dictionary extended with every charity number of the converted extracts.
+
+        Numbers not stored yet are appended in ascending order, so the codes
+        of the stored ones do not change.
+        """
+        numbers = []
+        for name in names:
+            path = parquet_path(name, data_dir)
+            if not path.exists():
+                continue
+            columns = [c for c in pq.read_schema(path).names if c in NUMBER_COLUMNS]
+            table = pq.read_table(path, columns=columns)
+            for column in table.columns:
+                numbers.append(pc.unique(column.drop_null()).to_numpy())
+        dictionary = cls._read(data_dir)
+        if numbers:
+            dictionary.extend(np.unique(np.concatenate(numbers)))
+        return dictionary
+
+    @classmethod
+    def load(cls, data_dir=DATA_DIR):
+        """Stored dictionary, built and saved on first use."""
+        with _locked(data_dir):
+            if (Path(data_dir) / NUMBERS_FILE).exists():
+                return cls._read(data_dir)
+            numbers = cls.build(data_dir)
+            numbers._write(data_dir)
+            return numbers
+
+    def save(self, data_dir=DATA_DIR):
+        """Store the dictionary after the numbers stored since it was read."""
+        with _locked(data_dir):
+            self._merge(data_dir)
+            self._write(data_dir)
+
+    def _merge(self, data_dir):
+        # stored numbers first, with their codes, then the ones only known here
+        stored = self._read(data_dir).categories
+        self.categories = stored.append(self.categories[~self.categories.isin(stored)])
+
+    def _write(self, data_dir):
+        path = Path(data_dir) / NUMBERS_FILE
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.parquet.tmp')
+        pq.write_table(pa.table({'number': self.categories.to_numpy()}), tmp_path)
+        tmp_path.replace(path)
+
+    def extend(self, values):
+        """Append numbers not seen yet; returns how many were added."""
+        values = pd.unique(pd.Series(values).dropna().astype('int64'))
+        new = values[self.categories.get_indexer(values) == -1]
+        if len(new):
+            self.categories = self.categories.append(pd.Index(new))
+        return len(new)
+
+    def encode(self, values):
+        """Categorical of `values` using the shared dtype, appending numbers not seen yet."""
+        values = pd.Series(values)
+        missing = values.isna()
+        numbers = values.fillna(0).astype('int64')
+        new = numbers[~missing][self.categories.get_indexer(numbers[~missing]) == -1]
+        if len(new) and self.data_dir is not None:
+            # codes handed out must be the stored ones, whatever other processes added
+            with _locked(self.data_dir):
+                self._merge(self.data_dir)
+                if self.extend(new):
+                    self._write(self.data_dir)
+        else:
+            self.extend(new)
+        codes = self.categories.get_indexer(numbers)
+        codes[missing.to_numpy()] = -1
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
+
+
+@contextmanager
+def _locked(data_dir):
+    # exclusive lock on the charity number dictionary of `data_dir`
+    path = Path(data_dir) / NUMBERS_LOCK
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        yield
+
+
+def strip_dictionary(column):
+    """Dictionary array of a string column, whitespace stripped once per distinct value."""
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    if not pa.types.is_dictionary(column.type):
+        column = pc.dictionary_encode(column)
+    stripped = pc.utf8_trim_whitespace(column.dictionary)
+    return pc.dictionary_encode(pc.take(stripped, column.indices))
+
+
+def encode_table(table, category_columns=(), numbers=None):
+    """Convert an Arrow table to pandas with categorical names and numbers."""
+    if numbers is None:
+        numbers = CharityNumbers()
+    for column in category_columns:
+        if column in table.column_names:
+            i = table.column_names.index(column)
+            table = table.set_column(i, column, strip_dictionary(table.column(column)))
+    df = table.to_pandas()
+    for column in NUMBER_COLUMNS:
+        if column in df.columns:
+            df[column] = numbers.encode(df[column])
+    return df
+
+
+def year_filter(column, years):
+    """Filter on the year of a date column.
+
+    `years` is an iterable of years, or a `(first, last)` tuple where either
+    bound can be None. The filter is a range on the column itself, so it can
+    be checked against row group statistics.
+    """
+    if isinstance(years, tuple) and len(years) == 2:
+        first, last = years
+    else:
+        years = list(years)
+        first, last = min(years), max(years)
+    field = ds.field(column)
+    expression = None
+    if first is not None:
+        expression = field >= _new_year(first)
+    if last is not None:
+        upper = field < _new_year(last + 1)
+        expression = upper if expression is None else expression & upper
+    return expression
+
+
+def _new_year(year):
+    return pa.scalar(pd.Timestamp(year=year, month=1, day=1), pa.timestamp('ms'))
+
+
+def number_filter(charity_numbers, column='registered_charity_number'):
+    """Filter on a set of charity numbers; labels that are not numbers are ignored."""
+    numbers = as_charity_numbers(charity_numbers)
+    numbers = np.unique(numbers[~np.isnan(numbers)].astype('int64'))
+    if not len(numbers):
+        return ds.scalar(False)
+    field = ds.field(column)
+    # min/max bounds let the reader skip row groups; isin selects the rows
+    return (
+        (field >= int(numbers[0]))
+        & (field <= int(numbers[-1]))
+        & field.isin(pa.array(numbers))
+    )
+
+
+def _combine(*filters):
+    expression = None
+    for item in filters:
+        if item is not None:
+            expression = item if expression is None else expression & item
+    return expression
+
+
+def load_table(name, columns=None, filters=None, numbers=None, data_dir=DATA_DIR):
+    """Load a converted extract with categorical string and number columns.
+
+    Only `columns` are read, and `filters` (a `pyarrow.dataset` expression)
+    is applied by the reader, skipping row groups that cannot match.
+    """
+    path = parquet_path(name, data_dir)
+    if numbers is None:
+        numbers = CharityNumbers.load(data_dir)
+    category_columns = [
+        c for c in CATEGORY_COLUMNS.get(name, []) if columns is None or c in columns
+    ]
+    table = pq.read_table(
+        path, columns=columns, filters=filters, read_dictionary=category_columns
+    )
+    return encode_table(table, category_columns, numbers)
+
+
+def load_trustees(columns=None, charity_numbers=None, appointed=None, numbers=None,
+                  data_dir=DATA_DIR):
+    """Trustees, optionally of some charities or appointed in some years."""
+    filters = _combine(
+        None if charity_numbers is None else number_filter(charity_numbers),
+        None if appointed is None else year_filter('trustee_date_of_appointment', appointed),
+    )
+    return load_table('charity_trustee', columns, filters, numbers, data_dir)
+
+
+def load_annual_returns(columns=None, years=None, charity_numbers=None, numbers=None,
+                        data_dir=DATA_DIR):
+    """Annual returns, optionally of some charities or of periods starting in some years."""
+    filters = _combine(
+        None if charity_numbers is None else number_filter(charity_numbers),
+        None if years is None else year_filter('fin_period_start_date', years),
+    )
+    return load_table('charity_annual_return_history', columns, filters, numbers, data_dir)
+
+
+def load_other_names(columns=None, charity_numbers=None, numbers=None, data_dir=DATA_DIR):
+    """Other names, optionally of some charities."""
+    filters = None if charity_numbers is None else number_filter(charity_numbers)
+    return load_table('charity_other_names', columns, filters, numbers, data_dir)
+
+
+def _partitions(path, key, run_size):
+    # range partition of each value of column `key`, with about `run_size` rows per
+    # partition (more when a single value has more rows); nulls go in the last one
+    column = pq.read_table(path, columns=[key]).column(key)
+    valid = pc.is_valid(column).to_numpy(zero_copy_only=False)
+    values = np.sort(pc.drop_null(column).cast(pa.int64()).to_numpy())
+    bounds = np.unique(values[run_size::run_size])
+    return bounds, len(bounds) + 1 + (not valid.all())
+
+
+def sort_extract(name, data_dir=DATA_DIR, row_group_size=ROW_GROUP_SIZE, run_size=RUN_SIZE):
+    """Rewrite a converted extract sorted on its `SORT_KEYS`.
+
+    Sorting clusters the filter columns, so that the min/max statistics of
+    each row group only cover a narrow range and filtered reads skip most
+    row groups. Extracts of more than `run_size` rows are sorted externally:
+    rows are streamed into spill files by range of the first sort key, then
+    each range is sorted on its own and appended to the output, so memory
+    holds one range rather than the whole extract.
+    """
+    keys = SORT_KEYS.get(name)
+    if not keys:
+        return
+    path = parquet_path(name, data_dir)
+    file = pq.ParquetFile(path)
+    schema = file.schema_arrow
+    ordering = [(key, 'ascending') for key in keys]
+    tmp_path = path.with_suffix('.parquet.tmp')
+    writer = pq.ParquetWriter(
+        tmp_path, schema, sorting_columns=pq.SortingColumn.from_ordering(schema, ordering)
+    )
+    with writer, tempfile.TemporaryDirectory(prefix='ccew-sort-') as directory:
+        if file.metadata.num_rows <= run_size:
+            writer.write_table(file.read().sort_by(ordering), row_group_size=row_group_size)
+        else:
+            bounds, partitions = _partitions(path, keys[0], run_size)
+            paths = [Path(directory) / f'{i}.arrow' for i in range(partitions)]
+            with ExitStack() as stack:
+                spills = [stack.enter_context(pa.ipc.new_file(str(p), schema)) for p in paths]
+                for batch in file.iter_batches(batch_size=row_group_size):
+                    key = batch.column(keys[0])
+                    parts = np.searchsorted(
+                        bounds, pc.fill_null(key.cast(pa.int64()), 0).to_numpy(), side='right'
+                    )
+                    parts[~pc.is_valid(key).to_numpy(zero_copy_only=False)] = partitions - 1
+                    for i in np.unique(parts):
+                        spills[i].write_batch(batch.filter(pa.array(parts == i)))
+            for spill in paths:
+                with pa.memory_map(str(spill)) as source:
+                    table = pa.ipc.open_file(source).read_all()
+                writer.write_table(table.sort_by(ordering), row_group_size=row_group_size)
+    tmp_path.replace(path)
+
+
+def sorted_on(path):
+    """Columns a Parquet file is declared sorted on (ascending), from its metadata."""
+    file = pq.ParquetFile(path)
+    if not file.metadata.num_row_groups:
+        return []
+    sorting = file.metadata.row_group(0).sorting_columns
+    if not sorting:
+        return []
+    ordering, _ = pq.SortingColumn.to_ordering(file.schema_arrow, sorting)
+    keys = []
+    for column, order in ordering:
+        if order != 'ascending':
+            break
+        keys.append(column)
+    return keys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sort converted extracts for filtered reads and build the charity number dictionary.'
+    )
+    parser.add_argument('names', nargs='*', default=list(SORT_KEYS), help='extracts to sort')
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    for name in args.names:
+        keys = SORT_KEYS.get(name)
+        if keys and parquet_path(name, args.data_dir).exists():
+            sort_extract(name, args.data_dir)
+            print(f'{name}: sorted on {", ".join(keys)}')
+    numbers = CharityNumbers.build(args.data_dir)
+    numbers.save(args.data_dir)
+    print(f'{len(numbers)} charity numbers')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Income and expenditure of merging charities over windows of financial periods.
+
+`merger_effects` compares the financial period of a merger with the next
+one, for one role at a time. `effect_panel` looks further: for every event
+it takes the `pre` periods before the merger and the `post` periods after
+it, for the transferor and the transferee at once, with one `positions`
+lookup per role in an annual return index and NumPy reductions over the
+window columns, no merge.
+
+For each role and value column, the panel has the mean over the periods
+before (`_pre`) and after (`_post`) the merger that have a return, the
+value in the merger's period (`_current`), and three measures of change:
+
+- `_change`: percent change from `_pre` to `_post`, with the convention of
+  `ccew.mergers.merger_effects` (a missing side counts as 0, so a value
+  appearing or disappearing gives +/-100);
+- `_log_ratio`: `log(post / pre)`, symmetric and not dominated by tiny
+  bases, NaN unless both are positive;
+- `_cagr`: compound annual growth from `_pre` to `_post`, over the years
+  between the centres of the windows.
+
+`pro_forma_<column>_*` compares the transferee after the merger with the
+transferors and transferee combined before it (any of them alone when the
+others have no return), i.e. the growth of the merged charity rather than
+the growth the transferee got from absorbing the transferor. Every
+transferor of the same transferee on the same date is combined, so the
+rows of a merger of several charities share the same pro forma figures.
+
+    index = FinancialPeriodIndex.from_frame(df_ar)
+    panel = effect_panel(df, index, pre=3, post=3)
+"""
+
+import numpy as np
+import pandas as pd
+
+from ccew.annual_returns import as_charity_numbers
+from ccew.mergers import ROLES
+
+PRE = 3
+POST = 3
+
+
+def window_offsets(pre=PRE, post=POST):
+    """Period offsets of a window around an event: `-pre` to `post`, 0 being the event's."""
+    return np.arange(-pre, post + 1)
+
+
+def _mean(values):
+    # mean of each row over its non-missing values, NaN when there are none
+    present = ~np.isnan(values)
+    count = present.sum(axis=1)
+    total = np.where(present, values, 0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def change_metrics(pre, post, years):
+    """`change`, `log_ratio` and `cagr` from arrays of values before and after events."""
+    both = ~np.isnan(pre) & ~np.isnan(post)
+    either = ~np.isnan(pre) | ~np.isnan(post)
+    before, after = np.nan_to_num(pre), np.nan_to_num(post)
+    positive = both & (before > 0) & (after > 0)
+    ratio = np.where(positive, after, 1) / np.where(positive, before, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change = (after - before) / before * 100
+    change = np.where(np.isposinf(change), 100, np.where(np.isneginf(change), -100, change))
+    return {
+        'change': np.where(either, change, np.nan),
+        'log_ratio': np.where(positive, np.log(ratio), np.nan),
+        'cagr': np.where(positive, ratio ** (1 / years) - 1, np.nan),
+    }
+
+
+def merger_groups(events, date_column='date_transferred'):
+    """Group of each event: one per registered transferee and date.
+
+    Events whose transferee is not a charity number or whose date is
+    missing are each a group of their own.
+    """
+    numbers = as_charity_numbers(events['transferee_number'])
+    dates = pd.to_datetime(pd.Series(events[date_column], copy=False))
+    known = ~np.isnan(numbers) & dates.notna().to_numpy()
+    codes = np.full(len(events), -1, dtype='int64')
+    if known.any():
+        codes[known] = pd.DataFrame(
+            {'number': numbers[known], 'date': dates[known].to_numpy()}
+        ).groupby(['number', 'date'], sort=False).ngroup().to_numpy()
+    alone = ~known
+    codes[alone] = codes.max(initial=-1) + 1 + np.arange(alone.sum())
+    return codes
+
+
+def _group_sum(values, groups, labels):
+    # sum of `values` over each event's group, counting each label once; NaN when all missing
+    first = ~pd.DataFrame({'group': groups, 'label': labels}).duplicated().to_numpy()
+    counted = first & ~np.isnan(values)
+    size = groups.max(initial=-1) + 1
+    sums = np.bincount(groups, weights=np.where(counted, values, 0), minlength=size)
+    present = np.bincount(groups, weights=counted, minlength=size) > 0
+    return np.where(present[groups], sums[groups], np.nan)
+
+
+def effect_panel(events, index, pre=PRE, post=POST, columns=None, roles=ROLES,
+                 date_column='date_transferred'):
+    """Panel of `columns` (default: all of the index) around each event, and their changes.
+
+    `events` has `<role>_number` labels for each of `roles` and a
+    `date_column`; `index` is a `FinancialPeriodIndex` (events matched to
+    the period containing their date), or an `AnnualReturnIndex` with a
+    year `date_column`. The panel is aligned on `events`.
+    """
+    if pre < 1 or post < 1:
+        raise ValueError('pre and post windows need at least one period each')
+    if columns is None:
+        columns = list(index.values)
+    offsets = window_offsets(pre, post)
+    before, after = offsets < 0, offsets > 0
+    # years between the centres of the windows, for annual growth rates
+    years = offsets[after].mean() - offsets[before].mean()
+
+    panel, means = {}, {}
+    for role in roles:
+        pos = index.positions(events[f'{role}_number'], events[date_column], offsets)
+        found = pos >= 0
+        at = np.maximum(pos, 0)
+        for column in columns:
+            values = np.where(found, index.values[column][at], np.nan)
+            name = f'{role}_{column}'
+            means[role, column] = _mean(values[:, before]), _mean(values[:, after])
+            panel[f'{name}_pre'], panel[f'{name}_post'] = means[role, column]
+            panel[f'{name}_current'] = values[:, offsets == 0][:, 0]
+            for metric, result in change_metrics(*means[role, column], years).items():
+                panel[f'{name}_{metric}'] = result
+
+    if set(ROLES) <= set(roles):
+        groups = merger_groups(events, date_column)
+        labels = events['transferor_number'].astype('string').fillna('').to_numpy()
+        for column in columns:
+            # every transferor of the merger, each counted once
+            transferor = _group_sum(means['transferor', column][0], groups, labels)
+            transferee = means['transferee', column][0]
+            combined = np.where(
+                np.isnan(transferor) & np.isnan(transferee),
+                np.nan,
+                np.nan_to_num(transferor) + np.nan_to_num(transferee),
+            )
+            after_merger = means['transferee', column][1]
+            name = f'pro_forma_{column}'
+            panel[f'{name}_pre'], panel[f'{name}_post'] = combined, after_merger
+            for metric, result in change_metrics(combined, after_merger, years).items():
+                panel[f'{name}_{metric}'] = result
+    return pd.DataFrame(panel, index=events.index)
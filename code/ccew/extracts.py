@@ -0,0 +1,327 @@
+"""Stream the Charity Commission's `publicextract.*.zip` files into Parquet.
+
+Each zip holds a single JSON array with one record per line. The records are
+decoded incrementally straight out of the zip member and written to Parquet
+in bounded row groups, so memory use depends on the row group size rather
+than on the size of the extract.
+"""
+
+import argparse
+import io
+import json
+import zipfile
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+ARCHIVE_DIR = ROOT_DIR / 'archive'
+DATA_DIR = ROOT_DIR / 'data'
+
+BASE_URL = 'https://ccewuksprdoneregsadata1.blob.core.windows.net/data/json'
+
+# extracts published at https://register-of-charities.charitycommission.gov.uk/register/full-register-download
+EXTRACTS = (
+    'charity',
+    'charity_annual_return_history',
+    'charity_annual_return_parta',
+    'charity_annual_return_partb',
+    'charity_area_of_operation',
+    'charity_classification',
+    'charity_event_history',
+    'charity_governing_document',
+    'charity_other_names',
+    'charity_other_regulators',
+    'charity_policy',
+    'charity_published_report',
+    'charity_trustee',
+)
+
+ROW_GROUP_SIZE = 100_000
+READ_SIZE = 1 << 20
+
+_DATE = pa.timestamp('ms')
+_INT = pa.int64()
+_FLOAT = pa.float64()
+_STR = pa.string()
+_BOOL = pa.bool_()
+
+_COMMON = [
+    ('date_of_extract', _DATE),
+    ('organisation_number', _INT),
+    ('registered_charity_number', _INT),
+]
+
+SCHEMAS = {
+    'charity': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('charity_name', _STR),
+        ('charity_type', _STR),
+        ('charity_registration_status', _STR),
+        ('date_of_registration', _DATE),
+        ('date_of_removal', _DATE),
+        ('charity_reporting_status', _STR),
+        ('latest_acc_fin_period_start_date', _DATE),
+        ('latest_acc_fin_period_end_date', _DATE),
+        ('latest_income', _FLOAT),
+        ('latest_expenditure', _FLOAT),
+        ('charity_contact_address1', _STR),
+        ('charity_contact_address2', _STR),
+        ('charity_contact_address3', _STR),
+        ('charity_contact_address4', _STR),
+        ('charity_contact_address5', _STR),
+        ('charity_contact_postcode', _STR),
+        ('charity_contact_phone', _STR),
+        ('charity_contact_email', _STR),
+        ('charity_contact_web', _STR),
+        ('charity_company_registration_number', _STR),
+        ('charity_insolvent', _BOOL),
+        ('charity_in_administration', _BOOL),
+        ('charity_previously_excepted', _BOOL),
+        ('charity_is_cdf_or_cif', _STR),
+        ('charity_is_cio', _BOOL),
+        ('cio_is_dissolved', _BOOL),
+        ('date_cio_dissolution_notice', _DATE),
+        ('charity_activities', _STR),
+        ('charity_gift_aid', _BOOL),
+        ('charity_has_land', _BOOL),
+    ]),
+    'charity_annual_return_history': pa.schema(_COMMON + [
+        ('fin_period_start_date', _DATE),
+        ('fin_period_end_date', _DATE),
+        ('ar_cycle_reference', _STR),
+        ('reporting_due_date', _DATE),
+        ('date_annual_return_received', _DATE),
+        ('date_accounts_received', _DATE),
+        ('total_gross_income', _FLOAT),
+        ('total_gross_expenditure', _FLOAT),
+        ('accounts_qualified', _BOOL),
+        ('suppression_ind', _BOOL),
+        ('suppression_type', _STR),
+    ]),
+    'charity_area_of_operation': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('geographic_area_type', _STR),
+        ('geographic_area_description', _STR),
+        ('parent_geographic_area_type', _STR),
+        ('parent_geographic_area_description', _STR),
+        ('welsh_ind', _BOOL),
+    ]),
+    'charity_classification': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('classification_code', _INT),
+        ('classification_type', _STR),
+        ('classification_description', _STR),
+    ]),
+    'charity_event_history': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('charity_name', _STR),
+        ('charity_event_order', _INT),
+        ('event_type', _STR),
+        ('date_of_event', _DATE),
+        ('reason', _STR),
+        ('assoc_organisation_number', _INT),
+        ('assoc_registered_charity_number', _INT),
+        ('assoc_charity_name', _STR),
+    ]),
+    'charity_governing_document': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('governing_document_description', _STR),
+        ('charitable_objects', _STR),
+        ('area_of_benefit', _STR),
+    ]),
+    'charity_other_names': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('charity_name_id', _INT),
+        ('charity_name_type', _STR),
+        ('charity_name', _STR),
+    ]),
+    'charity_other_regulators': pa.schema(_COMMON + [
+        ('regulator_order', _INT),
+        ('regulator_name', _STR),
+        ('regulator_web_url', _STR),
+    ]),
+    'charity_policy': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('policy_name', _STR),
+    ]),
+    'charity_published_report': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('report_name', _STR),
+        ('report_location', _STR),
+        ('date_published', _DATE),
+    ]),
+    'charity_trustee': pa.schema(_COMMON + [
+        ('linked_charity_number', _INT),
+        ('trustee_id', _INT),
+        ('trustee_name', _STR),
+        ('trustee_is_chair', _BOOL),
+        ('individual_or_organisation', _STR),
+        ('trustee_date_of_appointment', _DATE),
+    ]),
+}
+
+
+def extract_path(name, archive_dir=ARCHIVE_DIR):
+    """Path of the archived zip for extract `name`."""
+    return Path(archive_dir) / f'publicextract.{name}.zip'
+
+
+def parquet_path(name, data_dir=DATA_DIR):
+    """Path of the Parquet file converted from extract `name`."""
+    return Path(data_dir) / f'publicextract.{name}.parquet'
+
+
+def extract_name(path):
+    """Extract name from a `publicextract.<name>.zip|json|parquet` path."""
+    stem = Path(path).name.split('.')
+    return stem[1] if stem[0] == 'publicextract' else stem[0]
+
+
+def iter_records(path, read_size=READ_SIZE):
+    """Yield the records of an extract zip one by one, without unzipping to disk."""
+    with zipfile.ZipFile(path) as archive:
+        member = next(
+            info for info in archive.infolist() if info.filename.endswith('.json')
+        )
+        with archive.open(member) as raw:
+            text = io.TextIOWrapper(raw, encoding='utf-8-sig')
+            yield from _iter_array(text, read_size)
+
+
+def _iter_array(text, read_size):
+    decoder = json.JSONDecoder()
+    buffer = text.read(read_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('extract is not a JSON array')
+    pos = 1
+    eof = False
+    while True:
+        # skip separators between records
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            record, end = None, len(buffer)
+        if end >= len(buffer) and not eof:
+            # record may be cut off at the end of the buffer: read more and retry
+            chunk = text.read(read_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        if record is None:
+            raise ValueError('truncated or malformed extract')
+        yield record
+        pos = end
+
+
+def infer_schema(record):
+    """Schema for an extract without a declared schema, from its first record."""
+    fields = []
+    for name, value in record.items():
+        if 'date' in name:
+            type_ = _DATE
+        elif isinstance(value, bool):
+            type_ = _BOOL
+        elif isinstance(value, (int, float)):
+            is_key = name.endswith(('_number', '_id', '_order')) or name.startswith('count_')
+            type_ = _INT if is_key and isinstance(value, int) else _FLOAT
+        else:
+            type_ = _STR
+        fields.append((name, type_))
+    return pa.schema(fields)
+
+
+def records_to_batch(records, schema):
+    """Convert a list of records to a record batch with the given schema.
+
+    Dates arrive as ISO strings and are parsed by Arrow. Keys that are not in
+    the schema are dropped.
+    """
+    arrays = []
+    for field in schema:
+        values = [record.get(field.name) for record in records]
+        if pa.types.is_timestamp(field.type):
+            arrays.append(pa.array(values, type=_STR).cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_batches(path, schema=None, batch_size=ROW_GROUP_SIZE):
+    """Yield record batches of at most `batch_size` rows from an extract zip."""
+    if schema is None:
+        schema = SCHEMAS.get(extract_name(path))
+    records = []
+    for record in iter_records(path):
+        if schema is None:
+            schema = infer_schema(record)
+        records.append(record)
+        if len(records) == batch_size:
+            yield records_to_batch(records, schema)
+            records = []
+    if records:
+        yield records_to_batch(records, schema)
+
+
+def convert_extract(path, out_path=None, row_group_size=ROW_GROUP_SIZE):
+    """Convert an extract zip to Parquet, one row group at a time.
+
+    Returns the number of rows written.
+    """
+    if out_path is None:
+        out_path = parquet_path(extract_name(path))
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_suffix('.parquet.tmp')
+    writer = None
+    rows = 0
+    try:
+        for batch in iter_batches(path, batch_size=row_group_size):
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, batch.schema)
+            writer.write_batch(batch, row_group_size=row_group_size)
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f'{path} contains no records')
+    tmp_path.replace(out_path)
+    return rows
+
+
+def convert_all(names=EXTRACTS, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR,
+                row_group_size=ROW_GROUP_SIZE):
+    """Convert every archived extract in `names`, skipping missing zips."""
+    converted = {}
+    for name in names:
+        path = extract_path(name, archive_dir)
+        if not path.exists():
+            continue
+        converted[name] = convert_extract(
+            path, parquet_path(name, data_dir), row_group_size
+        )
+    return converted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=EXTRACTS, help='extracts to convert')
+    parser.add_argument('--archive-dir', type=Path, default=ARCHIVE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args(argv)
+
+    converted = convert_all(args.names, args.archive_dir, args.data_dir, args.row_group_size)
+    for name, rows in converted.items():
+        print(f'{name}: {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
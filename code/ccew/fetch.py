@@ -0,0 +1,442 @@
+"""Download the nightly extracts concurrently, resuming and verifying each one.
+
+The extracts to fetch are `ccew.extracts.EXTRACTS`, from `BASE_URL`. All
+of them are requested at once (at most `CONCURRENCY` at a time) over
+asyncio streams, so one slow or failing download does not hold up the
+others:
+
+- the ETag and Last-Modified of each archived zip are kept in
+  `archive/fetch_state.json`, and sent back as `If-None-Match` and
+  `If-Modified-Since`: an unchanged extract costs one 304 response;
+- a download goes to `<zip>.part`; when it is cut off or stalls for
+  `READ_TIMEOUT` seconds, it is retried from where it stopped with a
+  `Range` request, guarded by `If-Range` so that a file that changed in
+  the meantime is downloaded again from the start. A `.part` that already
+  has the full length is verified as it is rather than asked for more
+  (which the server answers with a 416), and one the server cannot resume,
+  or that was not sent with an ETag or Last-Modified to guard the resume
+  with, is deleted and downloaded again. The state is saved as each
+  download starts and ends, so a run that is killed resumes where it
+  stopped;
+- the archived zip is only replaced once the new one has its full length
+  and passes `zipfile`'s CRC check.
+
+`serve_archive` is a local stand-in for the register's blob storage that
+serves a directory of zips with the same headers, to try the fetcher
+offline:
+
+    python -m ccew.fetch                                   # fetch into archive/
+    python -m ccew.fetch --serve ../archive --port 8001    # stand-in server
+    python -m ccew.fetch --base-url http://127.0.0.1:8001 --archive-dir /tmp/archive
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import ssl
+import sys
+import time
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+
+from ccew.extracts import ARCHIVE_DIR, BASE_URL, EXTRACTS, extract_path
+
+STATE_FILE = 'fetch_state.json'
+CONCURRENCY = 4
+RETRIES = 4
+# seconds without receiving any data before a download counts as stalled
+READ_TIMEOUT = 60
+# seconds before the first retry, doubled at each following one
+BACKOFF = 2
+CHUNK_SIZE = 1 << 16
+MAX_REDIRECTS = 5
+PORT = 8001
+
+
+class FetchError(Exception):
+    """A download that failed in a way worth retrying."""
+
+
+@dataclass
+class FetchResult:
+    """Outcome of fetching one extract."""
+
+    name: str
+    status: str  # 'downloaded', 'unchanged' or 'failed'
+    size: int = 0
+    resumed_from: int = 0
+    attempts: int = 1
+    error: str = ''
+
+    def __str__(self):
+        if self.status == 'failed':
+            return f'{self.name}: failed after {self.attempts} attempts ({self.error})'
+        if self.status == 'unchanged':
+            return f'{self.name}: unchanged'
+        resumed = f', resumed at {self.resumed_from} bytes' if self.resumed_from else ''
+        return f'{self.name}: {self.size} bytes{resumed}'
+
+
+def load_state(archive_dir=ARCHIVE_DIR):
+    path = Path(archive_dir) / STATE_FILE
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def save_state(state, archive_dir=ARCHIVE_DIR):
+    path = Path(archive_dir) / STATE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+    tmp_path.replace(path)
+
+
+def verify_zip(path):
+    """Raise FetchError unless `path` is a readable zip holding a JSON extract."""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            if not any(info.filename.endswith('.json') for info in archive.infolist()):
+                raise FetchError('zip holds no JSON file')
+            bad = archive.testzip()
+    except zipfile.BadZipFile as error:
+        raise FetchError(f'not a zip: {error}') from None
+    if bad is not None:
+        raise FetchError(f'bad CRC for {bad}')
+
+
+async def _read(reader, size=CHUNK_SIZE):
+    try:
+        return await asyncio.wait_for(reader.read(size), READ_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise FetchError(f'stalled for {READ_TIMEOUT}s') from None
+
+
+async def _readline(reader):
+    try:
+        return await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise FetchError(f'stalled for {READ_TIMEOUT}s') from None
+
+
+async def _open(url, headers):
+    # GET `url`; returns the status, lower-cased headers and the open streams
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=ssl.create_default_context() if https else None),
+        READ_TIMEOUT,
+    )
+    target = parts.path + (f'?{parts.query}' if parts.query else '')
+    lines = [f'GET {target} HTTP/1.1', f'Host: {parts.netloc}', 'Connection: close',
+             'User-Agent: ccew-fetch']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+    status_line = (await _readline(reader)).decode('latin-1').split(None, 2)
+    if len(status_line) < 2 or not status_line[1].isdigit():
+        writer.close()
+        raise FetchError(f'bad status line from {host}')
+    response_headers = {}
+    while (line := (await _readline(reader)).decode('latin-1').strip()):
+        key, _, value = line.partition(':')
+        response_headers[key.strip().lower()] = value.strip()
+    return int(status_line[1]), response_headers, reader, writer
+
+
+async def _request(url, headers):
+    # `_open`, following redirects
+    for _ in range(MAX_REDIRECTS + 1):
+        status, response_headers, reader, writer = await _open(url, headers)
+        if status not in (301, 302, 303, 307, 308):
+            return status, response_headers, reader, writer
+        writer.close()
+        url = urljoin(url, response_headers['location'])
+    raise FetchError(f'more than {MAX_REDIRECTS} redirects')
+
+
+async def _copy_body(reader, headers, file):
+    # write the response body to `file`; returns the number of bytes written
+    written = 0
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await _readline(reader)).split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                return written
+            while size:
+                data = await _read(reader, min(size, CHUNK_SIZE))
+                if not data:
+                    raise FetchError('connection closed in a chunk')
+                file.write(data)
+                written += len(data)
+                size -= len(data)
+            await _readline(reader)
+    remaining = int(headers['content-length']) if 'content-length' in headers else None
+    while remaining is None or remaining > 0:
+        data = await _read(reader, CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE))
+        if not data:
+            break
+        file.write(data)
+        written += len(data)
+        if remaining is not None:
+            remaining -= len(data)
+    return written
+
+
+def _validators(headers):
+    return {key: headers[key] for key in ('etag', 'last-modified') if key in headers}
+
+
+def _total_length(headers):
+    # full length of the file from a `Content-Range: bytes a-b/N` or `bytes */N` header
+    total = headers.get('content-range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _install(name, part, target, entry, validators, resumed_from=0):
+    # verify a complete `.part` file and move it over the archived zip
+    size = part.stat().st_size
+    try:
+        verify_zip(part)
+    except FetchError:
+        # a corrupt file cannot be resumed
+        part.unlink()
+        entry.pop('partial', None)
+        raise
+    os.replace(part, target)
+    entry.clear()
+    entry.update(validators)
+    entry['size'] = size
+    entry['fetched_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    return FetchResult(name, 'downloaded', size, resumed_from=resumed_from)
+
+
+async def _download(name, url, archive_dir, entry, save):
+    # one attempt; updates `entry`, the extract's state, as it goes and calls `save`
+    target = extract_path(name, archive_dir)
+    part = target.with_name(target.name + '.part')
+    headers = {}
+    partial = entry.get('partial')
+    offset = part.stat().st_size if part.exists() and partial else 0
+    if offset and not _validators(partial):
+        # nothing to tell whether the file changed since: download it again
+        part.unlink()
+        entry.pop('partial')
+        offset = 0
+    if offset and offset == partial.get('length'):
+        # the whole body arrived but was not installed: there is nothing left to ask for
+        return _install(name, part, target, entry, _validators(partial), offset)
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = partial.get('etag', partial.get('last-modified'))
+    elif target.exists():
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last-modified' in entry:
+            headers['If-Modified-Since'] = entry['last-modified']
+
+    status, response_headers, reader, writer = await _request(url, headers)
+    try:
+        if status == HTTPStatus.NOT_MODIFIED:
+            return FetchResult(name, 'unchanged', target.stat().st_size)
+        if status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE and offset:
+            if _total_length(response_headers) == offset:
+                # the partial file already holds the whole body
+                return _install(name, part, target, entry, _validators(partial), offset)
+            # the file shrank or the range is wrong: start again from scratch
+            part.unlink(missing_ok=True)
+            entry.pop('partial', None)
+            raise FetchError(f'HTTP {status} for bytes from {offset}, restarting')
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            start = int(response_headers.get('content-range', 'bytes -1').split()[1].split('-')[0])
+            if start != offset:
+                raise FetchError(f'asked for bytes from {offset}, got {start}')
+        elif status == HTTPStatus.OK:
+            offset = 0
+        elif status >= 500 or status == HTTPStatus.TOO_MANY_REQUESTS:
+            raise FetchError(f'HTTP {status}')
+        else:
+            return FetchResult(name, 'failed', error=f'HTTP {status}')
+
+        expected = (
+            offset + int(response_headers['content-length'])
+            if 'content-length' in response_headers else None
+        )
+        # remember what the partial file is a prefix of, and its full length, to resume it
+        entry['partial'] = _validators(response_headers)
+        length = _total_length(response_headers) if offset else expected
+        if length is not None:
+            entry['partial']['length'] = length
+        save()
+        part.parent.mkdir(parents=True, exist_ok=True)
+        with open(part, 'r+b' if offset else 'wb') as file:
+            file.seek(offset)
+            file.truncate()
+            await _copy_body(reader, response_headers, file)
+    finally:
+        writer.close()
+
+    size = part.stat().st_size
+    if expected is not None and size != expected:
+        raise FetchError(f'got {size} of {expected} bytes')
+    return _install(name, part, target, entry, _validators(response_headers), offset)
+
+
+async def fetch_extract(name, base_url, archive_dir, entry, semaphore, retries=RETRIES,
+                        save=lambda: None):
+    """Fetch one extract, retrying with exponential backoff; never raises.
+
+    `save` is called whenever `entry` changes, to save the state.
+    """
+    url = f'{base_url.rstrip("/")}/publicextract.{name}.zip'
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            async with semaphore:
+                result = await _download(name, url, archive_dir, entry, save)
+            result.attempts = attempt
+            return result
+        except (FetchError, OSError, asyncio.TimeoutError, ValueError, KeyError) as exc:
+            error = exc
+            if attempt <= retries:
+                await asyncio.sleep(BACKOFF * 2 ** (attempt - 1))
+    return FetchResult(name, 'failed', attempts=retries + 1, error=f'{type(error).__name__}: {error}')
+
+
+async def fetch_all(names=EXTRACTS, base_url=BASE_URL, archive_dir=ARCHIVE_DIR,
+                    concurrency=CONCURRENCY, retries=RETRIES):
+    """Fetch `names` concurrently; returns their `FetchResult`s.
+
+    The state is saved as each download starts and ends, rather than once
+    all are done, so that an interrupted run keeps its partial downloads.
+    """
+    state = load_state(archive_dir)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(name):
+        entry = state.setdefault(name, {})
+        try:
+            return await fetch_extract(
+                name, base_url, archive_dir, entry, semaphore, retries,
+                lambda: save_state(state, archive_dir),
+            )
+        finally:
+            save_state(state, archive_dir)
+
+    return await asyncio.gather(*(fetch_one(name) for name in names))
+
+
+def fetch(names=EXTRACTS, base_url=BASE_URL, archive_dir=ARCHIVE_DIR,
+          concurrency=CONCURRENCY, retries=RETRIES):
+    """`fetch_all` from synchronous code."""
+    return asyncio.run(fetch_all(names, base_url, archive_dir, concurrency, retries))
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serves the zips of the server's `directory` with ETag, Last-Modified and ranges."""
+
+    def do_GET(self):
+        path = self.server.directory / Path(urlsplit(self.path).path).name
+        if not path.is_file():
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        stat = path.stat()
+        size = stat.st_size
+        etag = '"' + hashlib.md5(f'{stat.st_mtime_ns}-{size}'.encode()).hexdigest() + '"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag or (
+            'If-None-Match' not in self.headers
+            and 'If-Modified-Since' in self.headers
+            and parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp()
+            >= int(stat.st_mtime)
+        ):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        ranged = self.headers.get('Range', '').startswith('bytes=') and self.headers.get(
+            'If-Range', etag
+        ) in (etag, last_modified)
+        if ranged:
+            first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+            start, end = int(first or 0), min(int(last) if last else size - 1, size - 1)
+            if start >= size:
+                # with the full length, as blob storage sends it
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if ranged else HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0 and (data := file.read(min(remaining, CHUNK_SIZE))):
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def log_message(self, format, *args):
+        print(f'{self.command} {self.path} {args[1] if len(args) > 1 else ""}', flush=True)
+
+
+def serve_archive(directory=ARCHIVE_DIR, host='127.0.0.1', port=PORT):
+    """HTTP server for a directory of extract zips, standing in for `BASE_URL`."""
+    server = ThreadingHTTPServer((host, port), ArchiveHandler)
+    server.directory = Path(directory)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=EXTRACTS, help='extracts to fetch')
+    parser.add_argument('--base-url', default=BASE_URL)
+    parser.add_argument('--archive-dir', type=Path, default=ARCHIVE_DIR)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    parser.add_argument('--serve', type=Path, metavar='DIR',
+                        help='serve the zips of DIR instead of fetching')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        server = serve_archive(args.serve, port=args.port)
+        print(f'serving {args.serve} on http://127.0.0.1:{args.port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    start = time.perf_counter()
+    results = fetch(args.names, args.base_url, args.archive_dir, args.concurrency, args.retries)
+    for result in results:
+        print(result, file=sys.stderr if result.status == 'failed' else sys.stdout)
+    print(f'{len(results)} extracts in {time.perf_counter() - start:.1f}s')
+    # the extracts that were fetched are still worth archiving if some failed
+    if all(result.status == 'failed' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
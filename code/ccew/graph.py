@@ -0,0 +1,300 @@
+"""Graph of the mergers between registered charities.
+
+Charities are nodes, identified by an integer code for their charity number
+label (`1053467`, `1170369-1`); each merger is an edge from the transferor
+to the transferee. Mergers with an unregistered, exempt or unknown party are
+left out of the graph, as these parties are not single charities, so the
+graph only answers chain and cluster queries.
+
+A charity's own rows of the register come from a separate row index keyed
+on every party label, statuses included (`exempt`, `excepted`, ...), with
+subsidiaries (`1053467-01`) also filed under their main charity's number:
+`graph.mergers('275946')` has Kingdom Hall Trust's mergers with excepted
+congregations, and `graph.mergers('1053467')` those of its subsidiaries.
+
+The edges are stored as compressed sparse rows, twice: by transferor (for
+transferees and descendants) and by transferee (for transferors and
+ancestors), so looking up a charity's mergers costs O(its degree) instead of
+a scan of the register. Weakly connected components, the consolidation
+clusters, are computed once when the graph is built.
+
+    graph = MergerGraph.from_frame(df)
+    graph.transferors('275946')     # charities merged into Kingdom Hall Trust
+    graph.descendants('1189059')    # everything its funds ended up in
+    graph.cluster('1053467')        # all charities linked by mergers to it
+    graph.chains()                  # A -> B -> C transfers
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ccew.extracts import DATA_DIR
+from ccew.releases import TABLE_FILE, load_table
+
+GRAPH_FILE = 'merger_graph.npz'
+# bump to rebuild saved graphs when their layout changes
+GRAPH_VERSION = 1
+ROLES = ('transferor', 'transferee')
+# main charity number of a subsidiary label
+PARENT_PATTERN = r'^(\d+)-'
+
+
+def _csr(keys, values, size):
+    # offsets and values of a CSR index of `values` by `keys`, stable in row order
+    order = np.argsort(keys, kind='stable')
+    indptr = np.zeros(size + 1, dtype='int64')
+    np.cumsum(np.bincount(keys, minlength=size), out=indptr[1:])
+    return indptr, values[order], order
+
+
+def _components(source, target, size):
+    # smallest node code of each weakly connected component, by label propagation
+    # with pointer jumping: O(edges * log(diameter)) numpy operations
+    labels = np.arange(size)
+    while True:
+        previous = labels.copy()
+        low = np.minimum(labels[source], labels[target])
+        np.minimum.at(labels, source, low)
+        np.minimum.at(labels, target, low)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def party_index(df):
+    """Party label, role (0 for transferor, 1 for transferee) and row position of every
+    party of every merger in `df`, subsidiaries again under their main charity's number."""
+    labels, roles, rows = [], [], []
+    for role_code, role in enumerate(ROLES):
+        label = pd.Series(df[f'{role}_number'].to_numpy(dtype=object)).astype('string')
+        parent = label.str.extract(PARENT_PATTERN, expand=False)
+        for values in (label, parent):
+            present = values.notna().to_numpy(dtype=bool)
+            labels.append(values[present].to_numpy(dtype=object))
+            roles.append(np.full(present.sum(), role_code, dtype='int64'))
+            rows.append(np.flatnonzero(present))
+    return np.concatenate(labels), np.concatenate(roles), np.concatenate(rows)
+
+
+def is_charity_number(labels):
+    """Whether charity number labels are numbers (`1053467`, `1170369-1`), not statuses."""
+    return pd.Series(labels, dtype='string').str.match(r'^\d').fillna(False).to_numpy(dtype=bool)
+
+
+class MergerGraph:
+    """Transfers between charities, as CSR adjacency arrays keyed on charity codes.
+
+    `nodes[code]` is the charity number label of a code. Edges keep the
+    position of their merger in the frame the graph was built from, as does
+    the party index (see `party_index`), so `df.iloc[graph.mergers(label)]`
+    gives a party's rows of the register.
+    """
+
+    def __init__(self, nodes, source, target, rows, dates, parties=None):
+        self.nodes = np.asarray(nodes, dtype=object)
+        self.index = pd.Index(self.nodes)
+        self.source = np.asarray(source, dtype='int64')
+        self.target = np.asarray(target, dtype='int64')
+        self.rows = np.asarray(rows, dtype='int64')
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        size = len(self.nodes)
+        # edge ids by transferor and by transferee
+        self.out_ptr, self.out_edges, _ = _csr(self.source, np.arange(len(self.source)), size)
+        self.in_ptr, self.in_edges, _ = _csr(self.target, np.arange(len(self.target)), size)
+        self.component = _components(self.source, self.target, size)
+        self.cluster_ptr, self.cluster_nodes, _ = _csr(
+            self.component, np.arange(size), size
+        )
+        # row positions by party label and role
+        if parties is None:
+            parties = (np.array([], dtype=object), np.array([], dtype='int64'),
+                       np.array([], dtype='int64'))
+        labels, roles, party_rows = parties
+        codes, party_labels = pd.factorize(np.asarray(labels, dtype=object), sort=True)
+        self.party_labels = pd.Index(party_labels)
+        self.party_ptr, self.party_rows, _ = _csr(
+            codes * len(ROLES) + np.asarray(roles, dtype='int64'),
+            np.asarray(party_rows, dtype='int64'),
+            len(party_labels) * len(ROLES),
+        )
+
+    @classmethod
+    def from_frame(cls, df):
+        """Graph of the mergers in `df`, with `transferor_number` and `transferee_number` labels."""
+        transferors = df['transferor_number'].to_numpy(dtype=object)
+        transferees = df['transferee_number'].to_numpy(dtype=object)
+        keep = is_charity_number(transferors) & is_charity_number(transferees)
+        transferors, transferees = transferors[keep].astype(str), transferees[keep].astype(str)
+        codes, nodes = pd.factorize(np.concatenate([transferors, transferees]), sort=True)
+        return cls(
+            nodes,
+            codes[:len(transferors)],
+            codes[len(transferors):],
+            np.flatnonzero(keep),
+            df['date_transferred'].to_numpy()[keep],
+            party_index(df),
+        )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return (
+            f'{type(self).__name__}({len(self.nodes)} charities, {len(self.source)} mergers, '
+            f'{len(self.cluster_sizes())} clusters)'
+        )
+
+    def code(self, label):
+        """Code of a charity number label; KeyError if it has no merger in the graph."""
+        code = self.index.get_indexer([str(label)])[0]
+        if code < 0:
+            raise KeyError(label)
+        return code
+
+    def _out(self, code):
+        return self.out_edges[self.out_ptr[code]:self.out_ptr[code + 1]]
+
+    def _in(self, code):
+        return self.in_edges[self.in_ptr[code]:self.in_ptr[code + 1]]
+
+    def mergers(self, label, role=None):
+        """Row positions of the mergers of a party label, as `role` ('transferor',
+        'transferee') or as either, whatever the other party; a charity number
+        includes the mergers of its subsidiaries."""
+        if role is not None and role not in ROLES:
+            raise ValueError(f'role must be one of {ROLES}, got {role!r}')
+        code = self.party_labels.get_indexer([str(label)])[0]
+        if code < 0:
+            raise KeyError(label)
+        rows = [
+            self.party_rows[self.party_ptr[key]:self.party_ptr[key + 1]]
+            for key in range(code * len(ROLES), (code + 1) * len(ROLES))
+            if role is None or ROLES[key - code * len(ROLES)] == role
+        ]
+        return np.unique(np.concatenate(rows))
+
+    def transferees(self, label):
+        """Charities that `label` transferred to, in register order (with repeats)."""
+        return self.nodes[self.target[self._out(self.code(label))]]
+
+    def transferors(self, label):
+        """Charities that transferred to `label`, in register order (with repeats)."""
+        return self.nodes[self.source[self._in(self.code(label))]]
+
+    def _reach(self, code, ptr, edges, ends):
+        # breadth-first search; each node and edge is visited once
+        depth = {code: 0}
+        frontier = [code]
+        while frontier:
+            following = []
+            for node in frontier:
+                for end in ends[edges[ptr[node]:ptr[node + 1]]]:
+                    end = int(end)
+                    if end not in depth:
+                        depth[end] = depth[node] + 1
+                        following.append(end)
+            frontier = following
+        del depth[code]
+        return pd.Series(depth, dtype='int64').rename(lambda c: self.nodes[c]).rename('depth')
+
+    def descendants(self, label):
+        """Charities that `label`'s funds were transferred to, directly or through
+        other mergers, with the number of transfers (`depth`) to reach them."""
+        return self._reach(self.code(label), self.out_ptr, self.out_edges, self.target)
+
+    def ancestors(self, label):
+        """Charities transferred to `label`, directly or through other mergers,
+        with the number of transfers (`depth`) between them."""
+        return self._reach(self.code(label), self.in_ptr, self.in_edges, self.source)
+
+    def cluster(self, label):
+        """Charities connected to `label` by mergers in either direction, itself included."""
+        root = self.component[self.code(label)]
+        return self.nodes[self.cluster_nodes[self.cluster_ptr[root]:self.cluster_ptr[root + 1]]]
+
+    def cluster_sizes(self):
+        """Number of charities in each cluster, by the cluster's smallest charity label."""
+        sizes = np.diff(self.cluster_ptr)
+        roots = np.flatnonzero(sizes)
+        return pd.Series(sizes[roots], index=self.nodes[roots], name='charities').sort_values(
+            ascending=False, kind='stable'
+        )
+
+    def chains(self, ordered=True):
+        """Transfers A -> B followed by B -> C, with C different from A.
+
+        With `ordered`, the second transfer must not be earlier than the
+        first one, i.e. B passed on funds after receiving them.
+        """
+        # join each edge A -> B with the edges leaving B
+        counts = np.diff(self.out_ptr)[self.target]
+        first = np.repeat(np.arange(len(self.target)), counts)
+        starts = np.repeat(self.out_ptr[self.target] - np.cumsum(counts) + counts, counts)
+        second = self.out_edges[np.arange(len(first)) + starts]
+        keep = self.source[first] != self.target[second]
+        if ordered:
+            keep &= self.dates[first] <= self.dates[second]
+        first, second = first[keep], second[keep]
+        return pd.DataFrame({
+            'transferor': self.nodes[self.source[first]],
+            'via': self.nodes[self.target[first]],
+            'transferee': self.nodes[self.target[second]],
+            'date_first': self.dates[first],
+            'date_second': self.dates[second],
+            'row_first': self.rows[first],
+            'row_second': self.rows[second],
+        })
+
+    def save(self, path):
+        """Write the graph's arrays to an `.npz` file."""
+        np.savez(
+            path,
+            nodes=self.nodes.astype(str),
+            source=self.source,
+            target=self.target,
+            rows=self.rows,
+            dates=self.dates,
+            party_labels=self.party_labels.to_numpy().astype(str),
+            party_keys=np.repeat(
+                np.arange(len(self.party_ptr) - 1), np.diff(self.party_ptr)
+            ),
+            party_rows=self.party_rows,
+            version=GRAPH_VERSION,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                arrays['nodes'].astype(object),
+                arrays['source'],
+                arrays['target'],
+                arrays['rows'],
+                arrays['dates'],
+                (
+                    arrays['party_labels'].astype(object)[arrays['party_keys'] // len(ROLES)],
+                    arrays['party_keys'] % len(ROLES),
+                    arrays['party_rows'],
+                ),
+            )
+
+
+def merger_graph(data_dir=DATA_DIR):
+    """Graph of the stored cleaned register (see `ccew.releases`), rebuilt when the register changed.
+
+    Row positions refer to `ccew.releases.load_table(data_dir)`.
+    """
+    data_dir = Path(data_dir)
+    table_path, graph_path = data_dir / TABLE_FILE, data_dir / GRAPH_FILE
+    if not table_path.exists():
+        raise FileNotFoundError(f'{table_path} not found: ingest a release with ccew.releases')
+    if graph_path.exists() and graph_path.stat().st_mtime_ns >= table_path.stat().st_mtime_ns:
+        with np.load(graph_path) as arrays:
+            current = 'version' in arrays and int(arrays['version']) == GRAPH_VERSION
+        if current:
+            return MergerGraph.load(graph_path)
+    graph = MergerGraph.from_frame(load_table(data_dir))
+    graph.save(graph_path)
+    return graph
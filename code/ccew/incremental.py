@@ -0,0 +1,291 @@
+"""Incremental ingestion of the nightly extracts.
+
+Each run records a SHA-256 of every archived zip in a state file. Extracts
+whose zip has not changed are skipped outright. For the others, rows are
+hashed (ignoring `date_of_extract`, which changes every night) and combined
+into one hash per `registered_charity_number`, which is compared to the
+hashes stored by the previous run. Only the rows of inserted and updated
+charities are rewritten into the Parquet table; removed charities are
+dropped from it. Rows without a charity number are hashed together under
+`NULL_KEY` and rewritten together when any of them changes. Tables with
+`ccew.data.SORT_KEYS` are sorted again after they are rewritten, so that
+filtered reads keep skipping row groups.
+
+`ingest` calls its `on_change` callbacks with the changes of each extract.
+`python -m ccew.incremental` registers `extend_numbers`, which appends the
+inserted charity numbers to the shared dictionary of `ccew.data`. The
+analysis aggregates are not updated from the changes yet: they are
+rebuilt from the tables.
+"""
+
+import argparse
+import hashlib
+import json
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.data import CharityNumbers, sort_extract
+from ccew.extracts import (
+    ARCHIVE_DIR,
+    DATA_DIR,
+    EXTRACTS,
+    ROW_GROUP_SIZE,
+    convert_extract,
+    extract_path,
+    iter_batches,
+    parquet_path,
+)
+
+KEY = 'registered_charity_number'
+# key of the rows without a charity number: charity numbers are positive
+NULL_KEY = -1
+IGNORED_COLUMNS = ['date_of_extract']
+STATE_FILE = 'ingest_state.json'
+# combination of column hashes into row hashes (FNV-1a constants)
+HASH_SEED = np.uint64(0xCBF29CE484222325)
+HASH_PRIME = np.uint64(0x100000001B3)
+NULL_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+@dataclass
+class ExtractChanges:
+    """Charity numbers inserted, updated and removed in one extract."""
+
+    name: str
+    skipped: bool = False
+    inserted: np.ndarray = field(default_factory=lambda: np.array([], dtype='int64'))
+    updated: np.ndarray = field(default_factory=lambda: np.array([], dtype='int64'))
+    removed: np.ndarray = field(default_factory=lambda: np.array([], dtype='int64'))
+
+    @property
+    def changed(self):
+        return bool(len(self.inserted) or len(self.updated) or len(self.removed))
+
+    def __str__(self):
+        if self.skipped:
+            return f'{self.name}: unchanged'
+        return (
+            f'{self.name}: +{len(self.inserted)} ~{len(self.updated)} '
+            f'-{len(self.removed)} charities'
+        )
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashes_path(name, data_dir=DATA_DIR):
+    """Path of the per-charity hashes of extract `name`."""
+    return Path(data_dir) / f'publicextract.{name}.hashes.parquet'
+
+
+def load_state(data_dir=DATA_DIR):
+    path = Path(data_dir) / STATE_FILE
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_state(state, data_dir=DATA_DIR):
+    path = Path(data_dir) / STATE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+
+def column_hashes(column):
+    """uint64 hash of every value of an Arrow array, `NULL_HASH` where missing.
+
+    Values are hashed in the NumPy dtype of the Arrow type, whatever the
+    other values: converting to pandas would turn an int column with a null
+    into floats, and so change the hashes of its other values.
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    valid = pc.is_valid(column).to_numpy(zero_copy_only=False)
+    if not valid.all():
+        # any value of the column's own type keeps the conversion's dtype
+        filler = column.filter(pa.array(valid))[0] if valid.any() else None
+        if filler is None:
+            return np.full(len(column), NULL_HASH, dtype='uint64')
+        column = pc.fill_null(column, filler)
+    hashes = pd.util.hash_array(column.to_numpy(zero_copy_only=False))
+    return np.where(valid, hashes, NULL_HASH)
+
+
+def row_hashes(batch):
+    """uint64 hash of every row of a record batch, ignoring `IGNORED_COLUMNS`.
+
+    The hash of a row depends on its values only, not on the other rows of
+    its batch, so it does not change when batch boundaries move.
+    """
+    hashes = np.full(batch.num_rows, HASH_SEED, dtype='uint64')
+    for name, column in zip(batch.schema.names, batch.columns):
+        if name not in IGNORED_COLUMNS:
+            hashes = (hashes ^ column_hashes(column)) * HASH_PRIME
+    return hashes
+
+
+def _keys(column):
+    # charity numbers of a column, NULL_KEY where missing
+    return pc.fill_null(column, NULL_KEY)
+
+
+def _sum_by_key(keys, hashes):
+    # order-independent combination of row hashes: sum modulo 2**64; missing keys
+    # get a group of their own rather than the -1 code, which would index the last one
+    codes, uniques = pd.factorize(keys, use_na_sentinel=False)
+    sums = np.zeros(len(uniques), dtype='uint64')
+    np.add.at(sums, codes, hashes)
+    return pd.Series(sums, index=pd.Index(uniques, name=KEY), name='row_hash')
+
+
+def charity_hashes(batches):
+    """Combined row hash per charity number over an iterable of record batches."""
+    keys, hashes = [], []
+    for batch in batches:
+        partial = _sum_by_key(_keys(batch.column(KEY)).to_numpy(), row_hashes(batch))
+        keys.append(partial.index.to_numpy())
+        hashes.append(partial.to_numpy())
+    if not keys:
+        return pd.Series([], index=pd.Index([], name=KEY), name='row_hash', dtype='uint64')
+    return _sum_by_key(np.concatenate(keys), np.concatenate(hashes))
+
+
+def diff_hashes(old, new):
+    """Split charity numbers into inserted, updated and removed."""
+    inserted = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = new.index.intersection(old.index)
+    updated = common[new.loc[common].to_numpy() != old.loc[common].to_numpy()]
+    return inserted.to_numpy(), updated.to_numpy(), removed.to_numpy()
+
+
+def apply_changes(table_path, drop, batches, row_group_size=ROW_GROUP_SIZE):
+    """Rewrite a Parquet table without the charities in `drop`, plus `batches`.
+
+    The existing table is streamed one row group at a time; `batches` are
+    appended at the end, so the table is no longer sorted (see
+    `ccew.data.sort_extract`).
+    """
+    table_path = Path(table_path)
+    tmp_path = table_path.with_suffix('.parquet.tmp')
+    drop = pa.array(np.asarray(drop, dtype='int64'))
+    source = pq.ParquetFile(table_path)
+    with pq.ParquetWriter(tmp_path, source.schema_arrow) as writer:
+        for batch in source.iter_batches(batch_size=row_group_size):
+            keep = pc.invert(pc.is_in(_keys(batch.column(KEY)), value_set=drop))
+            writer.write_batch(batch.filter(keep), row_group_size=row_group_size)
+        for batch in batches:
+            writer.write_batch(batch, row_group_size=row_group_size)
+    tmp_path.replace(table_path)
+
+
+def _write_hashes(hashes, path):
+    pq.write_table(pa.Table.from_pandas(hashes.to_frame(), preserve_index=True), path)
+
+
+def _read_hashes(path):
+    return pq.read_table(path).to_pandas()['row_hash']
+
+
+def ingest_extract(name, state, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR,
+                   row_group_size=ROW_GROUP_SIZE):
+    """Bring the Parquet table of one extract up to date with its archived zip."""
+    zip_path = extract_path(name, archive_dir)
+    table_path = parquet_path(name, data_dir)
+    digest = file_digest(zip_path)
+    previous = state.get(name, {})
+    if (
+        previous.get('sha256') == digest
+        and table_path.exists()
+        and hashes_path(name, data_dir).exists()
+    ):
+        return ExtractChanges(name, skipped=True)
+
+    new = charity_hashes(iter_batches(zip_path, batch_size=row_group_size))
+    if table_path.exists() and hashes_path(name, data_dir).exists():
+        old = _read_hashes(hashes_path(name, data_dir))
+        inserted, updated, removed = diff_hashes(old, new)
+        if len(inserted) or len(updated) or len(removed):
+            wanted = pa.array(np.concatenate([inserted, updated]).astype('int64'))
+            delta = (
+                batch.filter(pc.is_in(_keys(batch.column(KEY)), value_set=wanted))
+                for batch in iter_batches(zip_path, batch_size=row_group_size)
+            )
+            apply_changes(
+                table_path, np.concatenate([updated, removed]), delta, row_group_size
+            )
+            sort_extract(name, data_dir, row_group_size)
+    else:
+        convert_extract(zip_path, table_path, row_group_size)
+        sort_extract(name, data_dir, row_group_size)
+        inserted = new.index.to_numpy()
+        updated = removed = np.array([], dtype='int64')
+
+    _write_hashes(new, hashes_path(name, data_dir))
+    state[name] = {
+        'sha256': digest,
+        'charities': len(new),
+        'ingested_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+    return ExtractChanges(name, False, inserted, updated, removed)
+
+
+def ingest(names=EXTRACTS, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR,
+           row_group_size=ROW_GROUP_SIZE, on_change=()):
+    """Ingest every archived extract in `names`.
+
+    `on_change` callables are called as `callback(changes, table_path)` for
+    each extract that changed, so downstream tables and aggregates can be
+    updated from the changed charity numbers only.
+    """
+    state = load_state(data_dir)
+    results = []
+    for name in names:
+        if not extract_path(name, archive_dir).exists():
+            continue
+        changes = ingest_extract(name, state, archive_dir, data_dir, row_group_size)
+        # save after every extract so an interrupted run keeps its progress
+        save_state(state, data_dir)
+        if changes.changed:
+            for callback in on_change:
+                callback(changes, parquet_path(name, data_dir))
+        results.append(changes)
+    return results
+
+
+def extend_numbers(changes, data_dir=DATA_DIR):
+    """`on_change` callback: add the inserted charity numbers to the shared dictionary."""
+    inserted = changes.inserted[changes.inserted != NULL_KEY]
+    if len(inserted):
+        CharityNumbers.load(data_dir).encode(inserted)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=EXTRACTS, help='extracts to ingest')
+    parser.add_argument('--archive-dir', type=Path, default=ARCHIVE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args(argv)
+
+    on_change = [lambda changes, path: extend_numbers(changes, args.data_dir)]
+    for changes in ingest(args.names, args.archive_dir, args.data_dir, args.row_group_size,
+                          on_change):
+        print(changes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Analysis steps of the register of merged charities.
+
+The notebook and `ccew.pipeline` call these steps instead of computing
+their frames inline. Each step that costs more than its cache lookup is
+`@cached`, so after a kernel restart its result is read back from disk
+unless the data it is given, the files it reads or its code (including the
+modules it calls) changed.
+"""
+
+import numpy as np
+import pandas as pd
+
+from ccew.annual_returns import FinancialPeriodIndex
+from ccew.cache import cached
+from ccew.data import NUMBERS_FILE, load_annual_returns
+from ccew.extracts import DATA_DIR, parquet_path
+from ccew.numbers import charity_number_label, extract_charity_numbers
+from ccew.status import RULES_PATH
+
+MERGERS_CSV = DATA_DIR / 'mergers_register_july_2024.csv'
+MERGERS_COLUMNS = [
+    'transferor',
+    'transferee',
+    'date_vesting',
+    'date_transferred',
+    'date_registered',
+]
+ROLES = ('transferor', 'transferee')
+ANNUAL_RETURN_COLUMNS = [
+    'registered_charity_number',
+    'fin_period_start_date',
+    'fin_period_end_date',
+    'total_gross_income',
+    'total_gross_expenditure',
+]
+
+
+@cached
+def load_mergers(path=MERGERS_CSV, encoding='cp1252'):
+    """Register of merged charities with short column names, stripped names and dates.
+
+    Adds `registered-transfer`, the years between transfer and registration.
+    """
+    df = pd.read_csv(path, encoding=encoding)
+    df.columns = MERGERS_COLUMNS
+    df = df.drop(columns='date_vesting')
+    df['transferor'] = df['transferor'].str.strip()
+    df['transferee'] = df['transferee'].str.strip()
+    date_cols = ['date_transferred', 'date_registered']
+    df[date_cols] = df[date_cols].apply(lambda x: pd.to_datetime(x, format='%d/%m/%Y'))
+    df['registered-transfer'] = (df['date_registered'] - df['date_transferred']).dt.days / 365
+    return df
+
+
+def recent_mergers(df, first_year=2008):
+    """Mergers transferred from `first_year`; earlier transfers are few and unreliable."""
+    return df.loc[df['date_transferred'].dt.year >= first_year]
+
+
+@cached(inputs=[RULES_PATH], modules=['ccew.numbers', 'ccew.status'])
+def charity_numbers(df):
+    """Charity numbers, suffixes and statuses of the transferors and transferees."""
+    return extract_charity_numbers(df, list(ROLES))
+
+
+def label_charity_numbers(df, numbers):
+    """`df` with `transferor_number` and `transferee_number` labels."""
+    return df.assign(**{
+        f'{role}_number': charity_number_label(numbers, role) for role in ROLES
+    })
+
+
+@cached(
+    inputs=[parquet_path('charity_annual_return_history', DATA_DIR), DATA_DIR / NUMBERS_FILE],
+    modules=['ccew.data'],
+)
+def annual_returns(charity_numbers, first_year=2007):
+    """Annual returns of `charity_numbers` for financial periods starting from `first_year`."""
+    return load_annual_returns(
+        columns=ANNUAL_RETURN_COLUMNS,
+        years=(first_year, None),
+        charity_numbers=charity_numbers,
+    )
+
+
+@cached
+def frequent_charities(df, role):
+    """Mergers per charity number for `role`, with its most common name, most mergers first."""
+    return df[
+        [f'{role}_number', role]
+    ].value_counts().to_frame().reset_index().sort_values(
+        [f'{role}_number', 'count'], ascending=False
+    ).groupby(
+        f'{role}_number', as_index=False
+    ).agg(
+        {role: 'first', 'count': 'sum'}
+    ).sort_values('count', ascending=False).reset_index(drop=True)
+
+
+@cached
+def merger_frequencies(df, role):
+    """Number of charities by their number of mergers as `role`."""
+    counts = df[f'{role}_number'].value_counts().value_counts().sort_index()
+    return counts.rename_axis('count_of_mergers').to_frame('frequency')
+
+
+@cached
+def mergers_per_year(df, unique=False):
+    """Mergers per year of transfer; with `unique`, a consolidation counts as one merger."""
+    if unique:
+        df = df.drop_duplicates(subset=['transferee', 'date_transferred'])
+    counts = df.groupby(df['date_transferred'].dt.year, as_index=True)['date_transferred'].count()
+    return counts.to_frame('count').reset_index()
+
+
+@cached(modules=['ccew.annual_returns'])
+def merged_annual_returns(df, df_ar, role, column='total_gross_income'):
+    """Mergers with the `role` charity's `column` in the financial period of the
+    transfer (`<column>_current`) and the next one (`<column>_next`)."""
+    period_index = FinancialPeriodIndex.from_frame(df_ar, value_columns=[column])
+    return df.drop(
+        columns=['date_registered', 'registered-transfer']
+    ).join(
+        period_index.match(
+            df[f'{role}_number'],
+            df['date_transferred'],
+            offsets=[0, 1],
+            columns=[column],
+            names=['current', 'next'],
+        )
+    )
+
+
+@cached
+def merger_effects(df_merged, column='total_gross_income'):
+    """Change of `column` from the financial period of the merger to the next, in %.
+
+    Mergers with neither value are dropped and a missing value counts as 0,
+    so incomes appearing or disappearing give an effect of +/-100.
+    """
+    current, next_ = f'{column}_current', f'{column}_next'
+    df = df_merged.dropna(subset=[current, next_], how='all').copy()
+    df[[current, next_]] = df[[current, next_]].fillna(0)
+    df['effect'] = (df[next_] - df[current]) / df[current] * 100
+    df['effect'] = df['effect'].replace([-np.inf, np.inf], [-100, 100])
+    return df
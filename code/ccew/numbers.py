@@ -0,0 +1,118 @@
+"""Extract charity numbers from the names in the register of merged charities.
+
+Charity numbers are generally given between parentheses at the end of the
+name, e.g. `Crisis UK (1082947)`, sometimes with a subsidiary suffix
+(`1170369-1`, `1053467.01`) and sometimes replaced by a note such as
+`(exempt)` or `(unregistered place of worship)`. When there are no
+parentheses at the end, the first run of 5 to 8 digits in the name is
+used. Runs of more than `MAX_DIGITS` digits are not charity numbers (nor
+int64 values, past 18 digits) and are kept as notes.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from ccew.status import normalise_status
+
+# last group in parentheses at the end of the name, matched on the reversed name
+# so that the pattern is anchored at the start of the string
+REVERSED_PAREN_PATTERN = r'^\)(?P<paren>[^(]+)\('
+# longest charity number: registered numbers have up to 7 digits
+MAX_DIGITS = 8
+# first run of 5 to MAX_DIGITS digits, for names without parentheses at the end
+DIGITS_PATTERN = rf'(?:^|\D)(?P<digits>\d{{5,{MAX_DIGITS}}})(?:\D|$)'
+# main number and optional subsidiary suffix, with any of the separators seen in the data
+PARTS_PATTERN = (
+    rf'^\s*(?P<number>\d{{1,{MAX_DIGITS}}})\s*(?:[-./]\s*(?P<suffix>\d{{1,{MAX_DIGITS}}}))?\s*$'
+)
+
+RESULT_TYPE = pa.struct([
+    ('number', pa.int64()),
+    ('suffix', pa.string()),
+    ('status', pa.string()),
+    ('note', pa.string()),
+])
+
+
+def _to_arrow(values):
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if not isinstance(values, pa.Array):
+        values = pa.array(values, type=pa.string(), from_pandas=True)
+    return values.cast(pa.string())
+
+
+def _empty_to_null(values):
+    return pc.if_else(pc.equal(values, ''), pa.scalar(None, pa.string()), values)
+
+
+def extract_charity_number(values):
+    """Parse charity names into a struct array of number, suffix, status and note.
+
+    `values` can be a pyarrow string array, a pandas Series or a list.
+    `status` is 'registered' when a number was found, otherwise the status
+    of the lower-cased `note` found in the parentheses (see `ccew.status`).
+    """
+    names = pc.utf8_trim_whitespace(_to_arrow(values))
+    paren = pc.struct_field(
+        pc.extract_regex(pc.utf8_reverse(names), REVERSED_PAREN_PATTERN), 'paren'
+    )
+    raw = pc.utf8_lower(pc.utf8_reverse(paren))
+    # fall back to the first run of digits only where there are no parentheses
+    missing = pc.fill_null(pc.and_(pc.is_null(raw), pc.is_valid(names)), False)
+    if pc.any(missing).as_py():
+        digits = pc.struct_field(
+            pc.extract_regex(names.filter(missing), DIGITS_PATTERN), 'digits'
+        )
+        raw = pc.replace_with_mask(raw, missing, digits)
+
+    # plain numbers need no parsing; only the rest goes through the parts pattern
+    plain = pc.fill_null(
+        pc.and_(pc.utf8_is_digit(raw), pc.less_equal(pc.utf8_length(raw), MAX_DIGITS)), False
+    )
+    number = pc.if_else(plain, raw, pa.scalar(None, pa.string()))
+    suffix = pa.nulls(len(raw), pa.string())
+    other = pc.and_(pc.invert(plain), pc.is_valid(raw))
+    if pc.any(other).as_py():
+        parts = pc.extract_regex(raw.filter(other), PARTS_PATTERN)
+        number = pc.replace_with_mask(number, other, pc.struct_field(parts, 'number'))
+        suffix = pc.replace_with_mask(
+            suffix, other, _empty_to_null(pc.struct_field(parts, 'suffix'))
+        )
+    number = pc.cast(number, pa.int64())
+    note = pc.if_else(pc.is_null(number), raw, pa.scalar(None, pa.string()))
+    status = pc.if_else(pc.is_valid(number), 'registered', normalise_status(note))
+    return pa.StructArray.from_arrays(
+        [number, suffix, status, note], fields=list(RESULT_TYPE)
+    )
+
+
+def extract_charity_numbers(df, columns=('transferor', 'transferee')):
+    """Extract charity numbers from several columns of `df` in a single pass.
+
+    Returns a DataFrame aligned on `df.index` with `<column>_number`,
+    `<column>_suffix`, `<column>_status` and `<column>_note` columns.
+    """
+    arrays = [_to_arrow(df[column]) for column in columns]
+    result = extract_charity_number(pa.concat_arrays(arrays))
+    parsed = {}
+    offset = 0
+    for column, array in zip(columns, arrays):
+        part = result.slice(offset, len(array))
+        offset += len(array)
+        for field in RESULT_TYPE:
+            parsed[f'{column}_{field.name}'] = part.field(field.name).to_pandas(
+                types_mapper=pd.ArrowDtype
+            ).set_axis(df.index)
+    return pd.DataFrame(parsed, index=df.index)
+
+
+def charity_number_label(numbers, column):
+    """Single string label per row: `number[-suffix]` for registered charities, else the status."""
+    number = numbers[f'{column}_number'].astype('string')
+    suffix = numbers[f'{column}_suffix'].astype('string')
+    label = number.where(suffix.isna(), number + '-' + suffix)
+    label = label.fillna(numbers[f'{column}_status'].astype('string'))
+    return label.astype(object).where(label.notna(), np.nan)
@@ -0,0 +1,193 @@
+"""The notebook's analysis as a graph of named stages.
+
+Each stage declares the stages whose outputs it takes as inputs, and
+produces one frame named after itself. `run` executes the stages needed
+for some targets, and only those: independent stages (the transferor and
+transferee analyses, the annual return join, the trustee statistics) run
+concurrently in a process pool as soon as their inputs are ready.
+
+The stage functions are the steps of `ccew.mergers`, mostly `@cached`, so
+re-running a target only recomputes the stages whose inputs changed.
+
+    python -m ccew.pipeline merger_counts
+    python -m ccew.pipeline --list
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from ccew import mergers
+from ccew.annual_returns import FinancialPeriodIndex
+from ccew.data import load_trustees
+from ccew.effects import effect_panel
+from ccew.graph import MergerGraph
+from ccew.trustees import link_trustees, repeat_trustees, trustee_counts
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A named step: `func(*outputs of inputs, **params)`."""
+
+    name: str
+    func: object
+    inputs: tuple = ()
+    params: dict = field(default_factory=dict)
+
+
+def _annual_return_numbers(numbers):
+    return mergers.annual_returns(
+        pd.concat([numbers['transferor_number'], numbers['transferee_number']]),
+        first_year=2007,
+    )
+
+
+def _annual_return_incomes(df_ar):
+    return df_ar.drop(columns='total_gross_expenditure')
+
+
+def _effect_panel(df, df_ar):
+    return effect_panel(df, FinancialPeriodIndex.from_frame(df_ar))
+
+
+def _merger_chains(df):
+    return MergerGraph.from_frame(df).chains()
+
+
+def _trustee_summary():
+    return trustee_counts().summary()
+
+
+def _repeat_trustees():
+    df = load_trustees(columns=['trustee_id', 'trustee_name', 'registered_charity_number',
+                                'individual_or_organisation'])
+    return repeat_trustees(df, link_trustees(df))
+
+
+STAGES = {
+    stage.name: stage for stage in [
+        Stage('all_mergers', mergers.load_mergers),
+        Stage('recent_mergers', mergers.recent_mergers, ('all_mergers',), {'first_year': 2008}),
+        Stage('charity_numbers', mergers.charity_numbers, ('recent_mergers',)),
+        Stage('mergers', mergers.label_charity_numbers, ('recent_mergers', 'charity_numbers')),
+        Stage('frequent_transferors', mergers.frequent_charities, ('mergers',), {'role': 'transferor'}),
+        Stage('frequent_transferees', mergers.frequent_charities, ('mergers',), {'role': 'transferee'}),
+        Stage('transferor_frequencies', mergers.merger_frequencies, ('mergers',),
+              {'role': 'transferor'}),
+        Stage('transferee_frequencies', mergers.merger_frequencies, ('mergers',),
+              {'role': 'transferee'}),
+        Stage('merger_counts', mergers.mergers_per_year, ('recent_mergers',)),
+        Stage('merger_counts_unique', mergers.mergers_per_year, ('recent_mergers',), {'unique': True}),
+        Stage('merger_chains', _merger_chains, ('mergers',)),
+        Stage('annual_returns', _annual_return_numbers, ('charity_numbers',)),
+        Stage('incomes', _annual_return_incomes, ('annual_returns',)),
+        Stage('merged_transferees', mergers.merged_annual_returns, ('mergers', 'incomes'),
+              {'role': 'transferee'}),
+        Stage('merged_transferors', mergers.merged_annual_returns, ('mergers', 'incomes'),
+              {'role': 'transferor'}),
+        Stage('effects_transferees', mergers.merger_effects, ('merged_transferees',)),
+        Stage('effects_transferors', mergers.merger_effects, ('merged_transferors',)),
+        Stage('effect_panel', _effect_panel, ('mergers', 'annual_returns')),
+        Stage('trustee_summary', _trustee_summary),
+        Stage('repeat_trustees', _repeat_trustees),
+    ]
+}
+
+
+def upstream(targets, stages=STAGES):
+    """Names of `targets` and every stage they depend on, in dependency order."""
+    order, seen = [], set()
+
+    def visit(name, path=()):
+        if name in path:
+            raise ValueError(f'cycle in stages: {" -> ".join((*path, name))}')
+        if name in seen:
+            return
+        if name not in stages:
+            raise KeyError(f'unknown stage {name!r}')
+        for dependency in stages[name].inputs:
+            visit(dependency, (*path, name))
+        seen.add(name)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def _call(stage, inputs):
+    return stage.func(*inputs, **stage.params)
+
+
+def run(targets, stages=STAGES, processes=None, on_done=None):
+    """Run `targets` and their upstream stages; returns `{name: output}` of every stage run.
+
+    Stages whose inputs are ready run concurrently in up to `processes`
+    worker processes (default: one per CPU), or in this process when there
+    is a single worker. `on_done(name, seconds)` is called as each stage
+    finishes.
+    """
+    names = upstream(targets, stages)
+    processes = min(processes or os.cpu_count() or 1, len(names))
+    outputs = {}
+    if processes <= 1:
+        for name in names:
+            start = time.perf_counter()
+            outputs[name] = _call(stages[name], [outputs[i] for i in stages[name].inputs])
+            if on_done:
+                on_done(name, time.perf_counter() - start)
+        return outputs
+
+    pending = list(names)
+    running = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        while pending or running:
+            for name in [n for n in pending if all(i in outputs for i in stages[n].inputs)]:
+                pending.remove(name)
+                inputs = [outputs[i] for i in stages[name].inputs]
+                running[pool.submit(_call, stages[name], inputs)] = (name, time.perf_counter())
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                outputs[name] = future.result()
+                if on_done:
+                    on_done(name, time.perf_counter() - start)
+    return outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('targets', nargs='*', help='stages to run, with their upstream stages')
+    parser.add_argument('--list', action='store_true', help='list the stages and their inputs')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: CPUs)')
+    parser.add_argument('--out', type=Path, help='write the targets to <out>/<target>.parquet')
+    args = parser.parse_args(argv)
+
+    if args.list or not args.targets:
+        for stage in STAGES.values():
+            print(stage.name, '<-', ', '.join(stage.inputs) or '-')
+        return
+
+    outputs = run(
+        args.targets,
+        processes=args.jobs,
+        on_done=lambda name, seconds: print(f'{name}: {seconds:.2f}s'),
+    )
+    for target in args.targets:
+        output = outputs[target]
+        if args.out:
+            args.out.mkdir(parents=True, exist_ok=True)
+            output.to_parquet(args.out / f'{target}.parquet')
+        else:
+            print(f'\n{target}\n{output}')
+
+
+if __name__ == '__main__':
+    main()
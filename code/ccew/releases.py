@@ -0,0 +1,225 @@
+"""Incremental ingestion of new releases of the register of merged charities.
+
+The register is republished every few months with mostly the same rows. A
+release is compared to the stored cleaned table on a key made of the
+normalised transferor, transferee and transfer date (plus an occurrence
+number, as the register has some exact duplicates):
+
+- rows whose key is new are inserted;
+- rows whose key is gone have been withdrawn;
+- rows whose key is kept but whose content differs have changed: only the
+  letter case or spacing of the names, or the registration date, can
+  differ. A spelling change alters the key, so it shows up as an insert
+  plus a withdrawal, never as a change.
+
+Only inserted and changed rows go through charity number extraction and
+status normalisation. The yearly merger counts are updated from the rows
+that were inserted or withdrawn, instead of being recounted.
+"""
+
+import argparse
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ccew.extracts import DATA_DIR
+from ccew.incremental import file_digest, load_state, save_state
+from ccew.mergers import MERGERS_CSV, ROLES, label_charity_numbers, load_mergers
+from ccew.numbers import extract_charity_numbers
+
+TABLE_FILE = 'mergers.parquet'
+COUNTS_FILE = 'merger_counts.parquet'
+STATE_KEY = 'register_of_merged_charities'
+# columns of the release that make up a row's content
+CONTENT_COLUMNS = ['transferor', 'transferee', 'date_transferred', 'date_registered']
+
+
+@dataclass
+class ReleaseChanges:
+    """Rows inserted, changed and withdrawn by one release, by key."""
+
+    release: str
+    skipped: bool = False
+    inserted: np.ndarray = field(default_factory=lambda: np.array([], dtype='uint64'))
+    changed: np.ndarray = field(default_factory=lambda: np.array([], dtype='uint64'))
+    withdrawn: np.ndarray = field(default_factory=lambda: np.array([], dtype='uint64'))
+
+    def __str__(self):
+        if self.skipped:
+            return f'{self.release}: unchanged'
+        return (
+            f'{self.release}: +{len(self.inserted)} ~{len(self.changed)} '
+            f'-{len(self.withdrawn)} mergers'
+        )
+
+
+def _normalise(names):
+    return names.astype('string').str.casefold().str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def merger_keys(df):
+    """uint64 key of each row: normalised transferor, transferee, transfer date and occurrence."""
+    parts = pd.DataFrame({
+        'transferor': _normalise(df['transferor']),
+        'transferee': _normalise(df['transferee']),
+        'date_transferred': df['date_transferred'],
+    }, index=df.index)
+    # number exact duplicates, so that every row has its own key
+    parts['occurrence'] = parts.groupby(list(parts.columns), dropna=False).cumcount()
+    return pd.util.hash_pandas_object(parts, index=False).to_numpy()
+
+
+def content_hashes(df):
+    """uint64 hash of each row's content."""
+    return pd.util.hash_pandas_object(df[CONTENT_COLUMNS], index=False).to_numpy()
+
+
+def prepare_rows(df):
+    """Charity numbers, labels and statuses of some rows of a release."""
+    numbers = extract_charity_numbers(df, list(ROLES))
+    df = label_charity_numbers(df, numbers)
+    return pd.concat([df, numbers.drop(columns=[f'{role}_number' for role in ROLES])], axis=1)
+
+
+def count_by_year(df):
+    """Mergers per transfer year, also counting a consolidation (same transferee and date) once."""
+    years = df['date_transferred'].dt.year
+    unique = ~df.duplicated(subset=['transferee', 'date_transferred'])
+    return pd.DataFrame({
+        'count': years.value_counts(),
+        'count_unique': years[unique].value_counts(),
+    }).fillna(0).astype('int64').rename_axis('date_transferred').sort_index()
+
+
+def _unique_delta(old, new, touched):
+    # change in the number of distinct (transferee, date) groups per year,
+    # looking only at the groups touched by inserted or withdrawn rows
+    def sizes(df):
+        rows = df.loc[
+            pd.MultiIndex.from_frame(df[['transferee', 'date_transferred']]).isin(touched)
+        ]
+        return rows.groupby(['transferee', 'date_transferred']).size().reindex(touched, fill_value=0)
+
+    before, after = sizes(old), sizes(new)
+    delta = (after.to_numpy() > 0).astype('int64') - (before.to_numpy() > 0)
+    years = touched.get_level_values('date_transferred').year
+    return pd.Series(delta, index=years).groupby(level=0).sum()
+
+
+def update_counts(counts, old, new, inserted, withdrawn, changed=()):
+    """Yearly counts of `new` from those of `old` and the rows inserted and withdrawn.
+
+    `changed` holds the changed rows as they were and as they are: their
+    transferee may be written differently, which moves them between the
+    groups of distinct (transferee, date) counted by `count_unique`.
+    """
+    counts = counts.copy()
+    delta = (
+        inserted['date_transferred'].dt.year.value_counts()
+        .sub(withdrawn['date_transferred'].dt.year.value_counts(), fill_value=0)
+    )
+    touched = pd.MultiIndex.from_frame(
+        pd.concat([inserted, withdrawn, *changed])[['transferee', 'date_transferred']]
+    ).unique()
+    unique_delta = _unique_delta(old, new, touched) if len(touched) else pd.Series(dtype='int64')
+    counts = counts.reindex(counts.index.union(delta.index).union(unique_delta.index), fill_value=0)
+    counts['count'] += delta.reindex(counts.index, fill_value=0).astype('int64')
+    counts['count_unique'] += unique_delta.reindex(counts.index, fill_value=0).astype('int64')
+    counts = counts.loc[(counts['count'] > 0)]
+    return counts.rename_axis('date_transferred')
+
+
+def load_table(data_dir=DATA_DIR):
+    """Stored cleaned register, or None before the first release is ingested."""
+    path = Path(data_dir) / TABLE_FILE
+    return pd.read_parquet(path) if path.exists() else None
+
+
+def load_counts(data_dir=DATA_DIR):
+    """Stored yearly merger counts."""
+    return pd.read_parquet(Path(data_dir) / COUNTS_FILE)
+
+
+def _write(df, path):
+    tmp_path = path.with_suffix('.parquet.tmp')
+    df.to_parquet(tmp_path)
+    tmp_path.replace(path)
+
+
+def ingest_release(path=MERGERS_CSV, data_dir=DATA_DIR, encoding='cp1252'):
+    """Bring the stored register and yearly counts up to date with a release CSV."""
+    path, data_dir = Path(path), Path(data_dir)
+    state = load_state(data_dir)
+    digest = file_digest(path)
+    table_path, counts_path = data_dir / TABLE_FILE, data_dir / COUNTS_FILE
+    previous = state.get(STATE_KEY, {})
+    if previous.get('sha256') == digest and table_path.exists() and counts_path.exists():
+        return ReleaseChanges(path.name, skipped=True)
+
+    release = load_mergers.uncached(path, encoding).reset_index(drop=True)
+    release['key'] = merger_keys(release)
+    release['content_hash'] = content_hashes(release)
+    old = load_table(data_dir)
+
+    if old is None or not counts_path.exists():
+        new = prepare_rows(release)
+        inserted_keys = release['key'].to_numpy()
+        changed_keys = withdrawn_keys = np.array([], dtype='uint64')
+        counts = count_by_year(new)
+    else:
+        old_keys = pd.Index(old['key'])
+        known = old_keys.get_indexer(release['key'])
+        same = np.zeros(len(release), dtype=bool)
+        same[known >= 0] = (
+            old['content_hash'].to_numpy()[known[known >= 0]]
+            == release['content_hash'].to_numpy()[known >= 0]
+        )
+        todo = ~same
+        processed = prepare_rows(release.loc[todo])
+        # unchanged rows keep their processed columns, in the release's order
+        kept = old.iloc[known[same]].set_axis(release.index[same])
+        new = pd.concat([kept, processed]).loc[release.index]
+
+        inserted_keys = release['key'].to_numpy()[known < 0]
+        changed = (known >= 0) & todo
+        changed_keys = release['key'].to_numpy()[changed]
+        withdrawn = ~old_keys.isin(release['key'])
+        withdrawn_keys = old['key'].to_numpy()[withdrawn]
+        counts = update_counts(
+            pd.read_parquet(counts_path),
+            old,
+            new,
+            inserted=new.loc[known < 0],
+            withdrawn=old.loc[withdrawn],
+            changed=(old.iloc[known[changed]], new.loc[changed]),
+        )
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    _write(new.reset_index(drop=True), table_path)
+    _write(counts, counts_path)
+    state[STATE_KEY] = {
+        'release': path.name,
+        'sha256': digest,
+        'mergers': len(new),
+        'ingested_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+    save_state(state, data_dir)
+    return ReleaseChanges(path.name, False, inserted_keys, changed_keys, withdrawn_keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('release', nargs='?', type=Path, default=MERGERS_CSV,
+                        help='CSV of the register of merged charities')
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--encoding', default='cp1252')
+    args = parser.parse_args(argv)
+
+    print(ingest_release(args.release, args.data_dir, args.encoding))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Render the notebook's charts and tables to PNG without a browser.
+
+Charts and tables are collected while the notebook runs and rendered
+together in a process pool at the end:
+
+- Altair charts are compiled to PNG with `vl-convert`, from their Vega-Lite
+  spec (which inlines the chart data);
+- tables are drawn with matplotlib, laid out like the pandas HTML tables
+  that `dataframe_image` used to screenshot.
+
+Each output is keyed by a hash of its spec or data and of the rendering
+options. The hashes of the last render are kept in a manifest next to the
+PNGs, and outputs whose hash has not changed are skipped.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from ccew.extracts import ROOT_DIR
+
+CHARTS_DIR = ROOT_DIR / 'charts'
+MANIFEST = '.render_manifest.json'
+SCALE = 2
+# bump to re-render everything when the rendering code changes
+RENDER_VERSION = 1
+
+
+def _digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+    return digest.hexdigest()
+
+
+def chart_digest(spec, scale=SCALE):
+    """Hash of a Vega-Lite spec and the rendering options."""
+    return _digest(RENDER_VERSION, 'chart', scale, json.dumps(spec, sort_keys=True, default=str))
+
+
+def table_digest(df, scale=SCALE):
+    """Hash of a table's values, labels and the rendering options."""
+    values = pd.util.hash_pandas_object(df.astype(str), index=True).to_numpy().tobytes()
+    labels = json.dumps([list(map(str, df.columns)), list(map(str, df.index.names))])
+    return _digest(RENDER_VERSION, 'table', scale, labels, values)
+
+
+def render_chart(spec, path, scale=SCALE):
+    """Write a Vega-Lite spec to PNG with vl-convert."""
+    import vl_convert
+
+    Path(path).write_bytes(vl_convert.vegalite_to_png(spec, scale=scale))
+
+
+def render_table(df, path, scale=SCALE):
+    """Draw a frame as a PNG table with matplotlib, styled like pandas' HTML tables."""
+    import matplotlib
+
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    index_name = ', '.join(str(name) for name in df.index.names if name is not None)
+    columns = [index_name, *(str(c) for c in df.columns)]
+    cells = [[str(i), *(str(v) for v in row)] for i, row in zip(df.index, df.to_numpy())]
+    # column widths in characters, for the figure size and relative widths
+    widths = [
+        max([len(columns[i]), *(len(row[i]) for row in cells)]) + 2 for i in range(len(columns))
+    ]
+    # cells are padded by a tenth of their width on each side
+    inches_per_char, row_inches = 0.09 / 0.8, 0.3
+    fig, ax = plt.subplots(
+        figsize=(sum(widths) * inches_per_char, (len(cells) + 1) * row_inches), dpi=72 * scale
+    )
+    ax.axis('off')
+    table = ax.table(
+        cellText=cells or None,
+        colLabels=columns,
+        colWidths=[w / sum(widths) for w in widths],
+        cellLoc='right',
+        colLoc='right',
+        loc='center',
+        bbox=[0, 0, 1, 1],
+    )
+    table.auto_set_font_size(False)
+    table.set_fontsize(10)
+    for (row, column), cell in table.get_celld().items():
+        cell.set_linewidth(0)
+        if row == 0:
+            cell.visible_edges = 'B'
+            cell.set_linewidth(1)
+        if row == 0 or column == 0:
+            cell.get_text().set_fontweight('bold')
+        if row % 2 == 1:
+            cell.set_facecolor('#f5f5f5')
+    fig.savefig(path, bbox_inches='tight', pad_inches=0.05, facecolor='white')
+    plt.close(fig)
+
+
+def _run(func, *args):
+    try:
+        func(*args)
+    except Exception as error:
+        return error
+    return None
+
+
+class Renderer:
+    """Collect charts and tables, then render the changed ones in parallel.
+
+    `chart(chart, name)` and `table(df, name)` only record the spec or data
+    to write to `<out_dir>/<name>.png`; `render()` writes them.
+    """
+
+    def __init__(self, out_dir=CHARTS_DIR, scale=SCALE, processes=None):
+        self.out_dir = Path(out_dir)
+        self.scale = scale
+        self.processes = processes
+        self.jobs = {}
+
+    def chart(self, chart, name):
+        """Queue an Altair chart (or a Vega-Lite spec dict)."""
+        spec = chart if isinstance(chart, dict) else chart.to_dict()
+        self.jobs[name] = (render_chart, spec, chart_digest(spec, self.scale))
+        return chart
+
+    def table(self, df, name):
+        """Queue a table."""
+        self.jobs[name] = (render_table, df, table_digest(df, self.scale))
+        return df
+
+    def _manifest_path(self):
+        return self.out_dir / MANIFEST
+
+    def _load_manifest(self):
+        try:
+            return json.loads(self._manifest_path().read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def render(self, force=False):
+        """Render the queued outputs whose hash changed; returns `{name: status}`.
+
+        Status is 'rendered', 'skipped' (unchanged) or the error message.
+        """
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self._load_manifest()
+        status = {}
+        todo = {}
+        for name, (func, payload, digest) in self.jobs.items():
+            path = self.out_dir / f'{name}.png'
+            if not force and manifest.get(name) == digest and path.exists():
+                status[name] = 'skipped'
+            else:
+                todo[name] = (func, payload, path, digest)
+
+        workers = min(len(todo), self.processes or os.cpu_count() or 1)
+        if workers > 1:
+            # vl-convert runs its own threads, which a forked worker would inherit locked
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                futures = {
+                    name: pool.submit(func, payload, path, self.scale)
+                    for name, (func, payload, path, _) in todo.items()
+                }
+                results = {name: future.exception() for name, future in futures.items()}
+        else:
+            # a single worker is not worth starting a process for
+            results = {
+                name: _run(func, payload, path, self.scale)
+                for name, (func, payload, path, _) in todo.items()
+            }
+        for name, error in results.items():
+            if error is None:
+                status[name] = 'rendered'
+                manifest[name] = todo[name][3]
+            else:
+                status[name] = f'{type(error).__name__}: {error}'
+                manifest.pop(name, None)
+
+        self._manifest_path().write_text(json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+        self.jobs = {}
+        return status
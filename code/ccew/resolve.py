@@ -0,0 +1,211 @@
+"""Resolve the charity names of the merger register to registered charity numbers.
+
+Every transferor and transferee name is matched against the register's
+names and their other names (`ccew.search`), in batches rather than one
+query at a time:
+
+- candidate (name, registered name) pairs come from the name index's
+  blocks: the registered names listed under the rarest trigrams of each
+  name, plus the names of the charity whose number the row gives;
+- all pairs of a batch are scored at once with NumPy, by the Jaccard
+  similarity of their trigrams.
+
+A row keeps the number it gives when that number is in the register, with
+the similarity of its name to the charity's closest name as confidence (a
+low one flags a mistyped number). Otherwise the best matching charity above
+`min_score` is used.
+
+    python -m ccew.resolve                # resolve the stored register, in place
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ccew.extracts import DATA_DIR
+from ccew.graph import is_charity_number
+from ccew.mergers import ROLES
+from ccew.releases import TABLE_FILE, load_table
+from ccew.search import (
+    INDEX_SCORE, name_index, normalise_labels, normalise_names, prefix_length, trigrams,
+)
+
+MIN_SCORE = 0.8
+BATCH_SIZE = 2_000
+# the trailing note in parentheses is not part of the name (`(1082947)`, `(exempt)`)
+NOTE_PATTERN = r'\s*\([^()]*\)\s*$'
+
+
+def _ranges(starts, lengths):
+    # concatenated ranges [start, start + length), and the range of each position
+    owners = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - offsets[owners] + starts[owners], owners, offsets
+
+
+def _distinct_pairs(queries, names, size):
+    keys = np.unique(queries.astype('int64') * size + names)
+    return keys // size, keys % size
+
+
+class QueryGrams:
+    """Trigram ranks of a set of normalised names, for scoring them against the index.
+
+    Each name's trigrams are sorted from the rarest, those missing from the
+    index (rank -1) first.
+    """
+
+    def __init__(self, index, normalised):
+        owners, codes = trigrams(normalised)
+        self.sizes = np.bincount(owners, minlength=len(normalised))
+        found = np.minimum(np.searchsorted(index.codes, codes), len(index.codes) - 1)
+        known = index.codes[found] == codes
+        ranks = np.where(known, index.ranks[found], -1)
+        order = np.lexsort((ranks, owners))
+        self.owners, self.ranks, self.known = owners[order], ranks[order], known[order]
+        self.ptr = np.zeros(len(normalised) + 1, dtype='int64')
+        np.cumsum(self.sizes, out=self.ptr[1:])
+        # (name, rank) keys of the known trigrams, sorted, for membership tests
+        known_owners = self.owners[self.known].astype('int64')
+        self.keys = known_owners * len(index.codes) + self.ranks[self.known]
+
+    def candidates(self, index, queries, min_score=MIN_SCORE):
+        """(query, name id) pairs that may have a similarity of `min_score`:
+        names indexed under a prefix trigram of the query, of a similar size."""
+        rows, _, _ = _ranges(self.ptr[queries], self.sizes[queries])
+        owners, ranks = self.owners[rows], self.ranks[rows]
+        position = rows - self.ptr[owners]
+        prefix = self.known[rows] & (position < prefix_length(self.sizes[owners], min_score))
+        starts = index.prefix_ptr[ranks[prefix]]
+        rows, block, _ = _ranges(starts, index.prefix_ptr[ranks[prefix] + 1] - starts)
+        queries, names = owners[prefix][block], index.prefix_names[rows].astype('int64')
+        sizes, name_sizes = self.sizes[queries], index.sizes[names]
+        keep = (name_sizes >= min_score * sizes) & (name_sizes * min_score <= sizes)
+        return _distinct_pairs(queries[keep], names[keep], len(index))
+
+    def scores(self, index, queries, names):
+        """Similarity of each (query, name id) pair."""
+        rows, pair, _ = _ranges(index.ptr[names], index.sizes[names])
+        keys = queries[pair] * len(index.codes) + index.grams[rows]
+        if len(self.keys):
+            position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            hits = self.keys[position] == keys
+        else:
+            hits = np.zeros(len(keys), dtype=bool)
+        common = np.bincount(pair[hits], minlength=len(names))
+        return common / np.maximum(self.sizes[queries] + index.sizes[names] - common, 1)
+
+
+def _best(queries, names, scores, size):
+    # best scoring name of each query, or -1 and NaN
+    best_names = np.full(size, -1, dtype='int64')
+    best_scores = np.full(size, np.nan)
+    order = np.lexsort((-scores, queries))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = queries[order[1:]] != queries[order[:-1]]
+    best_names[queries[order[first]]] = names[order[first]]
+    best_scores[queries[order[first]]] = scores[order[first]]
+    return best_names, best_scores
+
+
+def resolve_queries(index, names, numbers, min_score=MIN_SCORE, batch_size=BATCH_SIZE):
+    """Resolved charity of each (name, number label) query, as a frame aligned on them."""
+    if min_score < INDEX_SCORE:
+        raise ValueError(f'the index only finds names with a score of at least {INDEX_SCORE}')
+    # queries repeat names (`Charity 12 (exempt)`, a charity's many mergers): score each once
+    name_codes, distinct = pd.factorize(normalise_names(names))
+    grams = QueryGrams(index, distinct.to_numpy(dtype=object))
+
+    # best name match of each distinct name, in batches of candidates
+    name_ids = np.full(len(distinct), -1, dtype='int64')
+    name_scores = np.full(len(distinct), np.nan)
+    for start in range(0, len(distinct), batch_size):
+        batch = np.arange(start, min(start + batch_size, len(distinct)))
+        queries, ids = grams.candidates(index, batch, min_score)
+        scores = grams.scores(index, queries, ids)
+        best_ids, best_scores = _best(queries, ids, scores, len(distinct))
+        found = best_ids >= 0
+        name_ids[found], name_scores[found] = best_ids[found], best_scores[found]
+
+    # closest name of the charity whose number is given
+    charities = pd.Index(index.charity_labels).get_indexer(normalise_labels(numbers))
+    given = np.flatnonzero(charities >= 0)
+    size = len(index.charity_labels)
+    pairs, pair_queries = np.unique(
+        name_codes[given].astype('int64') * size + charities[given], return_inverse=True
+    )
+    starts = index.charity_ptr[pairs % size]
+    rows, pair, _ = _ranges(starts, index.charity_ptr[pairs % size + 1] - starts)
+    ids = index.charity_name_ids[rows]
+    scores = grams.scores(index, pairs[pair] // size, ids)
+    number_ids, number_scores = _best(pair, ids, scores, len(pairs))
+
+    by_number = charities >= 0
+    by_name = ~by_number & (name_scores[name_codes] >= min_score)
+    resolved = np.where(by_name, name_ids[name_codes], -1)
+    resolved[given] = number_ids[pair_queries]
+    confidence = np.where(by_name, name_scores[name_codes], np.nan)
+    confidence[given] = number_scores[pair_queries]
+    matched = resolved >= 0
+    return pd.DataFrame({
+        'resolved': np.where(matched, index.labels[resolved], None),
+        'resolved_name': np.where(matched, index.charity_names[resolved], None),
+        'confidence': confidence,
+        'resolution': np.where(by_number, 'number', np.where(by_name, 'name', None)),
+    })
+
+
+def resolve_charities(df, index, roles=ROLES, min_score=MIN_SCORE, batch_size=BATCH_SIZE):
+    """Registered charity of each transferor and transferee of the merger register.
+
+    `df` has the `<role>` names and `<role>_number` labels. Returns, aligned
+    on `df`, `<role>_resolved` (charity number label), `<role>_resolved_name`
+    (the registered name it matched), `<role>_confidence` (similarity of the
+    names, 0 to 1) and `<role>_resolution` ('number', 'name' or missing).
+    """
+    columns = {}
+    for role in roles:
+        labels = df[f'{role}_number'].to_numpy(dtype=object)
+        queries = pd.DataFrame({
+            'name': df[role].astype('string').str.replace(NOTE_PATTERN, '', regex=True),
+            'number': np.where(is_charity_number(labels), labels, None),
+        })
+        # each distinct (name, number) once, in order of appearance
+        codes = queries.groupby(['name', 'number'], dropna=False, sort=False).ngroup().to_numpy()
+        distinct = queries.drop_duplicates()
+        result = resolve_queries(index, distinct['name'], distinct['number'], min_score, batch_size)
+        for column in result.columns:
+            columns[f'{role}_{column}'] = result[column].to_numpy()[codes]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--min-score', type=float, default=MIN_SCORE)
+    parser.add_argument('--out', type=Path,
+                        help='write here instead of updating the stored register')
+    args = parser.parse_args(argv)
+
+    df = load_table(args.data_dir)
+    if df is None:
+        parser.exit(1, 'no stored register: run python -m ccew.releases first\n')
+    index = name_index(args.data_dir)
+    start = time.perf_counter()
+    resolved = resolve_charities(df, index, min_score=args.min_score)
+    print(f'resolved {len(df)} mergers in {time.perf_counter() - start:.2f}s')
+    for role in ROLES:
+        print(resolved[f'{role}_resolution'].value_counts(dropna=False).to_string(), '\n')
+
+    df = df.drop(columns=resolved.columns, errors='ignore').join(resolved)
+    out = args.out or Path(args.data_dir) / TABLE_FILE
+    tmp_path = out.with_suffix('.parquet.tmp')
+    df.to_parquet(tmp_path)
+    tmp_path.replace(out)
+
+
+if __name__ == '__main__':
+    main()
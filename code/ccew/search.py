@@ -0,0 +1,365 @@
+"""Fuzzy search of charity names: the register's names and their other names.
+
+Names are normalised (case, punctuation, `&`, a leading `THE`, charity
+numbers) and cut into character trigrams; names are scored by the Jaccard
+similarity of their sets of trigrams.
+
+Two sets with a similarity of at least `t` always share one of their
+rarest trigrams, the first `n - ceil(t * n) + 1` of a set of `n` in a
+global order from the rarest (prefix filtering). The inverted index only
+lists each name under these prefix trigrams, so a query never reads the
+long postings of common trigrams (`CHA`, `RUS`...), and the few candidates
+are scored on a forward index of their trigrams. All of it is compressed
+sparse rows of NumPy arrays.
+
+A best-match lookup over the full register takes about 0.5ms at the
+default `MIN_SCORE` of 0.8; lower thresholds read longer prefixes, and
+take about 1.3ms at 0.7.
+
+Charities are labelled `number[-linked]` like the merger register, with
+the linked charity number on two digits (`1053467-01`);
+`normalise_labels` writes register labels the same way (`1053467-1`,
+`1053467-001`).
+
+    index = name_index()
+    index.search('Victim Support')
+"""
+
+import argparse
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ccew.extracts import DATA_DIR, parquet_path
+
+INDEX_FILE = 'name_index.npz'
+NAMES_FILE = 'name_index.parquet'
+# name sources: extract and name type column (None for the register's own name)
+SOURCES = {
+    'charity': None,
+    'charity_other_names': 'charity_name_type',
+}
+# abbreviations spelled out, after `&` is replaced by AND
+SYNONYMS = {
+    'ST': 'SAINT',
+    'LTD': 'LIMITED',
+    'ASSOC': 'ASSOCIATION',
+    'CTTEE': 'COMMITTEE',
+}
+# bump to rebuild saved indexes when the normalisation or the index layout change
+INDEX_VERSION = 1
+# lowest similarity the index can answer queries for, and the default one
+INDEX_SCORE = 0.6
+MIN_SCORE = 0.8
+LIMIT = 10
+# digits of the linked charity number in labels, as in the register (`1053467-01`)
+LINKED_DIGITS = 2
+LABEL_PATTERN = r'^(?P<number>\d+)-0*(?P<linked>\d+)$'
+# bits per character in a trigram code: enough for any code point
+CHAR_BITS = 21
+# substitutions applied in order to upper-cased names
+REPLACEMENTS = [
+    (r'&', ' AND '),
+    # charity numbers, with or without parentheses
+    (r'\([^()]*\d[^()]*\)|\d{5,}', ' '),
+    # apostrophes, also as misdecoded in the extracts (`ALZHEIMERÆS`)
+    (r"['’Æ]", ''),
+    (r'[^0-9A-Z]+', ' '),
+    (rf'\b({"|".join(SYNONYMS)})\b', lambda match: SYNONYMS[match.group(1)]),
+    (r'^\s*THE\b', ''),
+    (r'\s+', ' '),
+]
+_REPLACEMENTS = [(re.compile(pattern), replacement) for pattern, replacement in REPLACEMENTS]
+
+
+def normalise_names(names):
+    """Upper-case names without punctuation, charity numbers or a leading THE."""
+    names = pd.Series(names, dtype='string').str.upper()
+    for pattern, replacement in REPLACEMENTS:
+        names = names.str.replace(pattern, replacement, regex=True)
+    return names.str.strip().fillna('')
+
+
+def normalise_name(name):
+    """`normalise_names` of a single name, without the overhead of a Series."""
+    name = name.upper()
+    for pattern, replacement in _REPLACEMENTS:
+        name = pattern.sub(replacement, name)
+    return name.strip()
+
+
+def trigrams(normalised):
+    """Distinct trigram codes of normalised names, as (name id, code) arrays sorted by code.
+
+    Each name is padded with a space on both sides, so that the first and
+    last letters of a name count as much as the others.
+    """
+    padded = (' ' + pd.Series(normalised, dtype=object).fillna('') + ' ').tolist()
+    lengths = np.fromiter(map(len, padded), dtype='int64', count=len(padded))
+    chars = np.frombuffer(''.join(padded).encode('utf-32-le'), dtype='<u4').astype('int64')
+    ends = np.cumsum(lengths)
+    owner = np.repeat(np.arange(len(padded)), lengths)
+    starts = np.arange(len(chars) - 2) if len(chars) > 2 else np.array([], dtype='int64')
+    starts = starts[starts + 3 <= ends[owner[starts]]]
+    codes = (
+        (chars[starts] << (2 * CHAR_BITS)) | (chars[starts + 1] << CHAR_BITS) | chars[starts + 2]
+    )
+    names = owner[starts]
+    order = np.lexsort((names, codes))
+    names, codes = names[order], codes[order]
+    distinct = np.ones(len(codes), dtype=bool)
+    distinct[1:] = (codes[1:] != codes[:-1]) | (names[1:] != names[:-1])
+    return names[distinct], codes[distinct]
+
+
+def name_trigrams(normalised):
+    """Sorted distinct trigram codes of one normalised name, as `trigrams` computes them."""
+    padded = f' {normalised} '
+    codes = {
+        (ord(a) << (2 * CHAR_BITS)) | (ord(b) << CHAR_BITS) | ord(c)
+        for a, b, c in zip(padded, padded[1:], padded[2:])
+    }
+    return np.sort(np.fromiter(codes, dtype='int64', count=len(codes)))
+
+
+def load_names(data_dir=DATA_DIR):
+    """Names of the register and their other names, with charity numbers and name types."""
+    frames = []
+    for extract, type_column in SOURCES.items():
+        columns = ['registered_charity_number', 'linked_charity_number', 'charity_name']
+        df = pq.read_table(
+            parquet_path(extract, data_dir), columns=columns + ([type_column] if type_column else [])
+        ).to_pandas()
+        df['name_type'] = df.pop(type_column) if type_column else 'Register name'
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    df = df.dropna(subset=['registered_charity_number', 'charity_name'])
+    df['linked_charity_number'] = df['linked_charity_number'].fillna(0).astype('int64')
+    return df.drop_duplicates(
+        subset=['registered_charity_number', 'linked_charity_number', 'charity_name']
+    ).reset_index(drop=True)
+
+
+def charity_labels(numbers, linked):
+    """`number[-linked]` labels, as in the merger register's `*_number` columns."""
+    numbers = pd.Series(numbers).astype('int64').astype(str)
+    linked = pd.Series(linked).astype('int64')
+    return numbers.where(
+        linked == 0, numbers + '-' + linked.astype(str).str.zfill(LINKED_DIGITS)
+    ).to_numpy(dtype=object)
+
+
+def normalise_labels(labels):
+    """Charity number labels with the linked number on `LINKED_DIGITS` digits, as
+    `charity_labels` writes them; other labels are left as they are."""
+    labels = pd.Series(labels, dtype=object)
+    parts = labels.astype('string').str.extract(LABEL_PATTERN)
+    linked = parts['number'] + '-' + parts['linked'].str.zfill(LINKED_DIGITS)
+    return labels.where(linked.isna(), linked.astype(object)).to_numpy(dtype=object)
+
+
+def _distinct(values):
+    # sorted distinct values; faster than np.unique on small arrays
+    values = np.sort(values)
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = values[1:] != values[:-1]
+    return values[keep]
+
+
+def _csr(keys, size):
+    # offsets and positions of an index of positions by key
+    ptr = np.zeros(size + 1, dtype='int64')
+    np.cumsum(np.bincount(keys, minlength=size), out=ptr[1:])
+    return ptr, np.argsort(keys, kind='stable')
+
+
+def prefix_length(sizes, min_score):
+    """Number of rarest trigrams of a set that any set with a similarity of
+    at least `min_score` to it shares at least one of."""
+    return sizes - np.ceil(min_score * sizes - 1e-9).astype('int64') + 1
+
+
+class NameIndex:
+    """Prefix-filtered trigram index of charity names.
+
+    `names` has one row per name, with `registered_charity_number`,
+    `linked_charity_number`, `charity_name` and `name_type`.
+
+    Trigrams are ranked from the rarest to the most common. Each name is
+    indexed under its rarest trigrams only (its prefix): two sets of
+    trigrams with a similarity of at least `INDEX_SCORE` share one of their
+    prefix trigrams, so the postings of common trigrams are never read.
+    Candidates are then scored on their full, rank-sorted trigrams.
+    """
+
+    def __init__(self, names, codes, ranks, ptr, grams, prefix_ptr, prefix_names):
+        self.names = names
+        # trigram codes, sorted, and their rank from the rarest
+        self.codes = codes
+        self.ranks = ranks
+        # forward index: trigram ranks of each name, sorted
+        self.ptr = ptr
+        self.grams = grams
+        self.sizes = np.diff(ptr)
+        # names by the trigram ranks of their prefixes
+        self.prefix_ptr = prefix_ptr
+        self.prefix_names = prefix_names
+        self.labels = charity_labels(
+            names['registered_charity_number'], names['linked_charity_number']
+        )
+        # one code per charity, and the names of each charity
+        self.charities, self.charity_labels = pd.factorize(self.labels)
+        self.charity_ptr, self.charity_name_ids = _csr(self.charities, len(self.charity_labels))
+        self.charity_names = names['charity_name'].to_numpy(dtype=object)
+        self.name_types = names['name_type'].to_numpy(dtype=object)
+
+    @classmethod
+    def from_names(cls, names):
+        names = names.reset_index(drop=True)
+        owners, grams = trigrams(normalise_names(names['charity_name']))
+        codes, inverse, counts = np.unique(grams, return_inverse=True, return_counts=True)
+        ranks = np.empty(len(codes), dtype='int32')
+        ranks[np.lexsort((codes, counts))] = np.arange(len(codes), dtype='int32')
+        grams = ranks[inverse]
+
+        order = np.lexsort((grams, owners))
+        owners, grams = owners[order], grams[order]
+        sizes = np.bincount(owners, minlength=len(names))
+        ptr = np.zeros(len(names) + 1, dtype='int64')
+        np.cumsum(sizes, out=ptr[1:])
+
+        position = np.arange(len(grams)) - ptr[owners]
+        in_prefix = position < prefix_length(sizes, INDEX_SCORE)[owners]
+        prefix_grams, prefix_names = grams[in_prefix], owners[in_prefix]
+        order = np.lexsort((prefix_names, prefix_grams))
+        prefix_ptr = np.zeros(len(codes) + 1, dtype='int64')
+        np.cumsum(np.bincount(prefix_grams, minlength=len(codes)), out=prefix_ptr[1:])
+        return cls(
+            names, codes, ranks, ptr, grams, prefix_ptr, prefix_names[order].astype('int32')
+        )
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR):
+        return cls.from_names(load_names(data_dir))
+
+    def save(self, data_dir=DATA_DIR):
+        data_dir = Path(data_dir)
+        np.savez(
+            data_dir / INDEX_FILE,
+            codes=self.codes, ranks=self.ranks, ptr=self.ptr, grams=self.grams,
+            prefix_ptr=self.prefix_ptr, prefix_names=self.prefix_names, version=INDEX_VERSION,
+        )
+        self.names.to_parquet(data_dir / NAMES_FILE)
+
+    @classmethod
+    def load(cls, data_dir=DATA_DIR):
+        data_dir = Path(data_dir)
+        with np.load(data_dir / INDEX_FILE) as arrays:
+            return cls(
+                pd.read_parquet(data_dir / NAMES_FILE),
+                *(arrays[key] for key in (
+                    'codes', 'ranks', 'ptr', 'grams', 'prefix_ptr', 'prefix_names'
+                )),
+            )
+
+    def __len__(self):
+        return len(self.names)
+
+    def scores(self, name, min_score=MIN_SCORE):
+        """Ids of the names whose similarity to `name` is at least `min_score`, and their scores."""
+        if min_score < INDEX_SCORE:
+            raise ValueError(f'the index only finds names with a score of at least {INDEX_SCORE}')
+        empty = np.array([], dtype='int64'), np.array([])
+        codes = name_trigrams(normalise_name(name))
+        size = len(codes)
+        if not size:
+            return empty
+        found = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        grams = np.sort(self.ranks[found[self.codes[found] == codes]])
+        # trigrams missing from the index are the rarest of all, and match nothing
+        prefix = int(prefix_length(size, min_score)) - (size - len(grams))
+        if prefix <= 0:
+            return empty
+        candidates = _distinct(np.concatenate([
+            self.prefix_names[self.prefix_ptr[gram]:self.prefix_ptr[gram + 1]]
+            for gram in grams[:prefix]
+        ]))
+        # similar names have a similar number of trigrams
+        sizes = self.sizes[candidates]
+        keep = (sizes >= min_score * size) & (sizes * min_score <= size)
+        candidates, sizes = candidates[keep], sizes[keep]
+        if not len(candidates):
+            return empty
+        # count the query's trigrams among the trigrams of each candidate
+        offsets = np.cumsum(sizes) - sizes
+        rows = np.repeat(self.ptr[candidates] - offsets, sizes) + np.arange(sizes.sum())
+        in_query = np.zeros(len(self.codes), dtype='int64')
+        in_query[grams] = 1
+        common = np.add.reduceat(in_query[self.grams[rows]], offsets)
+        scores = common / (size + sizes - common)
+        keep = scores >= min_score
+        return candidates[keep].astype('int64'), scores[keep]
+
+    def best(self, name, min_score=MIN_SCORE):
+        """(charity number label, name, score) of the best match for a name, or None."""
+        ids, scores = self.scores(name, min_score)
+        if not len(ids):
+            return None
+        i = np.argmax(scores)
+        return self.labels[ids[i]], self.charity_names[ids[i]], scores[i]
+
+    def search(self, name, limit=LIMIT, min_score=MIN_SCORE):
+        """Best matching charities for a name, one row per charity, best first."""
+        ids, scores = self.scores(name, min_score)
+        order = np.argsort(-scores, kind='stable')
+        ids, scores = ids[order], scores[order]
+        # the best name of each charity
+        charities = self.charities[ids]
+        order = np.argsort(charities, kind='stable')
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = charities[order[1:]] != charities[order[:-1]]
+        first = np.sort(order[first])[:limit]
+        ids, scores = ids[first], scores[first]
+        return pd.DataFrame({
+            'charity_number': self.labels[ids],
+            'charity_name': self.charity_names[ids],
+            'name_type': self.name_types[ids],
+            'score': scores,
+        })
+
+
+def name_index(data_dir=DATA_DIR):
+    """The name index of the converted extracts, rebuilt when they changed."""
+    data_dir = Path(data_dir)
+    index_path = data_dir / INDEX_FILE
+    sources = [parquet_path(extract, data_dir) for extract in SOURCES]
+    if index_path.exists() and all(
+        index_path.stat().st_mtime_ns >= source.stat().st_mtime_ns for source in sources
+    ):
+        with np.load(index_path) as arrays:
+            current = 'version' in arrays and int(arrays['version']) == INDEX_VERSION
+        if current:
+            return NameIndex.load(data_dir)
+    index = NameIndex.build(data_dir)
+    index.save(data_dir)
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='+', help='names to look up')
+    parser.add_argument('--limit', type=int, default=LIMIT)
+    parser.add_argument('--min-score', type=float, default=MIN_SCORE)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    index = name_index(args.data_dir)
+    for name in args.names:
+        print(f'{name}\n{index.search(name, args.limit, args.min_score).to_string()}\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Local query service over the cleaned register, with its tables kept warm.
+
+The annual return and trustee tables of the warehouse (`ccew.warehouse`,
+built first if needed) are memory-mapped at start-up: they are sorted by
+charity number, so a charity's rows are a binary search and a zero-copy
+slice away. The merger register (the table stored by `ccew.releases`, or the July
+2024 CSV if no release was ingested) is indexed by `ccew.graph`, and the
+yearly counts and top charities are computed once. A table that is not
+available is left out: its endpoints answer without it, and `/health`
+lists it under `missing`.
+
+    python -m ccew.serve --port 8765        # HTTP, e.g. curl localhost:8765/charity/275946
+    python -m ccew.serve /charity/275946    # one query, without a server
+
+Endpoints (JSON):
+
+- `/health`: row counts of the tables;
+- `/charity/<number>`: annual returns, trustees and mergers of a charity;
+- `/mergers/years?unique=1&from=2008&to=2024`: mergers per year of transfer;
+- `/top/transferees?n=10`, `/top/transferors?n=10`: most frequent
+  registered transferees or transferors.
+"""
+
+import argparse
+import json
+import math
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from ccew.extracts import DATA_DIR
+from ccew.graph import MergerGraph, is_charity_number
+from ccew.mergers import MERGERS_CSV, frequent_charities, load_mergers, mergers_per_year
+from ccew.releases import load_table, prepare_rows
+from ccew.warehouse import charity_slice, warehouse_table
+
+PORT = 8765
+# warehouse table and columns of each served table
+TABLES = {
+    'annual_returns': ('charity_annual_return_history', [
+        'registered_charity_number',
+        'fin_period_start_date',
+        'fin_period_end_date',
+        'total_gross_income',
+        'total_gross_expenditure',
+    ]),
+    'trustees': ('charity_trustee', [
+        'registered_charity_number',
+        'trustee_id',
+        'trustee_name',
+        'trustee_is_chair',
+        'individual_or_organisation',
+        'trustee_date_of_appointment',
+    ]),
+}
+MERGER_COLUMNS = [
+    'transferor', 'transferor_number', 'transferee', 'transferee_number',
+    'date_transferred', 'date_registered',
+]
+TOP_N = 10
+
+
+class QueryError(Exception):
+    """A query that cannot be answered, with its HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _records(df):
+    # JSON-ready rows: dates as ISO strings, missing values as null
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+def _json_default(value):
+    # dates and timestamps of Arrow rows
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _finite(value):
+    # NaN and infinite floats (of Arrow rows) as None, which JSON has no literal for
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_finite(item) for item in value]
+    return value
+
+
+def dumps(body, **kwargs):
+    """Strict JSON of a response body, with missing numbers as null."""
+    return json.dumps(_finite(body), allow_nan=False, default=_json_default, **kwargs)
+
+
+def _int_param(params, name, default=None):
+    try:
+        return int(params[name][0]) if name in params else default
+    except ValueError:
+        raise QueryError(HTTPStatus.BAD_REQUEST, f'{name} must be an integer') from None
+
+
+class QueryService:
+    """The cleaned tables, loaded once; `query(path)` answers an endpoint."""
+
+    def __init__(self, data_dir=DATA_DIR, mergers_csv=MERGERS_CSV):
+        start = time.perf_counter()
+        # reason each unavailable table is left out
+        self.missing = {}
+        self.tables = {}
+        for name, (extract, columns) in TABLES.items():
+            try:
+                self.tables[name] = warehouse_table(extract, columns, data_dir=data_dir)
+            except FileNotFoundError as error:
+                self.missing[name] = str(error)
+
+        mergers = load_table(data_dir)
+        if mergers is None and Path(mergers_csv).exists():
+            mergers = prepare_rows(load_mergers(mergers_csv))
+        if mergers is None:
+            self.missing['mergers'] = f'no release ingested and no {mergers_csv}'
+            mergers = pd.DataFrame(columns=MERGER_COLUMNS, dtype='string').astype(
+                {'date_transferred': 'datetime64[us]', 'date_registered': 'datetime64[us]'}
+            )
+        self.mergers = mergers[MERGER_COLUMNS].reset_index(drop=True)
+        self.graph = MergerGraph.from_frame(self.mergers)
+        self.counts = {
+            unique: mergers_per_year.uncached(self.mergers, unique).set_index('date_transferred')['count']
+            for unique in (False, True)
+        }
+        self.top = {
+            role: frequent_charities.uncached(
+                self.mergers.loc[is_charity_number(self.mergers[f'{role}_number'])], role
+            )
+            for role in ('transferor', 'transferee')
+        }
+        self.load_seconds = time.perf_counter() - start
+
+    def rows(self, name, number):
+        """Rows of a served table for one charity number."""
+        return charity_slice(self.tables[name], number)
+
+    def charity(self, number, params):
+        try:
+            number = int(number)
+        except ValueError:
+            raise QueryError(HTTPStatus.BAD_REQUEST, f'not a charity number: {number!r}') from None
+        result = {'registered_charity_number': number}
+        for name in TABLES:
+            # None rather than no rows when the table is missing
+            result[name] = self.rows(name, number).to_pylist() if name in self.tables else None
+        for role in ('transferor', 'transferee'):
+            try:
+                rows = self.graph.mergers(number, role)
+            except KeyError:
+                rows = []
+            result[f'mergers_as_{role}'] = _records(self.mergers.iloc[rows])
+        return result
+
+    def merger_years(self, params):
+        counts = self.counts[bool(_int_param(params, 'unique', 0))]
+        first, last = _int_param(params, 'from'), _int_param(params, 'to')
+        counts = counts.loc[first:last]
+        return {str(year): int(count) for year, count in counts.items()}
+
+    def top_charities(self, role, params):
+        n = _int_param(params, 'n', TOP_N)
+        return _records(self.top[role].head(n))
+
+    def health(self, params):
+        return {
+            'load_seconds': round(self.load_seconds, 3),
+            'rows': {
+                'mergers': len(self.mergers),
+                **{name: table.num_rows for name, table in self.tables.items()},
+            },
+            'missing': self.missing,
+        }
+
+    def query(self, url):
+        """Answer a query URL (path and query string); raises QueryError."""
+        parts = urlsplit(url)
+        path = [part for part in parts.path.split('/') if part]
+        params = parse_qs(parts.query)
+        if path == ['health']:
+            return self.health(params)
+        if len(path) == 2 and path[0] == 'charity':
+            return self.charity(path[1], params)
+        if path == ['mergers', 'years']:
+            return self.merger_years(params)
+        if len(path) == 2 and path[0] == 'top' and path[1] in ('transferees', 'transferors'):
+            return self.top_charities(path[1][:-1], params)
+        raise QueryError(HTTPStatus.NOT_FOUND, f'no endpoint {parts.path!r}')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """JSON responses from the server's `service`."""
+
+    def do_GET(self):
+        try:
+            status, body = HTTPStatus.OK, self.server.service.query(self.path)
+        except QueryError as error:
+            status, body = error.status, {'error': str(error)}
+        except Exception as error:
+            # any other failure is still a JSON response, and the server keeps serving
+            status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': repr(error)}
+        try:
+            payload = dumps(body).encode()
+        except (TypeError, ValueError) as error:
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            payload = dumps({'error': repr(error)}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # one line per request on stderr, without the client address
+        print(f'{self.command} {self.path} {args[1] if len(args) > 1 else ""}', flush=True)
+
+
+def make_server(service, host='127.0.0.1', port=PORT):
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('query', nargs='?', help='answer one query, e.g. /charity/275946, and exit')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    service = QueryService(args.data_dir)
+    if args.query:
+        try:
+            print(dumps(service.query(args.query), indent=2))
+        except QueryError as error:
+            parser.exit(1, f'{error}\n')
+        return
+    server = make_server(service, args.host, args.port)
+    print(f'loaded in {service.load_seconds:.2f}s, serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
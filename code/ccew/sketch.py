@@ -0,0 +1,104 @@
+"""Mergeable quantile sketch with a bounded relative error.
+
+Positive values are counted in logarithmic buckets: bucket `k` holds the
+values in `(gamma ** (k - 1), gamma ** k]`, with
+`gamma = (1 + accuracy) / (1 - accuracy)`, and is reported as the value
+whose relative distance to both bounds is `accuracy`. Any quantile is then
+within `accuracy` of the true value (relative error), whatever the
+distribution, and two sketches with the same accuracy merge by adding their
+bucket counts.
+"""
+
+import numpy as np
+
+ACCURACY = 0.01
+
+
+class QuantileSketch:
+    """Quantiles of non-negative values, within `accuracy` relative error."""
+
+    def __init__(self, accuracy=ACCURACY):
+        if not 0 < accuracy < 1:
+            raise ValueError(f'accuracy must be between 0 and 1, got {accuracy}')
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.offset = 0
+        self.bins = np.zeros(0, dtype='int64')
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = np.nan
+
+    def __len__(self):
+        return self.count
+
+    def _keys(self, values):
+        return np.ceil(np.log(values) / np.log(self.gamma)).astype('int64')
+
+    def _grow(self, low, high):
+        if not len(self.bins):
+            self.offset = low
+            self.bins = np.zeros(high - low + 1, dtype='int64')
+            return
+        first = min(low, self.offset)
+        last = max(high, self.offset + len(self.bins) - 1)
+        if first == self.offset and last == self.offset + len(self.bins) - 1:
+            return
+        bins = np.zeros(last - first + 1, dtype='int64')
+        bins[self.offset - first:self.offset - first + len(self.bins)] = self.bins
+        self.offset, self.bins = first, bins
+
+    def add(self, values, counts=None):
+        """Add values, each repeated `counts` times (default once). NaNs are ignored."""
+        values = np.asarray(values, dtype='float64').ravel()
+        counts = (
+            np.ones(len(values), dtype='int64') if counts is None
+            else np.asarray(counts, dtype='int64').ravel()
+        )
+        valid = ~np.isnan(values)
+        values, counts = values[valid], counts[valid]
+        if (values < 0).any():
+            raise ValueError('QuantileSketch only holds non-negative values')
+        if not len(values):
+            return self
+        self.count += int(counts.sum())
+        self.total += float((values * counts).sum())
+        self.max = np.nanmax([self.max, values.max()])
+        positive = values > 0
+        self.zeros += int(counts[~positive].sum())
+        if positive.any():
+            keys = self._keys(values[positive])
+            self._grow(int(keys.min()), int(keys.max()))
+            np.add.at(self.bins, keys - self.offset, counts[positive])
+        return self
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same accuracy."""
+        if other.accuracy != self.accuracy:
+            raise ValueError('cannot merge sketches with different accuracies')
+        if len(other.bins):
+            self._grow(other.offset, other.offset + len(other.bins) - 1)
+            start = other.offset - self.offset
+            self.bins[start:start + len(other.bins)] += other.bins
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.max = np.nanmax([self.max, other.max])
+        return self
+
+    def quantile(self, q):
+        """Estimated `q` quantile(s), NaN for an empty sketch."""
+        q = np.asarray(q, dtype='float64')
+        if not self.count:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        # rank of the quantile among the values sorted in increasing order
+        ranks = np.floor(q * (self.count - 1)).astype('int64')
+        cumulative = self.zeros + np.cumsum(self.bins)
+        keys = np.searchsorted(cumulative, ranks, side='right') + self.offset
+        estimates = 2 * self.gamma ** keys / (self.gamma + 1)
+        estimates = np.where(ranks < self.zeros, 0.0, np.minimum(estimates, self.max))
+        estimates = np.where(ranks == self.count - 1, self.max, estimates)
+        return estimates if q.ndim else float(estimates)
+
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
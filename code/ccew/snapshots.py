@@ -0,0 +1,477 @@
+"""Time-series store of the daily extracts as row-level deltas.
+
+Rather than a full zip per night, `snapshots/<extract>/` keeps one Parquet
+file (zstd) per archived day:
+
+- a keyframe, with every row of the extract, for the first day and then
+  every `KEYFRAME_INTERVAL` days, or when more than `KEYFRAME_RATIO` of the
+  rows changed;
+- otherwise a delta against the previous day: the rows added, in full, and
+  the ids of the rows removed (an updated row is one removed plus one
+  added). Rows that did not change are not stored again.
+
+Rows are identified by a `_row_id`, a hash of their values (ignoring
+`date_of_extract`) and of their occurrence among identical rows. Keyframes
+hold the rows alone, in the order of the extract, and their ids are
+recomputed when they are read: a row's hash depends on its values only,
+not on how the rows are cut into batches, so the ids match those it was
+stored with. Deltas hold the ids and a `_change` of +1 (added) or -1
+(removed). `index.json` lists the days with their file, kind, counts and
+the size and SHA-256 of the zip they replace.
+
+Any day is rebuilt by replaying the deltas from the keyframe before it,
+so reading a day never touches more than `KEYFRAME_INTERVAL` files. The
+ids of the newest day are kept in `data/snapshots/` (rebuilt from the store
+if missing) so that adding a day only reads the new extract, which is
+streamed in record batches. `materialise` writes a stored day where the
+converted extracts are read from, `data/publicextract.<extract>.parquet`,
+so the analysis runs from the store without the zips.
+
+    python -m ccew.snapshots                      # add every archived extract
+    python -m ccew.snapshots --materialise        # newest day -> data/publicextract.*.parquet
+    python -m ccew.snapshots charity --as-of 2024-09-10 --out out/
+    python -m ccew.snapshots --report             # storage against the raw zips
+"""
+
+import argparse
+import json
+import tempfile
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.extracts import (
+    ARCHIVE_DIR,
+    DATA_DIR,
+    EXTRACTS,
+    ROOT_DIR,
+    ROW_GROUP_SIZE,
+    extract_path,
+    parquet_path,
+)
+from ccew.incremental import file_digest, row_hashes
+from ccew.warehouse import iter_source
+
+STORE_DIR = ROOT_DIR / 'snapshots'
+INDEX_FILE = 'index.json'
+HEADS_DIR = 'snapshots'
+KEYFRAME_INTERVAL = 28
+KEYFRAME_RATIO = 0.5
+COMPRESSION = 'zstd'
+ID_COLUMN = '_row_id'
+CHANGE_COLUMN = '_change'
+DATE_COLUMN = 'date_of_extract'
+
+
+@dataclass
+class SnapshotAdded:
+    """Outcome of adding one day of an extract to the store."""
+
+    name: str
+    date: str
+    kind: str
+    added: int = 0
+    removed: int = 0
+    rows: int = 0
+    stored_bytes: int = 0
+    source_bytes: int = 0
+
+    def __str__(self):
+        if self.kind == 'unchanged':
+            return f'{self.name} {self.date}: already stored'
+        return (
+            f'{self.name} {self.date}: {self.kind}, +{self.added} -{self.removed} rows '
+            f'({self.rows} in all), {self.stored_bytes} bytes for a {self.source_bytes} byte zip'
+        )
+
+
+@dataclass
+class StoreReport:
+    """Storage used by the snapshots of one extract, against the zips they replace."""
+
+    name: str
+    days: int
+    keyframes: int
+    stored_bytes: int
+    source_bytes: int
+
+    @property
+    def saved(self):
+        """Fraction of the size of the zips saved by the store."""
+        return 1 - self.stored_bytes / self.source_bytes if self.source_bytes else 0.0
+
+    def __str__(self):
+        return (
+            f'{self.name}: {self.days} days ({self.keyframes} keyframes), '
+            f'{self.stored_bytes / 1e6:.1f} MB stored for {self.source_bytes / 1e6:.1f} MB '
+            f'of zips, {self.saved:.0%} saved'
+        )
+
+
+def extract_dir(name, store_dir=STORE_DIR):
+    """Directory of the snapshots of extract `name`."""
+    return Path(store_dir) / name
+
+
+def load_index(name, store_dir=STORE_DIR):
+    """Stored days of an extract, oldest first."""
+    path = extract_dir(name, store_dir) / INDEX_FILE
+    return json.loads(path.read_text()) if path.exists() else []
+
+
+def save_index(index, name, store_dir=STORE_DIR):
+    path = extract_dir(name, store_dir) / INDEX_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(index, indent=2))
+    tmp_path.replace(path)
+
+
+def _ids(hashes):
+    # uint64 id of every row from its hash and its rank among rows with the same hash
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'hash': hashes, 'occurrence': occurrence}), index=False
+    ).to_numpy()
+
+
+def row_ids(table):
+    """uint64 id of every row: the hash of its values and of its rank among identical rows."""
+    return _ids(np.concatenate(
+        [row_hashes(batch) for batch in table.to_batches()] or [np.array([], dtype='uint64')]
+    ))
+
+
+def _latest(latest, batch):
+    # the later of `latest` and the latest `date_of_extract` of a batch
+    if DATE_COLUMN in batch.schema.names:
+        value = pc.max(batch.column(DATE_COLUMN)).as_py()
+        if value is not None and (latest is None or value > latest):
+            return value
+    return latest
+
+
+def _extract_date(latest):
+    # the day an extract was taken, from its latest `date_of_extract`, else today
+    if latest is not None:
+        return latest.date().isoformat()
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _write_batches(batches, schema, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with pq.ParquetWriter(tmp_path, schema, compression=COMPRESSION) as writer:
+        for batch in batches:
+            writer.write_batch(batch, row_group_size=ROW_GROUP_SIZE)
+    tmp_path.replace(path)
+    return path.stat().st_size
+
+
+def _heads_path(name, data_dir=DATA_DIR):
+    return Path(data_dir) / HEADS_DIR / f'{name}.head.npz'
+
+
+def _head_ids(name, index, store_dir=STORE_DIR, data_dir=DATA_DIR):
+    # ids of the newest stored day, from the cache or replayed from the store
+    path = _heads_path(name, data_dir)
+    if path.exists():
+        head = np.load(path)
+        if str(head['date']) == index[-1]['date']:
+            return head['ids']
+    ids = _replay(name, index, len(index) - 1, store_dir)[ID_COLUMN].to_numpy()
+    _save_head(name, index[-1]['date'], ids, data_dir)
+    return ids
+
+
+def _save_head(name, day, ids, data_dir=DATA_DIR):
+    path = _heads_path(name, data_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix('.tmp'), 'wb') as file:
+        np.savez(file, date=day, ids=ids)
+    path.with_suffix('.tmp').replace(path)
+
+
+def _is_stored(name, day, index):
+    # whether `day` is already stored; raises if it is older than the last stored day
+    if not index or day > index[-1]['date']:
+        return False
+    if any(entry['date'] == day for entry in index):
+        return True
+    raise ValueError(f'{name}: {day} is older than the last stored day {index[-1]["date"]}')
+
+
+def _spill(source, path):
+    # copy the batches of `source` to an Arrow IPC file, hashing them on the way
+    hashes, latest, schema = [], None, None
+    with ExitStack() as stack:
+        writer = None
+        for batch in iter_source(source, batch_size=ROW_GROUP_SIZE):
+            if writer is None:
+                schema = batch.schema
+                writer = stack.enter_context(pa.ipc.new_file(str(path), schema))
+            writer.write_batch(batch)
+            hashes.append(row_hashes(batch))
+            latest = _latest(latest, batch)
+    if schema is None:
+        raise ValueError(f'{source} has no rows')
+    return np.concatenate(hashes), latest, schema
+
+
+def add_snapshot(name, source, day=None, store_dir=STORE_DIR, data_dir=DATA_DIR):
+    """Add the extract in `source` (zip or Parquet file) as day `day` of the store.
+
+    `day` defaults to the extract's `date_of_extract`. Days must be added in
+    order; a day already stored is left as it is. The extract is streamed
+    in record batches: it is parsed once into a temporary Arrow file while
+    the rows are hashed, then copied from it to the day's file, so memory
+    holds a batch and the row ids rather than the whole extract.
+    """
+    source = Path(source)
+    index = load_index(name, store_dir)
+    if day is not None and _is_stored(name, day, index):
+        return SnapshotAdded(name, day, 'unchanged')
+
+    with tempfile.TemporaryDirectory(prefix='ccew-snapshots-') as directory:
+        spilled = Path(directory) / f'{name}.arrow'
+        hashes, latest, schema = _spill(source, spilled)
+        day = day or _extract_date(latest)
+        if _is_stored(name, day, index):
+            return SnapshotAdded(name, day, 'unchanged')
+
+        ids = _ids(hashes)
+        entry = {
+            'date': day,
+            'rows': len(ids),
+            'source': source.name,
+            'source_bytes': source.stat().st_size,
+            'source_sha256': file_digest(source),
+        }
+        since_keyframe = next(
+            (i for i, previous in enumerate(reversed(index)) if previous['kind'] == 'keyframe'),
+            None,
+        )
+        if index:
+            previous = _head_ids(name, index, store_dir, data_dir)
+            added = ~np.isin(ids, previous)
+            removed = previous[~np.isin(previous, ids)]
+            changes = int(added.sum()) + len(removed)
+        keyframe = (
+            not index
+            or since_keyframe + 1 >= KEYFRAME_INTERVAL
+            or changes > KEYFRAME_RATIO * max(len(ids), 1)
+        )
+        if keyframe:
+            entry.update(kind='keyframe', added=len(ids), removed=0)
+        else:
+            entry.update(kind='delta', added=int(added.sum()), removed=len(removed))
+        if latest is not None:
+            entry['date_of_extract'] = _extract_date(latest)
+        entry['file'] = f'{day}.parquet'
+        with pa.memory_map(str(spilled)) as file:
+            reader = pa.ipc.open_file(file)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            path = extract_dir(name, store_dir) / entry['file']
+            if keyframe:
+                # ids are recomputed when a keyframe is read, so it holds the rows alone
+                entry['stored_bytes'] = _write_batches(batches, schema, path)
+            else:
+                entry['stored_bytes'] = _write_batches(
+                    _delta_batches(batches, schema, ids, added, removed),
+                    _delta_schema(schema),
+                    path,
+                )
+
+    index.append(entry)
+    save_index(index, name, store_dir)
+    _save_head(name, day, ids, data_dir)
+    return SnapshotAdded(
+        name, day, entry['kind'], entry['added'], entry['removed'], entry['rows'],
+        entry['stored_bytes'], entry['source_bytes'],
+    )
+
+
+def _delta_schema(schema):
+    return schema.append(pa.field(ID_COLUMN, pa.uint64())).append(
+        pa.field(CHANGE_COLUMN, pa.int8())
+    )
+
+
+def _delta_batches(batches, schema, ids, added, removed):
+    # the added rows of each batch with their ids, then the ids of the removed rows
+    start = 0
+    for batch in batches:
+        stop = start + batch.num_rows
+        keep = added[start:stop]
+        if keep.any():
+            batch = batch.filter(pa.array(keep))
+            yield pa.RecordBatch.from_arrays(
+                batch.columns + [
+                    pa.array(ids[start:stop][keep], type=pa.uint64()),
+                    pa.array(np.ones(batch.num_rows, dtype='int8')),
+                ],
+                schema=_delta_schema(schema),
+            )
+        start = stop
+    # removed rows only need their id: their values are in earlier files
+    yield pa.RecordBatch.from_arrays(
+        [pa.nulls(len(removed), field.type) for field in schema] + [
+            pa.array(removed, type=pa.uint64()),
+            pa.array(np.full(len(removed), -1, dtype='int8')),
+        ],
+        schema=_delta_schema(schema),
+    )
+
+
+def read_day(name, entry, store_dir=STORE_DIR):
+    """Stored file of one day of the index, with `_row_id` and `_change` columns.
+
+    That is the day's rows for a keyframe, and its changes from the
+    previous day for a delta.
+    """
+    table = pq.read_table(extract_dir(name, store_dir) / entry['file'])
+    if entry['kind'] == 'keyframe':
+        table = table.append_column(ID_COLUMN, pa.array(row_ids(table)))
+        table = table.append_column(
+            CHANGE_COLUMN, pa.array(np.ones(table.num_rows, dtype='int8'))
+        )
+    return table
+
+
+def _replay(name, index, position, store_dir=STORE_DIR):
+    # rows of day `index[position]`, with their ids, from the keyframe before it
+    start = max(i for i in range(position + 1) if index[i]['kind'] == 'keyframe')
+    table = read_day(name, index[start], store_dir)
+    for entry in index[start + 1:position + 1]:
+        delta = read_day(name, entry, store_dir)
+        removed = delta.filter(pc.equal(delta[CHANGE_COLUMN], -1))[ID_COLUMN]
+        table = table.filter(pc.invert(pc.is_in(table[ID_COLUMN], value_set=removed)))
+        added = delta.filter(pc.equal(delta[CHANGE_COLUMN], 1))
+        table = pa.concat_tables([table, added], promote_options='permissive')
+    return table
+
+
+def stored_days(name, store_dir=STORE_DIR):
+    """Days stored for an extract, oldest first."""
+    return [entry['date'] for entry in load_index(name, store_dir)]
+
+
+def snapshot(name, day, store_dir=STORE_DIR):
+    """Table of extract `name` as it was on `day` (the latest stored day up to it).
+
+    Rows are in charity number order, with the `date_of_extract` of that day.
+    """
+    day = day.isoformat() if isinstance(day, date) else str(day)
+    index = load_index(name, store_dir)
+    position = sum(entry['date'] <= day for entry in index) - 1
+    if position < 0:
+        raise KeyError(f'no snapshot of {name!r} on or before {day}')
+    table = _replay(name, index, position, store_dir).drop_columns([ID_COLUMN, CHANGE_COLUMN])
+    if DATE_COLUMN in table.column_names and 'date_of_extract' in index[position]:
+        extracted = pa.scalar(
+            datetime.fromisoformat(index[position]['date_of_extract']), table[DATE_COLUMN].type
+        )
+        table = table.set_column(
+            table.column_names.index(DATE_COLUMN), DATE_COLUMN,
+            pa.array(np.full(table.num_rows, extracted.value), type=extracted.type),
+        )
+    if 'registered_charity_number' in table.column_names:
+        table = table.sort_by('registered_charity_number')
+    return table
+
+
+def materialise(name, day=None, store_dir=STORE_DIR, data_dir=DATA_DIR):
+    """Write a stored day of an extract (default: the newest) to its `parquet_path`.
+
+    That is where the converted extracts are read from (`ccew.data`,
+    `ccew.warehouse`, `ccew.sql`...), so the tables of the analysis can be
+    rebuilt from the store alone. Returns the number of rows and the path.
+    """
+    index = load_index(name, store_dir)
+    if not index:
+        raise KeyError(f'no snapshot of {name!r} in {store_dir}')
+    table = snapshot(name, day or index[-1]['date'], store_dir)
+    path = parquet_path(name, data_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE)
+    tmp_path.replace(path)
+    return table.num_rows, path
+
+
+def add_archive(names=EXTRACTS, archive_dir=ARCHIVE_DIR, store_dir=STORE_DIR,
+                data_dir=DATA_DIR, day=None):
+    """Add every archived extract of `names` to the store, skipping missing ones."""
+    return [
+        add_snapshot(name, extract_path(name, archive_dir), day, store_dir, data_dir)
+        for name in names
+        if extract_path(name, archive_dir).exists()
+    ]
+
+
+def storage_report(names=EXTRACTS, store_dir=STORE_DIR):
+    """Storage of each stored extract, against the zips its days were added from."""
+    reports = []
+    for name in names:
+        index = load_index(name, store_dir)
+        if index:
+            reports.append(StoreReport(
+                name,
+                days=len(index),
+                keyframes=sum(entry['kind'] == 'keyframe' for entry in index),
+                stored_bytes=sum(entry['stored_bytes'] for entry in index),
+                source_bytes=sum(entry['source_bytes'] for entry in index),
+            ))
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=EXTRACTS, help='extracts to add or read')
+    parser.add_argument('--archive-dir', type=Path, default=ARCHIVE_DIR)
+    parser.add_argument('--store-dir', type=Path, default=STORE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument(
+        '--date', help='day to store the archived extracts as (default: their date_of_extract)'
+    )
+    parser.add_argument(
+        '--materialise', action='store_true',
+        help='write the newest stored day (or --as-of) of the extracts to their Parquet files',
+    )
+    parser.add_argument('--as-of', help='rebuild the extracts as they were on this day instead')
+    parser.add_argument(
+        '--out', type=Path, help='data directory for the rebuilt extracts (default: --data-dir)'
+    )
+    parser.add_argument('--report', action='store_true', help='only report the storage used')
+    args = parser.parse_args(argv)
+
+    if args.materialise or args.as_of:
+        for name in args.names:
+            if not load_index(name, args.store_dir):
+                continue
+            rows, path = materialise(name, args.as_of, args.store_dir, args.out or args.data_dir)
+            print(f'{name}: {rows} rows as of {args.as_of or "the newest day"} -> {path}')
+        return
+    if not args.report:
+        for added in add_archive(args.names, args.archive_dir, args.store_dir, args.data_dir,
+                                 args.date):
+            print(added)
+    reports = storage_report(args.names, args.store_dir)
+    for report in reports:
+        print(report)
+    stored = sum(report.stored_bytes for report in reports)
+    source = sum(report.source_bytes for report in reports)
+    if source:
+        print(f'total: {stored / 1e6:.1f} MB stored for {source / 1e6:.1f} MB of zips, '
+              f'{1 - stored / source:.0%} saved')
+
+
+if __name__ == '__main__':
+    main()
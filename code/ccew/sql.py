@@ -0,0 +1,344 @@
+"""The merger and annual return analyses as SQL, run by DuckDB over the Parquet files.
+
+An optional backend for the steps of `ccew.mergers`: DuckDB scans the
+stored register (`data/mergers.parquet`, see `ccew.releases`) and the
+converted annual return history in parallel on every core, and spills to
+`data/duckdb/` when a join does not fit in memory. The frames returned are
+the ones the pandas steps return, row for row.
+
+It needs the `duckdb` package, which the pandas path does not:
+
+    python -m ccew.sql merger_counts effects_transferees
+    python -m ccew.sql --check          # compare every target with the pandas path
+
+`compare_backends` is the check: it runs each target both ways and lists
+the targets whose results differ.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from ccew import mergers
+from ccew.data import load_annual_returns
+from ccew.extracts import DATA_DIR, parquet_path
+from ccew.releases import TABLE_FILE, load_table
+
+SPILL_DIR = 'duckdb'
+FIRST_YEAR = 2008
+# first year of the annual returns matched to mergers, as in `ccew.pipeline`
+FIRST_AR_YEAR = 2007
+VALUE_COLUMN = 'total_gross_income'
+
+# financial periods of the charities of the register, numbered from 1 in the
+# order of `FinancialPeriodIndex`: by start, then end (missing first), then file order
+PERIODS = """
+CREATE OR REPLACE VIEW periods AS
+SELECT
+    registered_charity_number AS number,
+    CAST(fin_period_start_date AS DATE) AS period_start,
+    CAST(fin_period_end_date AS DATE) AS period_end,
+    fin_period_start_date,
+    fin_period_end_date,
+    {column} AS value,
+    row_number() OVER (
+        PARTITION BY registered_charity_number
+        ORDER BY CAST(fin_period_start_date AS DATE),
+                 CAST(fin_period_end_date AS DATE) NULLS FIRST,
+                 file_row_number
+    ) AS pos
+FROM read_parquet({path}, file_row_number = true)
+WHERE fin_period_start_date >= make_date({first_year}, 1, 1)
+  AND registered_charity_number IN (
+      SELECT TRY_CAST(transferor_number AS BIGINT) FROM mergers
+      UNION SELECT TRY_CAST(transferee_number AS BIGINT) FROM mergers
+  )
+"""
+
+# each merger with the period containing its transfer date and the next one:
+# the last period starting on or before the date (ASOF join) is current if it
+# has not ended yet (or has no end); the next period follows it, or is the first one
+MERGED = """
+WITH latest AS (
+    SELECT number, period_start, max_by(period_end, pos) AS period_end, max(pos) AS pos
+    FROM periods GROUP BY number, period_start
+),
+events AS (
+    SELECT
+        row,
+        TRY_CAST({role}_number AS BIGINT) AS number,
+        CAST(date_transferred AS DATE) AS day
+    FROM mergers
+),
+matched AS (
+    SELECT events.*, latest.pos, latest.period_end
+    FROM events ASOF LEFT JOIN latest
+      ON events.number = latest.number AND events.day >= latest.period_start
+)
+SELECT
+    mergers.* EXCLUDE (date_registered, "registered-transfer"),
+    cur.fin_period_start_date AS fin_period_start_date_current,
+    cur.fin_period_end_date AS fin_period_end_date_current,
+    cur.value AS {column}_current,
+    nxt.fin_period_start_date AS fin_period_start_date_next,
+    nxt.fin_period_end_date AS fin_period_end_date_next,
+    nxt.value AS {column}_next
+FROM mergers
+JOIN matched USING (row)
+-- equality conditions only, so that both joins are hash joins
+LEFT JOIN periods cur
+  ON cur.number = matched.number
+ AND cur.pos = CASE
+     WHEN matched.period_end IS NULL OR matched.day <= matched.period_end THEN matched.pos
+ END
+LEFT JOIN periods nxt
+  ON nxt.number = matched.number
+ AND nxt.pos = CASE WHEN matched.day IS NOT NULL THEN coalesce(matched.pos, 0) + 1 END
+ORDER BY row
+"""
+
+
+def _quote(value):
+    # SQL string literal: views and settings cannot take prepared parameters
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def connect(data_dir=DATA_DIR, df=None, threads=None, memory_limit=None):
+    """DuckDB connection with a `mergers` view and the annual returns.
+
+    `mergers` is `df` if given (a cleaned register frame, e.g. a pipeline
+    stage's output), else the stored register from `FIRST_YEAR`, with a
+    `row` column: the frame's index, or the row number in the stored table.
+    """
+    import duckdb
+
+    data_dir = Path(data_dir)
+    spill_dir = data_dir / SPILL_DIR
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f'SET temp_directory = {_quote(spill_dir)}')
+    con.execute('SET preserve_insertion_order = true')
+    if threads:
+        con.execute(f'SET threads = {int(threads)}')
+    if memory_limit:
+        con.execute(f'SET memory_limit = {_quote(memory_limit)}')
+    if df is None:
+        con.execute(
+            'CREATE VIEW mergers AS '
+            'SELECT * EXCLUDE (file_row_number), file_row_number AS row '
+            f'FROM read_parquet({_quote(data_dir / TABLE_FILE)}, file_row_number = true) '
+            f'WHERE year(date_transferred) >= {int(FIRST_YEAR)}'
+        )
+    else:
+        con.register('mergers_frame', df.rename_axis('row').reset_index())
+        con.execute('CREATE VIEW mergers AS SELECT * FROM mergers_frame')
+    con.execute(PERIODS.format(
+        column=VALUE_COLUMN,
+        path=_quote(parquet_path('charity_annual_return_history', data_dir)),
+        first_year=int(FIRST_AR_YEAR),
+    ))
+    return con
+
+
+def _frame(con, query, params=None):
+    # result frame indexed like the register frame when it has a `row` column
+    df = con.execute(query, params or []).df()
+    return df.set_index('row').rename_axis(None) if 'row' in df.columns else df
+
+
+def mergers_per_year(con, unique=False):
+    """`ccew.mergers.mergers_per_year`."""
+    rows = 'SELECT DISTINCT transferee, date_transferred' if unique else 'SELECT date_transferred'
+    return _frame(con, f"""
+        SELECT year(date_transferred) AS date_transferred, count(*) AS count
+        FROM ({rows} FROM mergers)
+        WHERE date_transferred IS NOT NULL
+        GROUP BY ALL ORDER BY ALL
+    """)
+
+
+def frequent_charities(con, role):
+    """`ccew.mergers.frequent_charities`; between equally frequent names of a
+    charity, the name kept may differ."""
+    return _frame(con, f"""
+        SELECT {role}_number, arg_max({role}, n) AS {role}, sum(n) AS count
+        FROM (
+            SELECT {role}_number, {role}, count(*) AS n
+            FROM mergers
+            WHERE {role}_number IS NOT NULL AND {role} IS NOT NULL
+            GROUP BY ALL
+        )
+        GROUP BY ALL
+        ORDER BY count DESC, {role}_number DESC
+    """)
+
+
+def merger_frequencies(con, role):
+    """`ccew.mergers.merger_frequencies`."""
+    return _frame(con, f"""
+        SELECT count AS count_of_mergers, count(*) AS frequency
+        FROM (
+            SELECT count(*) AS count FROM mergers
+            WHERE {role}_number IS NOT NULL GROUP BY {role}_number
+        )
+        GROUP BY ALL ORDER BY ALL
+    """).set_index('count_of_mergers')
+
+
+def merged_annual_returns(con, role):
+    """`ccew.mergers.merged_annual_returns` of the annual returns from `FIRST_AR_YEAR`."""
+    return _frame(con, MERGED.format(role=role, column=VALUE_COLUMN))
+
+
+def merger_effects(con, role):
+    """`ccew.mergers.merger_effects` of `merged_annual_returns`."""
+    current, next_ = f'{VALUE_COLUMN}_current', f'{VALUE_COLUMN}_next'
+    return _frame(con, f"""
+        WITH merged AS ({MERGED.format(role=role, column=VALUE_COLUMN)})
+        SELECT * REPLACE (coalesce({current}, 0) AS {current}, coalesce({next_}, 0) AS {next_}),
+            CASE
+                WHEN coalesce({current}, 0) <> 0
+                    THEN (coalesce({next_}, 0) - {current}) / {current} * 100
+                WHEN coalesce({next_}, 0) > 0 THEN 100
+                WHEN coalesce({next_}, 0) < 0 THEN -100
+            END AS effect
+        FROM merged
+        WHERE {current} IS NOT NULL OR {next_} IS NOT NULL
+        ORDER BY row
+    """)
+
+
+# targets named as the `ccew.pipeline` stages they compute
+TARGETS = {
+    'merger_counts': (mergers_per_year, {}),
+    'merger_counts_unique': (mergers_per_year, {'unique': True}),
+    'frequent_transferors': (frequent_charities, {'role': 'transferor'}),
+    'frequent_transferees': (frequent_charities, {'role': 'transferee'}),
+    'transferor_frequencies': (merger_frequencies, {'role': 'transferor'}),
+    'transferee_frequencies': (merger_frequencies, {'role': 'transferee'}),
+    'merged_transferees': (merged_annual_returns, {'role': 'transferee'}),
+    'merged_transferors': (merged_annual_returns, {'role': 'transferor'}),
+    'effects_transferees': (merger_effects, {'role': 'transferee'}),
+    'effects_transferors': (merger_effects, {'role': 'transferor'}),
+}
+
+
+def run(targets, con):
+    """`{target: frame}` of the `TARGETS` named."""
+    return {target: TARGETS[target][0](con, **TARGETS[target][1]) for target in targets}
+
+
+def pandas_targets(targets, data_dir=DATA_DIR):
+    """The same targets computed by the pandas steps, from the stored register."""
+    df = mergers.recent_mergers(load_table(data_dir), FIRST_YEAR)
+    outputs = {}
+    df_ar = None
+    for target in targets:
+        func, params = TARGETS[target]
+        if func is mergers_per_year:
+            outputs[target] = mergers.mergers_per_year.uncached(df, **params)
+        elif func is frequent_charities:
+            outputs[target] = mergers.frequent_charities.uncached(df, **params)
+        elif func is merger_frequencies:
+            outputs[target] = mergers.merger_frequencies.uncached(df, **params)
+        else:
+            if df_ar is None:
+                numbers = pd.concat([df['transferor_number'], df['transferee_number']])
+                # the body of `mergers.annual_returns`, reading from `data_dir`
+                df_ar = load_annual_returns(
+                    columns=mergers.ANNUAL_RETURN_COLUMNS,
+                    years=(FIRST_AR_YEAR, None),
+                    charity_numbers=numbers,
+                    data_dir=data_dir,
+                )
+            merged = mergers.merged_annual_returns.uncached(df, df_ar, params['role'], VALUE_COLUMN)
+            if func is merger_effects:
+                merged = mergers.merger_effects.uncached(merged, VALUE_COLUMN)
+            outputs[target] = merged
+    return outputs
+
+
+def _canonical(df, target):
+    # frames in a comparable form: rows where the order is not defined are
+    # sorted, names of tied spellings dropped, missing values as NaN
+    df = df.copy()
+    if target.startswith('frequent_'):
+        role = target.removeprefix('frequent_')[:-1]
+        df = df.drop(columns=role).sort_values(
+            ['count', f'{role}_number'], ascending=False
+        ).reset_index(drop=True)
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].astype('datetime64[ns]')
+        elif pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype('float64')
+        else:
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
+    return df
+
+
+def compare_backends(targets=TARGETS, data_dir=DATA_DIR, con=None):
+    """Targets whose DuckDB and pandas results differ, with the difference found.
+
+    Floats are compared to a relative 1e-9; an empty dict means identical
+    results.
+    """
+    con = con or connect(data_dir)
+    expected = pandas_targets(targets, data_dir)
+    actual = run(targets, con)
+    differences = {}
+    for target in targets:
+        try:
+            pd.testing.assert_frame_equal(
+                _canonical(actual[target], target),
+                _canonical(expected[target], target),
+                check_dtype=False,
+                check_index_type=False,
+                check_column_type=False,
+                check_names=False,
+                rtol=1e-9,
+            )
+        except AssertionError as error:
+            differences[target] = str(error)
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('targets', nargs='*', help=f'targets: {", ".join(TARGETS)}')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the targets (default: all) with the pandas path')
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--threads', type=int, help='DuckDB threads (default: CPUs)')
+    parser.add_argument('--memory-limit', help="e.g. '4GB'; DuckDB spills beyond it")
+    parser.add_argument('--out', type=Path, help='write the targets to <out>/<target>.parquet')
+    args = parser.parse_args(argv)
+
+    unknown = [target for target in args.targets if target not in TARGETS]
+    if unknown:
+        parser.error(f'unknown targets: {", ".join(unknown)}')
+    con = connect(args.data_dir, threads=args.threads, memory_limit=args.memory_limit)
+    if args.check:
+        differences = compare_backends(args.targets or list(TARGETS), args.data_dir, con)
+        for target in args.targets or TARGETS:
+            print(f'{target}: {"differs" if target in differences else "identical"}')
+        for target, difference in differences.items():
+            print(f'\n{target}\n{difference}', file=sys.stderr)
+        sys.exit(1 if differences else 0)
+
+    for target in args.targets or TARGETS:
+        start = time.perf_counter()
+        output = run([target], con)[target]
+        print(f'{target}: {time.perf_counter() - start:.2f}s')
+        if args.out:
+            args.out.mkdir(parents=True, exist_ok=True)
+            output.to_parquet(args.out / f'{target}.parquet')
+        else:
+            print(f'{output}\n')
+
+
+if __name__ == '__main__':
+    main()
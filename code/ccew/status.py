@@ -0,0 +1,99 @@
+"""Normalise the notes found instead of a charity number into a few statuses.
+
+The rules live in a versioned table, `rules/status_rules.csv`. Columns are
+factorised first, so the rules are only evaluated once per distinct note
+rather than once per row, and the statuses are mapped back onto the codes.
+A note that matches no rule is its own status (lower-cased and stripped),
+as in the notebook's replace chains, so new kinds of notes stay visible
+instead of being folded into `other`.
+"""
+
+import csv
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+RULES_PATH = Path(__file__).parent / 'rules' / 'status_rules.csv'
+
+
+@dataclass(frozen=True)
+class StatusRules:
+    """Literal and regex rules mapping a lower-cased note to a status.
+
+    Notes matching no rule map to `default`, or to themselves when it is None.
+    """
+
+    version: str
+    literal: dict
+    regex: tuple
+    default: str | None = None
+
+    @classmethod
+    def load(cls, path=RULES_PATH):
+        version = None
+        lines = []
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.startswith('#'):
+                    key, _, value = line[1:].partition(':')
+                    if key.strip() == 'version':
+                        version = value.strip()
+                elif line.strip():
+                    lines.append(line)
+        if version is None:
+            raise ValueError(f'{path} has no "# version:" header')
+
+        literal, regex = {}, []
+        for row in csv.DictReader(lines):
+            if row['match'] == 'literal':
+                literal.setdefault(row['pattern'], row['status'])
+            elif row['match'] == 'regex':
+                regex.append((re.compile(row['pattern']), row['status']))
+            else:
+                raise ValueError(f'unknown match type {row["match"]!r} in {path}')
+        return cls(version, literal, tuple(regex))
+
+    def classify(self, note):
+        """Status of a single note."""
+        note = note.strip().lower()
+        if note in self.literal:
+            return self.literal[note]
+        for pattern, status in self.regex:
+            if pattern.search(note):
+                return status
+        return note if self.default is None else self.default
+
+
+@lru_cache
+def default_rules():
+    return StatusRules.load()
+
+
+def normalise_status(values, rules=None):
+    """Status of every note in `values`, evaluating the rules once per distinct note.
+
+    Accepts a pyarrow array or a pandas Series and returns the same kind;
+    nulls stay null.
+    """
+    if rules is None:
+        rules = default_rules()
+
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        encoded = pc.dictionary_encode(values)
+        if isinstance(encoded, pa.ChunkedArray):
+            encoded = encoded.combine_chunks()
+        statuses = pa.array(
+            [rules.classify(note) for note in encoded.dictionary.to_pylist()],
+            type=pa.string(),
+        )
+        return pc.take(statuses, encoded.indices)
+
+    codes, uniques = pd.factorize(values)
+    statuses = pd.array([rules.classify(str(note)) for note in uniques] + [pd.NA], dtype='string')
+    # code -1 (missing) picks the trailing NA
+    return pd.Series(statuses.take(codes), index=values.index, name=values.name)
@@ -0,0 +1,290 @@
+"""Point-in-time queries over the daily snapshots of the extracts.
+
+For each extract in the snapshot store (see `ccew.snapshots`), every
+version of every row gets a validity interval: `valid_from`, the first
+stored day it was seen, and `valid_to`, the first stored day it was no
+longer there (null while it is current). Rows of the first stored day are
+valid from that day, as nothing earlier is known; a day between two stored
+days reads as the earlier one.
+
+The intervals are kept in `data/temporal/<extract>.parquet`, sorted by
+charity number, in small row groups, next to an index of the rows of each
+charity. `update_intervals` applies the days stored since the last update,
+from their deltas alone, and lookups for one charity read only the row
+groups that hold it instead of the snapshots.
+
+    python -m ccew.temporal                                   # apply new days
+    python -m ccew.temporal charity 200047 --as-of 2024-09-15
+    python -m ccew.temporal charity_trustee 200047 --from 2024-01-01 --to 2024-12-31
+
+    intervals = RecordIntervals.load('charity')
+    intervals.as_of(200047, '2024-09-15')
+"""
+
+import argparse
+import json
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.extracts import DATA_DIR, EXTRACTS
+from ccew.snapshots import CHANGE_COLUMN, DATE_COLUMN, ID_COLUMN, STORE_DIR, load_index, read_day
+
+TEMPORAL_DIR = 'temporal'
+MANIFEST_FILE = 'manifest.json'
+KEY = 'registered_charity_number'
+ROW_GROUP_SIZE = 8192
+FROM_COLUMN = 'valid_from'
+TO_COLUMN = 'valid_to'
+
+
+@dataclass
+class IntervalsUpdate:
+    """Days applied to the intervals of one extract."""
+
+    name: str
+    days: int = 0
+    opened: int = 0
+    closed: int = 0
+    intervals: int = 0
+
+    def __str__(self):
+        if not self.days:
+            return f'{self.name}: up to date'
+        return (
+            f'{self.name}: {self.days} days, {self.opened} intervals opened, '
+            f'{self.closed} closed ({self.intervals} in all)'
+        )
+
+
+def intervals_path(name, data_dir=DATA_DIR):
+    """Path of the validity intervals of extract `name`."""
+    return Path(data_dir) / TEMPORAL_DIR / f'{name}.parquet'
+
+
+def index_path(name, data_dir=DATA_DIR):
+    """Path of the charity index of the intervals of extract `name`."""
+    return Path(data_dir) / TEMPORAL_DIR / f'{name}.index.npz'
+
+
+def load_manifest(data_dir=DATA_DIR):
+    """Last day applied and number of intervals of each extract."""
+    path = Path(data_dir) / TEMPORAL_DIR / MANIFEST_FILE
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def save_manifest(manifest, data_dir=DATA_DIR):
+    path = Path(data_dir) / TEMPORAL_DIR / MANIFEST_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def _day(value):
+    return value.isoformat() if isinstance(value, date) else str(value)
+
+
+def _opened(rows, day):
+    # intervals starting on `day` for rows with ids
+    rows = rows.drop_columns([c for c in [DATE_COLUMN, CHANGE_COLUMN] if c in rows.column_names])
+    start = pa.scalar(date.fromisoformat(day), pa.date32())
+    rows = rows.append_column(FROM_COLUMN, pa.repeat(start, rows.num_rows))
+    return rows.append_column(TO_COLUMN, pa.nulls(rows.num_rows, pa.date32()))
+
+
+def apply_day(intervals, day_table, day, kind):
+    """Intervals updated with one stored day; returns them and the number opened and closed.
+
+    `day_table` is the day as read by `ccew.snapshots.read_day`: all its
+    rows for a keyframe, which are compared to the open intervals, and its
+    changes for a delta.
+    """
+    if intervals is None:
+        return _opened(day_table, day), day_table.num_rows, 0
+    current = pc.is_null(intervals[TO_COLUMN])
+    if kind == 'keyframe':
+        open_ids = intervals.filter(current)[ID_COLUMN]
+        added = day_table.filter(pc.invert(pc.is_in(day_table[ID_COLUMN], value_set=open_ids)))
+        removed = pc.filter(open_ids, pc.invert(pc.is_in(open_ids, value_set=day_table[ID_COLUMN])))
+    else:
+        added = day_table.filter(pc.equal(day_table[CHANGE_COLUMN], 1))
+        removed = day_table.filter(pc.equal(day_table[CHANGE_COLUMN], -1))[ID_COLUMN]
+    closing = pc.and_(current, pc.is_in(intervals[ID_COLUMN], value_set=removed))
+    end = pa.scalar(date.fromisoformat(day), pa.date32())
+    intervals = intervals.set_column(
+        intervals.column_names.index(TO_COLUMN), TO_COLUMN,
+        pc.if_else(closing, end, intervals[TO_COLUMN]),
+    )
+    intervals = pa.concat_tables([intervals, _opened(added, day)], promote_options='permissive')
+    return intervals, added.num_rows, int(pc.sum(closing).as_py() or 0)
+
+
+def _write(intervals, name, data_dir=DATA_DIR):
+    intervals = intervals.sort_by([(KEY, 'ascending'), (FROM_COLUMN, 'ascending')])
+    path = intervals_path(name, data_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    pq.write_table(intervals, tmp_path, row_group_size=ROW_GROUP_SIZE, compression='zstd')
+    tmp_path.replace(path)
+
+    # first row of each charity, over rows sorted with missing numbers last
+    keys = intervals[KEY].to_numpy(zero_copy_only=False)
+    valid = ~pd.isna(keys)
+    numbers, starts = np.unique(keys[valid].astype('int64'), return_index=True)
+    with open(index_path(name, data_dir).with_suffix('.tmp'), 'wb') as file:
+        np.savez(file, numbers=numbers, starts=starts, stop=valid.sum())
+    index_path(name, data_dir).with_suffix('.tmp').replace(index_path(name, data_dir))
+
+
+def update_intervals(name, store_dir=STORE_DIR, data_dir=DATA_DIR):
+    """Apply the days stored for an extract since the last update to its intervals."""
+    manifest = load_manifest(data_dir)
+    done = manifest.get(name, {}).get('date')
+    pending = [
+        entry for entry in load_index(name, store_dir) if done is None or entry['date'] > done
+    ]
+    if not pending:
+        return IntervalsUpdate(name, intervals=manifest.get(name, {}).get('intervals', 0))
+
+    path = intervals_path(name, data_dir)
+    intervals = pq.read_table(path) if done is not None and path.exists() else None
+    update = IntervalsUpdate(name)
+    for entry in pending:
+        intervals, opened, closed = apply_day(
+            intervals, read_day(name, entry, store_dir), entry['date'], entry['kind']
+        )
+        update.days += 1
+        update.opened += opened
+        update.closed += closed
+    _write(intervals, name, data_dir)
+    update.intervals = intervals.num_rows
+    manifest[name] = {
+        'date': pending[-1]['date'],
+        'first_date': manifest.get(name, {}).get('first_date', pending[0]['date']),
+        'intervals': intervals.num_rows,
+    }
+    save_manifest(manifest, data_dir)
+    return update
+
+
+def update_all(names=EXTRACTS, store_dir=STORE_DIR, data_dir=DATA_DIR):
+    """`update_intervals` for every extract of `names` in the snapshot store."""
+    return [
+        update_intervals(name, store_dir, data_dir)
+        for name in names
+        if load_index(name, store_dir)
+    ]
+
+
+class RecordIntervals:
+    """Validity intervals of one extract, read one charity at a time."""
+
+    def __init__(self, name, data_dir=DATA_DIR):
+        path = intervals_path(name, data_dir)
+        if not path.exists():
+            raise FileNotFoundError(f'{path} not built: run python -m ccew.temporal {name}')
+        self.name = name
+        self.file = pq.ParquetFile(path)
+        index = np.load(index_path(name, data_dir))
+        self.numbers, self.starts = index['numbers'], index['starts']
+        self.stop = int(index['stop'])
+        sizes = [self.file.metadata.row_group(i).num_rows for i in range(self.file.num_row_groups)]
+        self.group_starts = np.concatenate([[0], np.cumsum(sizes)])
+
+    @classmethod
+    def load(cls, name, data_dir=DATA_DIR):
+        return cls(name, data_dir)
+
+    def __repr__(self):
+        return (
+            f'<RecordIntervals {self.name}: {self.file.metadata.num_rows} intervals, '
+            f'{len(self.numbers)} charities>'
+        )
+
+    def rows(self, number):
+        """Every interval of a charity number, oldest first."""
+        i = np.searchsorted(self.numbers, number)
+        if i == len(self.numbers) or self.numbers[i] != number:
+            return self.file.schema_arrow.empty_table()
+        lo = int(self.starts[i])
+        hi = int(self.starts[i + 1]) if i + 1 < len(self.numbers) else self.stop
+        first = np.searchsorted(self.group_starts, lo, side='right') - 1
+        last = np.searchsorted(self.group_starts, hi, side='left')
+        table = self.file.read_row_groups(range(first, last))
+        return table.slice(lo - self.group_starts[first], hi - lo)
+
+    def as_of(self, number, day):
+        """Rows of a charity as they were on `day`."""
+        table = self.rows(number)
+        day = pa.scalar(date.fromisoformat(_day(day)), pa.date32())
+        valid = pc.and_(
+            pc.less_equal(table[FROM_COLUMN], day),
+            pc.fill_null(pc.greater(table[TO_COLUMN], day), True),
+        )
+        return table.filter(valid).drop_columns([ID_COLUMN])
+
+    def history(self, number, start=None, end=None):
+        """Intervals of a charity that overlap the days `start` to `end` (inclusive)."""
+        table = self.rows(number)
+        keep = pa.array(np.ones(table.num_rows, dtype=bool))
+        if start is not None:
+            start = pa.scalar(date.fromisoformat(_day(start)), pa.date32())
+            keep = pc.and_(keep, pc.fill_null(pc.greater(table[TO_COLUMN], start), True))
+        if end is not None:
+            end = pa.scalar(date.fromisoformat(_day(end)), pa.date32())
+            keep = pc.and_(keep, pc.less_equal(table[FROM_COLUMN], end))
+        return table.filter(keep).drop_columns([ID_COLUMN])
+
+    def changes(self, number, start=None, end=None):
+        """Days on which a charity's rows changed, with the rows added and removed that day."""
+        history = self.history(number, start, end).to_pandas()
+        added = history.assign(change='added', date=history[FROM_COLUMN])
+        removed = history[history[TO_COLUMN].notna()]
+        removed = removed.assign(change='removed', date=removed[TO_COLUMN])
+        events = pd.concat([added, removed], ignore_index=True)
+        if start is not None:
+            events = events[events['date'] >= date.fromisoformat(_day(start))]
+        if end is not None:
+            events = events[events['date'] <= date.fromisoformat(_day(end))]
+        return events.sort_values(['date', 'change'], kind='stable').reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'names', nargs='*', default=list(EXTRACTS),
+        help='extracts to update, or extracts followed by a charity number to query',
+    )
+    parser.add_argument('--store-dir', type=Path, default=STORE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--as-of', help='rows of the charity on this day')
+    parser.add_argument('--from', dest='start', help='first day of the history')
+    parser.add_argument('--to', dest='end', help='last day of the history')
+    args = parser.parse_args(argv)
+
+    number = int(args.names.pop()) if args.names and args.names[-1].isdigit() else None
+    if number is None:
+        for update in update_all(args.names, args.store_dir, args.data_dir):
+            print(update)
+        return
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    for name in args.names:
+        update_intervals(name, args.store_dir, args.data_dir)
+        intervals = RecordIntervals.load(name, args.data_dir)
+        if args.as_of:
+            print(f'{name} {number} as of {args.as_of}:')
+            print(intervals.as_of(number, args.as_of).to_pandas())
+        else:
+            print(f'{name} {number} changes:')
+            print(intervals.changes(number, args.start, args.end))
+
+
+if __name__ == '__main__':
+    main()
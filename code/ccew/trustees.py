@@ -0,0 +1,463 @@
+"""Find repeat trustees: the same person acting as trustee of several charities.
+
+`trustee_id` already links some appointments of a person across charities,
+but the same person often appears under several ids with slightly different
+names (`Mr John A Smith`, `J A SMITH`, `John Smith OBE`). Ids are linked by
+fuzzy name matching:
+
+- names are normalised once per distinct name (case, titles, honours,
+  punctuation);
+- candidate pairs only come from the same block (surname + first initial),
+  so there is never an all-pairs comparison;
+- pairs are scored in bulk with NumPy on 256-bit character trigram
+  signatures, plus a check that the forenames are compatible;
+- scores are discounted for common names, which are weak evidence that two
+  ids are the same person, and for initials that could stand for several
+  of the forenames in the block;
+- linked ids are grouped into clusters by connected components.
+
+`TrusteeCounts` answers "how many trustees does a charity have?" in a single
+streaming pass over the trustee extract: counts are exact, and quantiles
+come from mergeable sketches with a bounded relative error.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.annual_returns import YEAR_FACTOR
+from ccew.data import sorted_on
+from ccew.extracts import DATA_DIR, ROW_GROUP_SIZE, parquet_path
+from ccew.sketch import ACCURACY, QuantileSketch
+
+TITLES = {
+    'MR', 'MRS', 'MS', 'MISS', 'MX', 'DR', 'PROF', 'PROFESSOR', 'REV', 'REVD',
+    'REVEREND', 'RT', 'HON', 'RIGHT', 'THE', 'VERY', 'CANON', 'FATHER', 'FR',
+    'SISTER', 'BROTHER', 'PASTOR', 'BISHOP', 'RABBI', 'IMAM', 'SIR', 'DAME',
+    'LORD', 'LADY', 'CAPT', 'CAPTAIN', 'MAJOR', 'COL', 'COLONEL', 'CLLR',
+    'COUNCILLOR', 'VEN', 'VENERABLE',
+}
+HONOURS = {
+    'OBE', 'MBE', 'CBE', 'KBE', 'DBE', 'BEM', 'JP', 'DL', 'QC', 'KC', 'MP',
+    'FCA', 'ACA', 'FRCS', 'FRCP', 'PHD', 'BSC', 'MSC', 'JR', 'JNR', 'SNR', 'ESQ',
+}
+
+SIGNATURE_BITS = 256
+NAME_WIDTH = 48
+MAX_BLOCK = 400
+THRESHOLD = 0.75
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def normalise_names(names):
+    """Upper-case names without titles, honours, punctuation or digits."""
+    strip = '|'.join(sorted(TITLES | HONOURS))
+    return (
+        pd.Series(names, dtype='string')
+        .str.upper()
+        .str.replace(r"[^A-Z\s'-]", ' ', regex=True)
+        .str.replace(r"['-]", '', regex=True)
+        .str.replace(rf'\b(?:{strip})\b', ' ', regex=True)
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.strip()
+        .fillna('')
+    )
+
+
+def name_parts(normalised):
+    """Surname, first forename, middle initials and block key of normalised names."""
+    parts = pd.Series(normalised, dtype='string').str.extract(
+        r'^(?:(?P<forename>\S+) )?(?:(?P<middle>.*) )?(?P<surname>\S+)$'
+    ).fillna('')
+    middle = parts['middle'].str.replace(r'(\S)\S*\s*', r'\1', regex=True)
+    return pd.DataFrame({
+        'surname': parts['surname'],
+        'forename': parts['forename'],
+        'middle': middle,
+        'block': parts['surname'] + ' ' + parts['forename'].str[:1],
+    })
+
+
+def trigram_signatures(names, bits=SIGNATURE_BITS, width=NAME_WIDTH):
+    """Bit signatures of the character trigrams of each name, as uint64 words."""
+    padded = np.array([f' {name} ' for name in names], dtype=f'U{width}')
+    codes = padded.view(np.uint32).reshape(len(padded), width).astype(np.uint64)
+    lengths = np.char.str_len(padded)
+    # polynomial hash of each trigram, masked beyond the end of the name
+    hashes = (codes[:, :-2] * 961 + codes[:, 1:-1] * 31 + codes[:, 2:]) % bits
+    valid = np.arange(width - 2)[None, :] < (lengths[:, None] - 2)
+    onehot = np.zeros((len(padded), bits), dtype=bool)
+    rows = np.broadcast_to(np.arange(len(padded))[:, None], hashes.shape)
+    onehot[rows[valid], hashes[valid].astype(np.int64)] = True
+    return np.packbits(onehot, axis=1).view(np.uint64)
+
+
+def _popcount(words):
+    return np.bitwise_count(words).sum(axis=1)
+
+
+def jaccard(signatures, left, right):
+    """Estimated trigram Jaccard similarity of pairs of signatures."""
+    a, b = signatures[left], signatures[right]
+    union = _popcount(a | b)
+    return np.where(union > 0, _popcount(a & b) / np.maximum(union, 1), 0.0)
+
+
+def candidate_pairs(blocks, max_block=MAX_BLOCK, sub_blocks=None):
+    """Index pairs of items sharing a block, generated per block size.
+
+    Blocks larger than `max_block` are split on `sub_blocks` (e.g. the full
+    forename) when given, and skipped otherwise.
+    """
+    codes, _ = pd.factorize(pd.Series(blocks))
+    order = np.argsort(codes, kind='stable')
+    sizes = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    lefts, rights = [], []
+    for size in np.unique(sizes[sizes > 1]):
+        if size > max_block:
+            continue
+        block_starts = starts[sizes == size]
+        i, j = np.triu_indices(size, 1)
+        lefts.append(order[(block_starts[:, None] + i[None, :]).ravel()])
+        rights.append(order[(block_starts[:, None] + j[None, :]).ravel()])
+    if sub_blocks is not None:
+        oversized = np.isin(codes, np.flatnonzero(sizes > max_block))
+        if oversized.any():
+            members = np.flatnonzero(oversized)
+            blocks = pd.Series(blocks).to_numpy()
+            sub = blocks[members] + '|' + pd.Series(sub_blocks).to_numpy()[members]
+            left, right = candidate_pairs(sub, max_block)
+            lefts.append(members[left])
+            rights.append(members[right])
+    if not lefts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def _prefix_compatible(left, right):
+    return (
+        (left == right)
+        | (left == '')
+        | (right == '')
+        | np.char.startswith(left, right)
+        | np.char.startswith(right, left)
+    )
+
+
+def forenames_compatible(left, right, left_middle=None, right_middle=None):
+    """Forenames that can belong to the same person: equal, an initial, or a prefix.
+
+    Middle initials, when given on both sides, must agree the same way.
+    """
+    compatible = _prefix_compatible(np.asarray(left, dtype=str), np.asarray(right, dtype=str))
+    if left_middle is not None:
+        compatible &= _prefix_compatible(
+            np.asarray(left_middle, dtype=str), np.asarray(right_middle, dtype=str)
+        )
+    return compatible
+
+
+def ambiguity(left, right, left_keys, right_keys):
+    """How many different fuller forenames each less complete name could expand to.
+
+    In each pair, the name with the shorter forename key (`J`, `JOHN`) is
+    the less complete one. `J SMITH` compatible with both `JOHN SMITH` and
+    `JAMES SMITH` is ambiguous and should not chain them together. Returns
+    the ambiguity of the less complete name of each pair.
+    """
+    shorter = np.char.str_len(left_keys) <= np.char.str_len(right_keys)
+    less = np.where(shorter, left, right)
+    fuller = np.where(shorter, right_keys, left_keys)
+    expansions = pd.DataFrame({'less': less, 'fuller': fuller}).drop_duplicates()
+    counts = expansions.groupby('less').size()
+    return counts.reindex(less).to_numpy()
+
+
+def connected_components(size, left, right):
+    """Component label (smallest member) of each of `size` nodes linked by edges."""
+    labels = np.arange(size)
+    if not len(left):
+        return labels
+    while True:
+        low = np.minimum(labels[left], labels[right])
+        updated = labels.copy()
+        np.minimum.at(updated, left, low)
+        np.minimum.at(updated, right, low)
+        # pointer jumping to the root of each label
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def link_trustees(df, threshold=THRESHOLD, max_block=MAX_BLOCK):
+    """Cluster trustee ids that look like the same person.
+
+    `df` has `trustee_id`, `trustee_name` and optionally
+    `individual_or_organisation` columns (organisations are left out).
+    Returns one row per trustee id with its normalised `name`, `cluster`
+    (the smallest trustee id of the cluster) and `confidence`: the score of
+    the weakest link joining the id to its cluster, 1 for ids on their own.
+    """
+    people = df
+    if 'individual_or_organisation' in df.columns:
+        people = df.loc[df['individual_or_organisation'].astype(str) != 'O']
+    ids = people[['trustee_id', 'trustee_name']].drop_duplicates('trustee_id')
+    ids = ids.sort_values('trustee_id').reset_index(drop=True)
+
+    # normalise and sign each distinct name once
+    codes, uniques = pd.factorize(ids['trustee_name'].astype(str))
+    name_codes, distinct = pd.factorize(normalise_names(uniques).to_numpy())
+    name_of_id = name_codes[codes]
+    ids['name'] = distinct[name_of_id]
+    parts = name_parts(pd.Series(distinct, dtype='string'))
+    signatures = trigram_signatures(distinct)
+
+    # a name shared by many ids is weak evidence that they are the same person
+    ids_per_name = np.bincount(name_of_id, minlength=len(distinct))
+    specificity = 1 / np.sqrt(np.maximum(ids_per_name - 1, 1))
+
+    # ids with the same name: chain them when the name is specific enough
+    by_name = np.argsort(name_of_id, kind='stable')
+    same = name_of_id[by_name[1:]] == name_of_id[by_name[:-1]]
+    same &= specificity[name_of_id[by_name[1:]]] >= threshold
+    left_ids = [by_name[:-1][same]]
+    right_ids = [by_name[1:][same]]
+    scores = [specificity[name_of_id[by_name[1:]]][same]]
+
+    # ids with different names in the same block: link their first ids
+    left, right = candidate_pairs(parts['block'], max_block, parts['forename'])
+    named = (parts['surname'] != '').to_numpy()
+    left, right = left[named[left]], right[named[left]]
+    forename = parts['forename'].to_numpy(dtype=str)
+    middle = parts['middle'].to_numpy(dtype=str)
+    similarity = jaccard(signatures, left, right)
+    compatible = forenames_compatible(
+        forename[left], forename[right], middle[left], middle[right]
+    )
+    score = np.where(compatible, 0.5 + 0.5 * similarity, similarity)
+    score *= np.minimum(specificity[left], specificity[right])
+    # an initial compatible with several different forenames links none of them
+    keys = np.char.add(np.char.add(forename, ' '), middle)
+    discount = np.ones(len(left))
+    if compatible.any():
+        discount[compatible] = 1 / np.sqrt(ambiguity(
+            left[compatible], right[compatible],
+            keys[left[compatible]], keys[right[compatible]],
+        ))
+    score *= discount
+    keep = score >= threshold
+    _, first = np.unique(name_of_id[by_name], return_index=True)
+    first_id = by_name[first]
+    left_ids.append(first_id[left[keep]])
+    right_ids.append(first_id[right[keep]])
+    scores.append(score[keep])
+
+    left_ids, right_ids = np.concatenate(left_ids), np.concatenate(right_ids)
+    scores = np.concatenate(scores)
+    labels = connected_components(len(ids), left_ids, right_ids)
+    confidence = np.ones(len(ids))
+    np.minimum.at(confidence, left_ids, scores)
+    np.minimum.at(confidence, right_ids, scores)
+    # ids are sorted, so the component label is the row of the smallest id
+    ids['cluster'] = ids['trustee_id'].to_numpy()[labels]
+    ids['confidence'] = confidence
+    return ids[['trustee_id', 'trustee_name', 'name', 'cluster', 'confidence']]
+
+
+def repeat_trustees(df, links=None, threshold=THRESHOLD):
+    """Clusters of trustee ids spanning more than one charity, most charities first.
+
+    Each cluster is named after the name of its smallest trustee id.
+    """
+    if links is None:
+        links = link_trustees(df, threshold)
+    appointments = df[['trustee_id', 'registered_charity_number']].merge(
+        links[['trustee_id', 'cluster']], on='trustee_id'
+    )
+    clusters = appointments.groupby('cluster').agg(
+        trustee_ids=('trustee_id', 'nunique'),
+        charities=('registered_charity_number', 'nunique'),
+    )
+    clusters['name'] = links.set_index('trustee_id')['name'].reindex(clusters.index).to_numpy()
+    clusters['confidence'] = links.groupby('cluster')['confidence'].min()
+    return clusters.loc[clusters['charities'] > 1].sort_values(
+        ['charities', 'confidence'], ascending=False
+    )
+
+
+class TrusteeCounts:
+    """Trustees per charity and per appointment year, accumulated batch by batch.
+
+    Feed it record batches of the trustee extract with `update`, then read
+    the tables. Counts of trustees are exact. Quantiles of the number of
+    trustees per charity come from `QuantileSketch`es, within `accuracy`
+    relative error:
+
+    - overall: trustees per charity;
+    - by appointment year: trustees appointed that year per charity, over
+      the charities that appointed at least one.
+
+    With `sorted=True` the caller declares that batches arrive sorted by
+    charity number (as `ccew.data.sort_extract` leaves the extract): a
+    charity is added to the sketches as soon as a later charity is seen, so
+    only one charity is pending at a time, and a batch out of order raises
+    `ValueError` rather than counting a charity twice. Otherwise every
+    charity stays pending until the tables are read. Counters over disjoint
+    sets of charities can be combined with `merge`.
+    """
+
+    def __init__(self, accuracy=ACCURACY, sorted=False):
+        self.accuracy = accuracy
+        self.sketch = QuantileSketch(accuracy)
+        self.year_sketches = {}
+        self.year_trustees = {}
+        self.charities = []
+        self.sorted = sorted
+        self.last = None
+        # pending counts by (charity number, appointment year, organisation) key
+        self.keys = np.zeros(0, dtype='int64')
+        self.counts = np.zeros(0, dtype='int64')
+
+    def update(self, batch):
+        """Count a record batch or table with the trustee extract columns."""
+        valid = pc.is_valid(batch.column('registered_charity_number'))
+        numbers = batch.column('registered_charity_number').filter(valid).to_numpy()
+        if not len(numbers):
+            return self
+        years = pc.year(batch.column('trustee_date_of_appointment').filter(valid))
+        years = pc.fill_null(years, 0).to_numpy()
+        organisation = pc.equal(batch.column('individual_or_organisation').filter(valid), 'O')
+        organisation = pc.fill_null(organisation, False).to_numpy(zero_copy_only=False)
+        keys = (numbers.astype('int64') * YEAR_FACTOR + years) * 2 + organisation
+        if self.sorted and not (
+            (np.diff(numbers) >= 0).all() and (self.last is None or numbers[0] >= self.last)
+        ):
+            # earlier charities may already be in the sketches
+            raise ValueError('trustee batches are not sorted by charity number')
+        keys, counts = np.unique(keys, return_counts=True)
+        self._add(keys, counts)
+
+        if self.sorted:
+            self.last = numbers[-1]
+            # every charity before the last one of the batch is complete
+            self._flush(self.keys < self.last * YEAR_FACTOR * 2)
+        return self
+
+    def _add(self, keys, counts):
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(
+            inverse, weights=np.concatenate([self.counts, counts]), minlength=len(keys)
+        ).astype('int64')
+        self.keys = keys
+
+    def _flush(self, done):
+        keys, counts = self.keys[done], self.counts[done]
+        self.keys, self.counts = self.keys[~done], self.counts[~done]
+        if not len(keys):
+            return
+        organisation = keys % 2 == 1
+        numbers = keys // 2 // YEAR_FACTOR
+        years = keys // 2 % YEAR_FACTOR
+
+        charities, inverse = np.unique(numbers, return_inverse=True)
+        trustees = np.bincount(inverse, weights=counts).astype('int64')
+        organisations = np.bincount(inverse, weights=counts * organisation).astype('int64')
+        self.charities.append(pd.DataFrame({
+            'registered_charity_number': charities,
+            'trustees': trustees,
+            'individuals': trustees - organisations,
+            'organisations': organisations,
+        }))
+        self.sketch.add(trustees)
+
+        appointed = years > 0
+        pairs, inverse = np.unique(keys[appointed] // 2, return_inverse=True)
+        per_year = np.bincount(inverse, weights=counts[appointed]).astype('int64')
+        order = np.argsort(pairs % YEAR_FACTOR, kind='stable')
+        years, starts = np.unique(pairs[order] % YEAR_FACTOR, return_index=True)
+        for year, values in zip(years.tolist(), np.split(per_year[order], starts[1:])):
+            if year not in self.year_sketches:
+                self.year_sketches[year] = QuantileSketch(self.accuracy)
+                self.year_trustees[year] = 0
+            self.year_sketches[year].add(values)
+            self.year_trustees[year] += int(values.sum())
+
+    def merge(self, other):
+        """Add the counts of a counter over a disjoint set of charities."""
+        self._flush(np.ones(len(self.keys), dtype=bool))
+        other._flush(np.ones(len(other.keys), dtype=bool))
+        self.sketch.merge(other.sketch)
+        for year, sketch in other.year_sketches.items():
+            if year not in self.year_sketches:
+                self.year_sketches[year] = QuantileSketch(self.accuracy)
+                self.year_trustees[year] = 0
+            self.year_sketches[year].merge(sketch)
+            self.year_trustees[year] += other.year_trustees[year]
+        self.charities.extend(other.charities)
+        return self
+
+    def by_charity(self):
+        """Exact trustee counts of each charity with at least one trustee."""
+        self._flush(np.ones(len(self.keys), dtype=bool))
+        if not self.charities:
+            return pd.DataFrame(columns=['trustees', 'individuals', 'organisations'])
+        self.charities = [pd.concat(self.charities, ignore_index=True)]
+        return self.charities[0].set_index('registered_charity_number')
+
+    def summary(self, quantiles=QUANTILES):
+        """Charities, trustees, mean and quantiles of trustees per charity.
+
+        One row for all charities (`'all'`) then one per appointment year.
+        Counts and means are exact. Quantiles are rounded to whole trustees,
+        which makes them exact below `1 / (2 * accuracy)` trustees (50 at
+        the default accuracy) and within the sketch accuracy above.
+        """
+        self._flush(np.ones(len(self.keys), dtype=bool))
+        sketches = {'all': self.sketch, **dict(sorted(self.year_sketches.items()))}
+        rows = []
+        for label, sketch in sketches.items():
+            row = {
+                'charities': len(sketch),
+                'trustees': int(round(sketch.total)),
+                'mean': sketch.mean(),
+            }
+            row.update({
+                f'p{round(q * 100)}': value
+                for q, value in zip(quantiles, np.round(sketch.quantile(quantiles)))
+            })
+            row['max'] = sketch.max
+            rows.append(row)
+        return pd.DataFrame(rows, index=pd.Index(list(sketches), name='appointed'))
+
+    def distribution(self, bins=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16, 21, 31)):
+        """Exact number of charities by number of trustees, grouped in `bins`."""
+        trustees = self.by_charity()['trustees']
+        edges = [*bins, np.inf]
+        labels = [
+            str(low) if high - low == 1 else f'{low}+' if high == np.inf else f'{low}-{high - 1}'
+            for low, high in zip(edges[:-1], edges[1:])
+        ]
+        groups = pd.cut(trustees, edges, right=False, labels=labels)
+        counts = groups.value_counts(sort=False)
+        return pd.DataFrame({'charities': counts, 'share': counts / counts.sum()})
+
+
+def trustee_counts(path=None, batch_size=ROW_GROUP_SIZE, accuracy=ACCURACY, sorted=None):
+    """Stream the converted trustee extract into a `TrusteeCounts`.
+
+    Only the three columns needed are read, one batch at a time. `sorted`
+    defaults to whether the file is declared sorted by charity number, as
+    `ccew.data.sort_extract` writes it.
+    """
+    if path is None:
+        path = parquet_path('charity_trustee', DATA_DIR)
+    if sorted is None:
+        sorted = sorted_on(path)[:1] == ['registered_charity_number']
+    counts = TrusteeCounts(accuracy, sorted)
+    columns = ['registered_charity_number', 'trustee_date_of_appointment', 'individual_or_organisation']
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        counts.update(batch)
+    return counts
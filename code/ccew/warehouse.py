@@ -0,0 +1,230 @@
+"""Warehouse of every extract as uncompressed Arrow IPC files, opened by memory mapping.
+
+Each extract is materialised once into `data/warehouse/<extract>.arrow`
+from its converted Parquet file, or straight from the archived zip if it
+was not converted (or the zip is newer), with:
+
+- the dtypes of `ccew.extracts.SCHEMAS` (millisecond timestamps, int64
+  numbers), string columns of `ccew.data.CATEGORY_COLUMNS` dictionary
+  encoded, whitespace stripped;
+- the shared charity key: `registered_charity_number`, a
+  `linked_charity_number` that is 0 for main charities (added to the
+  extracts that have none) and `charity_code`, the code of the number in
+  the dictionary shared with `ccew.data`;
+- rows sorted on the charity key, in a single record batch.
+
+Opening a table maps the file instead of reading it: the columns are views
+of the page cache, so it takes milliseconds whatever the table's size, and
+processes opening the same table share its memory.
+
+    python -m ccew.warehouse                  # build or refresh every table
+    table = open_table('charity_trustee', columns=['registered_charity_number', 'trustee_name'])
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ccew.data import CATEGORY_COLUMNS, CharityNumbers, strip_dictionary
+from ccew.extracts import (
+    ARCHIVE_DIR,
+    DATA_DIR,
+    EXTRACTS,
+    ROW_GROUP_SIZE,
+    SCHEMAS,
+    extract_path,
+    iter_batches,
+    parquet_path,
+)
+
+WAREHOUSE_DIR = 'warehouse'
+MANIFEST_FILE = 'manifest.json'
+KEY = ['registered_charity_number', 'linked_charity_number']
+CODE_COLUMN = 'charity_code'
+
+
+def table_path(name, data_dir=DATA_DIR):
+    """Path of the warehouse table of extract `name`."""
+    return Path(data_dir) / WAREHOUSE_DIR / f'{name}.arrow'
+
+
+def source_path(name, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR):
+    """Newest of the converted Parquet file and the archived zip of an extract, or None."""
+    paths = [
+        path for path in (parquet_path(name, data_dir), extract_path(name, archive_dir))
+        if path.exists()
+    ]
+    # the Parquet file wins a tie: it is faster to read
+    return max(paths, key=lambda path: path.stat().st_mtime_ns, default=None)
+
+
+def iter_source(path, batch_size=ROW_GROUP_SIZE):
+    """Record batches of a converted Parquet file or of an archived zip."""
+    path = Path(path)
+    if path.suffix == '.parquet':
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+    else:
+        yield from iter_batches(path, batch_size=batch_size)
+
+
+def read_source(path):
+    """Arrow table of a converted Parquet file or of an archived zip."""
+    if Path(path).suffix == '.parquet':
+        return pq.read_table(path)
+    return pa.Table.from_batches(list(iter_batches(path)))
+
+
+def conform(table, name, numbers):
+    """An extract's table with the warehouse dtypes, charity key and order."""
+    schema = SCHEMAS.get(name)
+    if schema is not None:
+        table = table.select([f.name for f in schema if f.name in table.column_names])
+        table = table.cast(pa.schema([f for f in schema if f.name in table.column_names]))
+    table = table.filter(pc.is_valid(table['registered_charity_number']))
+    linked = (
+        pc.fill_null(table['linked_charity_number'], 0)
+        if 'linked_charity_number' in table.column_names
+        else pa.array(np.zeros(table.num_rows, dtype='int64'))
+    )
+    table = table.drop_columns(
+        [c for c in ['linked_charity_number', CODE_COLUMN] if c in table.column_names]
+    )
+    table = table.add_column(
+        table.column_names.index('registered_charity_number') + 1, 'linked_charity_number', linked
+    )
+    table = table.sort_by([(key, 'ascending') for key in KEY]).combine_chunks()
+
+    codes = numbers.encode(table['registered_charity_number'].to_numpy()).codes.astype('int32')
+    table = table.add_column(0, CODE_COLUMN, pa.array(codes))
+    for column in CATEGORY_COLUMNS.get(name, []):
+        if column in table.column_names:
+            i = table.column_names.index(column)
+            table = table.set_column(i, column, strip_dictionary(table[column]))
+    return table
+
+
+def _write(table, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    # uncompressed, so that the columns can be mapped rather than decoded
+    with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+    tmp_path.replace(path)
+
+
+def is_current(name, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR):
+    """Whether the warehouse table of an extract is newer than its source."""
+    path, source = table_path(name, data_dir), source_path(name, archive_dir, data_dir)
+    return path.exists() and (
+        source is None or path.stat().st_mtime_ns >= source.stat().st_mtime_ns
+    )
+
+
+def build_table(name, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR, numbers=None):
+    """Materialise an extract into the warehouse; returns its number of rows.
+
+    New charity numbers are added to `numbers` (by default the stored
+    dictionary), which the caller saves.
+    """
+    source = source_path(name, archive_dir, data_dir)
+    if source is None:
+        raise FileNotFoundError(f'no converted or archived extract {name!r}')
+    if numbers is None:
+        numbers = CharityNumbers.load(data_dir)
+    table = conform(read_source(source), name, numbers)
+    _write(table, table_path(name, data_dir))
+    return table.num_rows
+
+
+def load_manifest(data_dir=DATA_DIR):
+    """Rows, columns and source of each warehouse table."""
+    path = Path(data_dir) / WAREHOUSE_DIR / MANIFEST_FILE
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def build_warehouse(names=EXTRACTS, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR, force=False):
+    """Build or refresh the warehouse tables of `names`, skipping missing extracts.
+
+    Returns the extracts that were (re)built and their number of rows.
+    """
+    numbers = CharityNumbers.load(data_dir)
+    manifest = load_manifest(data_dir)
+    built = {}
+    for name in names:
+        source = source_path(name, archive_dir, data_dir)
+        if source is None or (not force and is_current(name, archive_dir, data_dir)):
+            continue
+        built[name] = build_table(name, archive_dir, data_dir, numbers)
+        schema = pa.ipc.open_file(pa.memory_map(str(table_path(name, data_dir)))).schema
+        manifest[name] = {
+            'rows': built[name],
+            'columns': {field.name: str(field.type) for field in schema},
+            'source': source.name,
+            'built_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        }
+    if built:
+        numbers.save(data_dir)
+        path = Path(data_dir) / WAREHOUSE_DIR / MANIFEST_FILE
+        path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    return built
+
+
+def open_table(name, columns=None, data_dir=DATA_DIR):
+    """Memory-mapped warehouse table of an extract, without copying its data."""
+    path = table_path(name, data_dir)
+    if not path.exists():
+        raise FileNotFoundError(f'{path} not built: run python -m ccew.warehouse {name}')
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    return table if columns is None else table.select(columns)
+
+
+def warehouse_table(name, columns=None, archive_dir=ARCHIVE_DIR, data_dir=DATA_DIR):
+    """`open_table`, building or refreshing the table first if its source changed."""
+    if not is_current(name, archive_dir, data_dir):
+        build_warehouse([name], archive_dir, data_dir, force=True)
+    return open_table(name, columns, data_dir)
+
+
+def charity_slice(table, number):
+    """Rows of a warehouse table for one registered charity number, as a zero-copy slice."""
+    column = table['registered_charity_number']
+    if column.num_chunks == 0:
+        return table.slice(0, 0)
+    # tables are written as one record batch; others are searched after combining theirs
+    numbers = (column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()).to_numpy()
+    lo, hi = np.searchsorted(numbers, [number, number + 1])
+    return table.slice(lo, hi - lo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=EXTRACTS, help='extracts to materialise')
+    parser.add_argument('--archive-dir', type=Path, default=ARCHIVE_DIR)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--force', action='store_true', help='rebuild tables that are current')
+    args = parser.parse_args(argv)
+
+    built = build_warehouse(args.names, args.archive_dir, args.data_dir, args.force)
+    manifest = load_manifest(args.data_dir)
+    for name in args.names:
+        if name not in manifest:
+            print(f'{name}: no extract')
+            continue
+        start = time.perf_counter()
+        table = open_table(name, data_dir=args.data_dir)
+        status = 'built' if name in built else 'current'
+        print(
+            f'{name}: {status}, {table.num_rows} rows, {table.num_columns} columns, '
+            f'opened in {(time.perf_counter() - start) * 1000:.1f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,7 @@
 # - [x] evolution of number of mergers per year
 # - [x] what are the annual returns of the transferee before/after the merger?
 # - [x] what's the size of transferors/transferees in terms of annual return?
-# - [ ] what is the median number of trustees per charity?
+# - [x] what is the median number of trustees per charity?
 # - [ ] who are "repeat trustees"?
 
 # %% [markdown]
@@ -41,15 +41,31 @@
 # ## Imports
 # %%
 import altair as alt
-import dataframe_image as dfi
 import json
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import warnings
+
+from ccew.annual_returns import FinancialPeriodIndex
+from ccew.data import load_trustees
+from ccew.effects import effect_panel
+from ccew.graph import MergerGraph
+from ccew.mergers import (
+    annual_returns, frequent_charities, merged_annual_returns, merger_effects, merger_frequencies,
+    mergers_per_year,
+)
+from ccew.numbers import charity_number_label, extract_charity_numbers
+from ccew.render import Renderer
+from ccew.resolve import resolve_charities
+from ccew.search import name_index
+from ccew.trustees import link_trustees, repeat_trustees, trustee_counts
 # %%
 warnings.filterwarnings('ignore')
 
+# charts and tables are queued here and rendered together at the end of the analysis
+renderer = Renderer('../charts')
+
 # %% [markdown]
 # ## Register of merged charities
 
@@ -145,7 +161,7 @@ chart = (
     .properties(title='Year of transfer vs registration')
 )
 
-chart.save('../charts/transfer_vs_registration_year.png')
+renderer.chart(chart, 'transfer_vs_registration_year')
 
 chart
 
@@ -166,7 +182,7 @@ chart = (
     .properties(title='Count of transfers and registrations by year')
 )
 
-chart.save('../charts/count_transfer_registration_year.png')
+renderer.chart(chart, 'count_transfer_registration_year')
 
 chart
 
@@ -195,7 +211,7 @@ chart = (
     .properties(title='Patterns of number of years between transfer and registration')
 )
 
-chart.save('../charts/diff_transfer_registration_year.png')
+renderer.chart(chart, 'diff_transfer_registration_year')
 
 chart
 
@@ -232,7 +248,7 @@ chart = (
     .properties(title='Count of transfers and registrations by year (after 2007)')
 )
 
-chart.save('../charts/count_transfer_registration_year_trimmed.png')
+renderer.chart(chart, 'count_transfer_registration_year_trimmed')
 
 chart
 
@@ -261,7 +277,7 @@ chart = (
     .properties(title='Patterns of number of years between transfer and registration (after 2007)')
 )
 
-chart.save('../charts/diff_transfer_registration_year_trimmed.png')
+renderer.chart(chart, 'diff_transfer_registration_year_trimmed')
 
 chart
 
@@ -277,94 +293,65 @@ df['transferor'].sample(10, random_state=42).str[-35:]
 df['transferor'].str.extract(r'\(\d+(\D)\d+\)$').dropna()[0].unique()
 
 # %%
-# create charity number cols by extracting contents of last group in parentheses
-# and filling any null values with any string of 5+ digits contained in the string
-df['transferor_number'] = df['transferor'].str.lower().str.extract(
-    pat=r'\(([^\(]+?)\)$'
-)
-df['transferor_number'] = df['transferor_number'].str.replace(pat=r'[\-\.\/]', repl='-')
-df['transferor_number'] = df['transferor_number'].combine_first(
-    df['transferor'].str.extract(pat=r'(\d{5,})')[0]
-)
+# extract charity numbers, subsidiary suffixes and statuses from both cols in one pass:
+# the last group in parentheses, or any string of 5+ digits contained in the string
+numbers = extract_charity_numbers(df, ['transferor', 'transferee'])
 
-df['transferee_number'] = df['transferee'].str.lower().str.extract(
-    pat=r'\(([^\(]+?)\)$'
-)
-df['transferee_number'] = df['transferee_number'].str.replace(pat=r'[\-\.\/]', repl='-')
-df['transferee_number'] = df['transferee_number'].combine_first(
-    df['transferee'].str.extract(pat=r'(\d{5,})')[0]
-)
+df['transferor_number'] = charity_number_label(numbers, 'transferor')
+df['transferee_number'] = charity_number_label(numbers, 'transferee')
+
+numbers.head()
 
 # %%
 # list values that are not charity numbers
-no_charity_number_transferors = df['transferor_number'].loc[
-    df['transferor_number'].apply(str).str.contains(r'[a-zA-Z]')
-].value_counts().to_frame()
-
-dfi.export(
-    no_charity_number_transferors,
-    '../charts/no_charity_number_transferors.png',
-    table_conversion='selenium'
-)
+no_charity_number_transferors = numbers['transferor_note'].value_counts().rename_axis(
+    'transferor_number'
+).to_frame()
+
+renderer.table(no_charity_number_transferors, 'no_charity_number_transferors')
 
 no_charity_number_transferors
 
 # %%
-# standardise values that are not charity numbers
-df['transferor_number'] = df['transferor_number'].replace(
-    to_replace={
-        'unregistered .*': 'unregistered',
-        'exempt.*': 'exempt',
-        '.*excepted.*': 'excepted',
-        'unincorporated .*': 'unincorporated',
-        'not registered': 'unregistered',
-    },
-    regex=True,
-).replace(
-    to_replace={
-        value: 'other' for value in [
-            'unrestricted assets only', 
-            'formerly known as mount zion evangelical church',
-            'herne bay branch',
-            'bottley',
-            'mrs m gee trust',
-        ]
-    }
-)
-
-df['transferor_number'].loc[
-    ~df['transferor_number'].apply(str).str.contains(r'\d')
-].value_counts()
+# standardised values that are not charity numbers
+df['transferor_number'].loc[numbers['transferor_number'].isna()].value_counts()
 
 # %%
 # list values that are not charity numbers
-no_charity_number_transferees = df['transferee_number'].loc[
-    df['transferee_number'].apply(str).str.contains(r'[a-zA-Z]')
-].value_counts().to_frame()
-
-dfi.export(
-    no_charity_number_transferees,
-    '../charts/no_charity_number_transferees.png',
-    table_conversion='selenium'
-)
+no_charity_number_transferees = numbers['transferee_note'].value_counts().rename_axis(
+    'transferee_number'
+).to_frame()
+
+renderer.table(no_charity_number_transferees, 'no_charity_number_transferees')
 
 no_charity_number_transferees
 
 # %%
-# standardise values that are not charity numbers
-df['transferee_number'] = df['transferee_number'].replace(
-    to_replace={
-        'exempt.*': 'exempt',
-        'incorporating the merrett bequest': 'other',
-        'cio': 'other',
-        'picpus': 'other',
-    },
-    regex=True,
-)
+# standardised values that are not charity numbers
+df['transferee_number'].loc[numbers['transferee_number'].isna()].value_counts()
+
+# %%
+# registered charity of each transferor and transferee: the charity number given,
+# if registered, else the closest of the register's names and their other names
+charity_names = name_index()
 
-df['transferee_number'].loc[
-    df['transferee_number'].apply(str).str.contains(r'[a-zA-Z]')
-].value_counts()
+resolved = resolve_charities(df, charity_names)
+
+resolved.loc[resolved['transferor_resolution'] == 'name'].head()
+
+# %%
+# how the charities were resolved, as a share of the mergers
+pd.DataFrame({
+    role: resolved[f'{role}_resolution'].value_counts(normalize=True, dropna=False)
+    for role in ('transferor', 'transferee')
+})
+
+# %%
+# charity numbers given whose registered names differ most from the name in the register
+resolved.loc[
+    resolved['transferee_resolution'] == 'number',
+    ['transferee_resolved', 'transferee_resolved_name', 'transferee_confidence']
+].join(df['transferee']).sort_values('transferee_confidence').head()
 
 # %% [markdown]
 # Charity numbers are generally indicated in the data files as a series of digits between parentheses at the end of the charity name: for example, `Crisis UK (1082947)`.
@@ -438,6 +425,12 @@ duplicate_names_transferors = df.set_index('transferor_number').loc[
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # ### Number of mergers over time
 
+# %%
+# transfers between registered charities, and every party's rows of the register by label
+graph = MergerGraph.from_frame(df)
+
+graph
+
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### Most frequent transferors
 
@@ -447,11 +440,7 @@ registered_vs_unregistered_transferors = df['transferor_number'].apply(
     lambda x: 'exempt/unregistered/similar' if str(x).isalpha() else 'registered'
 ).value_counts().to_frame()
 
-dfi.export(
-    registered_vs_unregistered_transferors,
-    '../charts/registered_vs_unregistered_transferors.png',
-    table_conversion='selenium',
-)
+renderer.table(registered_vs_unregistered_transferors, 'registered_vs_unregistered_transferors')
 
 registered_vs_unregistered_transferors
 
@@ -474,24 +463,9 @@ registered_vs_unregistered_transferors
 
 # %%
 # frequencies of merger events for individual transferors
-transferor_freqs = (
-    df['transferor_number']
-    .value_counts()
-    .value_counts()
-    .reset_index(name='freqs')
-)
-
-transferor_freqs = transferor_freqs.sort_values(by='count')
+transferor_freqs = merger_frequencies(df, 'transferor')
 
-transferor_freqs.columns = ['count_of_mergers', 'frequency']
-
-transferor_freqs = transferor_freqs.set_index('count_of_mergers', drop=True)
-
-dfi.export(
-    transferor_freqs,
-    '../charts/transferor_freqs.png',
-    table_conversion='selenium',
-)
+renderer.table(transferor_freqs, 'transferor_freqs')
 
 transferor_freqs
 
@@ -510,15 +484,7 @@ transferor_freqs
 
 # %%
 # frequent transferors
-frequent_transferors = df[
-    ['transferor_number', 'transferor']
-].value_counts().to_frame().reset_index().sort_values(
-    ['transferor_number', 'count'], ascending=False
-).groupby(
-    'transferor_number', as_index=False
-).agg(
-    {'transferor': 'first', 'count':'sum'}
-).sort_values('count', ascending=False).reset_index(drop=True)
+frequent_transferors = frequent_charities(df, 'transferor')
 
 frequent_transferors
 
@@ -529,11 +495,7 @@ most_frequent_transferors = df.loc[
     'transferor_number'
 ].value_counts().to_frame()[:10]
 
-dfi.export(
-    most_frequent_transferors,
-    '../charts/most_frequent_transferors.png',
-    table_conversion='selenium',
-)
+renderer.table(most_frequent_transferors, 'most_frequent_transferors')
 
 most_frequent_transferors
 
@@ -542,18 +504,13 @@ most_frequent_transferors
 
 # %%
 # mergers of most frequent transferor
-consolidation_merger = df.loc[
-    df['transferor'].str.contains('1053467'),
-    ['transferor', 'transferee']
-].head()
+consolidation_merger = df.iloc[
+    graph.mergers('1053467', 'transferor')
+][['transferor', 'transferee']].head()
 
 consolidation_merger = consolidation_merger.set_index('transferor', drop=True)
 
-dfi.export(
-    consolidation_merger,
-    '../charts/consolidation_merger.png',
-    table_conversion='selenium',
-)
+renderer.table(consolidation_merger, 'consolidation_merger')
 
 consolidation_merger
 
@@ -568,15 +525,11 @@ df['transferor'].value_counts()[:10].to_frame()
 
 # %%
 # mergers of second most frequent transferor
-reverse_merger = df.loc[
-    df['transferor_number'] == '1189059'
+reverse_merger = df.iloc[
+    graph.mergers('1189059', 'transferor')
 ].set_index('transferee', drop=True)['transferor'].to_frame()
 
-dfi.export(
-    reverse_merger,
-    '../charts/reverse_merger.png',
-    table_conversion='selenium',
-)
+renderer.table(reverse_merger, 'reverse_merger')
 
 reverse_merger
 
@@ -587,6 +540,10 @@ reverse_merger
 #
 # While this seems to be a reverse merger, it could also be the parent charity distributing some assets to children charities.
 
+# %%
+# charities that received its funds, directly or through later mergers
+graph.descendants('1189059')
+
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### Most frequent transferees
 
@@ -596,11 +553,7 @@ registered_vs_unregistered_transferees = df['transferee_number'].apply(
     lambda x: 'exempt/unregistered/similar' if str(x).isalpha() else 'registered'
 ).value_counts().to_frame()
 
-dfi.export(
-    registered_vs_unregistered_transferees,
-    '../charts/registered_vs_unregistered_transferees.png',
-    table_conversion='selenium',
-)
+renderer.table(registered_vs_unregistered_transferees, 'registered_vs_unregistered_transferees')
 
 registered_vs_unregistered_transferees
 
@@ -613,15 +566,7 @@ df['transferee_number'].value_counts()[:10]
 
 # %%
 # frequent transferees
-frequent_transferees = df[
-    ['transferee_number', 'transferee']
-].value_counts().to_frame().reset_index().sort_values(
-    ['transferee_number', 'count'], ascending=False
-).groupby(
-    'transferee_number', as_index=False
-).agg(
-    {'transferee': 'first', 'count':'sum'}
-).sort_values('count', ascending=False).reset_index(drop=True)
+frequent_transferees = frequent_charities(df, 'transferee')
 
 frequent_transferees
 
@@ -631,11 +576,7 @@ most_frequent_transferees = frequent_transferees.drop(
     columns='transferee_number'
 ).set_index('transferee').sort_values('count',ascending=False)[:10]
 
-dfi.export(
-    most_frequent_transferees,
-    '../charts/most_frequent_transferees.png',
-    table_conversion='selenium',
-)
+renderer.table(most_frequent_transferees, 'most_frequent_transferees')
 
 most_frequent_transferees
 
@@ -644,24 +585,9 @@ most_frequent_transferees
 
 # %%
 # frequencies of merger events for individual transferees
-transferee_freqs = (
-    df['transferee_number']
-    .value_counts()
-    .value_counts()
-    .reset_index(name='freqs')
-)
-
-transferee_freqs = transferee_freqs.sort_values(by='count')
-
-transferee_freqs.columns = ['count_of_mergers', 'frequency']
+transferee_freqs = merger_frequencies(df, 'transferee')
 
-transferee_freqs = transferee_freqs.set_index('count_of_mergers', drop=True)
-
-dfi.export(
-    transferee_freqs,
-    '../charts/transferee_freqs.png',
-    table_conversion='selenium',
-)
+renderer.table(transferee_freqs, 'transferee_freqs')
 
 transferee_freqs
 
@@ -676,16 +602,11 @@ alt.Chart(transferee_freqs.reset_index()).mark_bar().encode(
 
 # %%
 # mergers of most frequent transferee
-consolidation_merger_kingdom_hall_trust = df.loc[
-    df['transferee'].str.contains('Kingdom Hall Trust'),
-    ['transferee', 'transferor']
-].head()
-
-dfi.export(
-    consolidation_merger_kingdom_hall_trust,
-    '../charts/consolidation_merger_kingdom_hall_trust.png',
-    table_conversion='selenium',
-)
+consolidation_merger_kingdom_hall_trust = df.iloc[
+    graph.mergers('275946', 'transferee')
+][['transferee', 'transferor']].head()
+
+renderer.table(consolidation_merger_kingdom_hall_trust, 'consolidation_merger_kingdom_hall_trust')
 
 consolidation_merger_kingdom_hall_trust = consolidation_merger_kingdom_hall_trust.set_index(
     'transferee', drop=True
@@ -695,16 +616,13 @@ consolidation_merger_kingdom_hall_trust
 
 # %%
 # mergers of second most frequent transferee
-consolidation_merger_victim_support = df.loc[
-    df['transferee'].str.contains('Victim Support'),
-    ['transferee', 'transferor']
-].head()
-
-dfi.export(
-    consolidation_merger_victim_support,
-    '../charts/consolidation_merger_victim_support.png',
-    table_conversion='selenium',
-)
+victim_support = charity_names.best('Victim Support')[0]
+
+consolidation_merger_victim_support = df.iloc[
+    graph.mergers(victim_support, 'transferee')
+][['transferee', 'transferor']].head()
+
+renderer.table(consolidation_merger_victim_support, 'consolidation_merger_victim_support')
 
 consolidation_merger_victim_support = consolidation_merger_victim_support.set_index(
     'transferee', drop=True
@@ -715,6 +633,16 @@ consolidation_merger_victim_support
 # %% [markdown]
 # Both Kingdom Hall Trust and Victim Support (and other frequent transferees) seem to be consolidation mergers.
 
+# %%
+# largest groups of charities linked by mergers, by their smallest charity number
+graph.cluster_sizes().head(10).to_frame()
+
+# %%
+# charities that received funds and passed them on: A -> B, then B -> C
+consolidation_chains = graph.chains()
+
+consolidation_chains.head()
+
 # %% [markdown]
 # Summary from a [Brave](https://search.brave.com/search?q=The+Kingdom+Hall+Trust+&summary=1) search:
 #
@@ -728,11 +656,7 @@ consolidation_merger_victim_support
 
 # %%
 # merger counts by year
-merger_counts = df.groupby(
-    df['date_transferred'].dt.year, as_index=True
-)['date_transferred'].count()
-
-merger_counts = merger_counts.to_frame('count').reset_index()
+merger_counts = mergers_per_year(df)
 
 merger_counts.T
 
@@ -752,17 +676,13 @@ chart = (
     )
 )
 
-chart.save('../charts/merger_counts.png')
+renderer.chart(chart, 'merger_counts')
 
 chart
 
 # %%
-# merger counts by year
-merger_counts_unique = df.drop_duplicates(subset=['transferee', 'date_transferred']).groupby(
-    df['date_transferred'].dt.year, as_index=True
-)['date_transferred'].count()
-
-merger_counts_unique = merger_counts_unique.to_frame('count').reset_index()
+# merger counts by year, counting consolidations as 1 merger
+merger_counts_unique = mergers_per_year(df, unique=True)
 
 merger_counts_unique.T
 
@@ -782,7 +702,7 @@ chart = (
     )
 )
 
-chart.save('../charts/merger_counts_unique.png')
+renderer.chart(chart, 'merger_counts_unique')
 
 chart
 
@@ -793,20 +713,18 @@ chart
 # #### Load data
 
 # %%
-# # load annual return data
-# with open(
-#     '../data/publicextract.charity_annual_return_history.json',
-#     'r',
-#     encoding='utf-8-sig',
-# ) as file:
-#     data = json.load(file)
+# # convert archived annual return data to parquet
+# from ccew.extracts import convert_extract, extract_path
 
-# df_ar = pd.DataFrame(data)
-
-# df_ar.to_parquet('../data/publicextract.charity_annual_return_history.parquet')
+# convert_extract(extract_path('charity_annual_return_history'))
 
 # %%
-df_ar = pd.read_parquet('../data/publicextract.charity_annual_return_history.parquet')
+# read only the cols used, for financial periods starting from 2007 and
+# charities in the register of merged charities
+df_ar = annual_returns(
+    pd.concat([numbers['transferor_number'], numbers['transferee_number']]),
+    first_year=2007,
+)
 
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### Cols
@@ -814,36 +732,12 @@ df_ar = pd.read_parquet('../data/publicextract.charity_annual_return_history.par
 # %%
 df_ar.head()
 
-# %%
-# select cols
-df_ar = df_ar[[
-    'registered_charity_number',
-    'fin_period_start_date',
-    'fin_period_end_date',
-    'total_gross_income',
-    'total_gross_expenditure',
-]]
-
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### `dtypes`
 
 # %%
 df_ar.dtypes
 
-# %%
-# convert date cols to datetime
-date_cols = [
-    'fin_period_start_date',
-    'fin_period_end_date',
-]
-
-df_ar[date_cols] = df_ar[date_cols].apply(pd.to_datetime)
-
-df_ar.head()
-
-# %%
-df_ar.dtypes
-
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### Date cols
 
@@ -860,125 +754,52 @@ df_ar.head()
 # %%
 # extract merger years
 df['merger_year'] = df['date_transferred'].dt.year
-df['merger_year_next'] = df['merger_year'].apply(lambda x: x + 1)
 
 df.head()
 
 # %%
-# convert charity number to string
-df_ar['registered_charity_number'] = df_ar['registered_charity_number'].apply(str).apply(str.strip)
+# income and expenditure of both parties over the 3 financial periods before and after
+# each merger, and their changes; pro forma: transferee after vs all parties before
+effects = effect_panel(df, FinancialPeriodIndex.from_frame(df_ar), pre=3, post=3)
+
+effects.filter(regex='_(change|log_ratio|cagr)$').median().to_frame('median')
 
 # %%
 # drop cols
-df_ar = df_ar.drop(columns=[
-    'fin_period_start_date',
-    'fin_period_end_date',
-    'total_gross_expenditure',
-])
-
-# %%
-# annual return of transferees
-df_merged_transferee = df.drop(
-    columns=['date_registered', 'registered-transfer']
-).merge(
-    df_ar,
-    left_on=['transferee_number', 'merger_year'],
-    right_on=['registered_charity_number', 'fin_start_year'],
-    how='left'
-).merge(
-    df_ar,
-    left_on=['transferee_number', 'merger_year_next'],
-    right_on=['registered_charity_number', 'fin_start_year'],
-    how='left',
-    suffixes=['_current', '_next']    
-)
+df_ar = df_ar.drop(columns='total_gross_expenditure')
+
+# %% [markdown]
+# Financial periods often don't start in January, so matching the merger year to the year the financial period starts in misses many annual returns.
+#
+# Instead, each transfer is matched to the financial period containing the transfer date (`current`) and to the following one (`next`).
+
+# %%
+# annual return of transferees in the financial period of the merger and the next
+df_merged_transferee = merged_annual_returns(df, df_ar, 'transferee')
 
 df_merged_transferee.head()
 
 # %%
-# annual return of transferors
-df_merged_transferor = df.drop(
-    columns=['date_registered', 'registered-transfer']
-).merge(
-    df_ar,
-    left_on=['transferor_number', 'merger_year'],
-    right_on=['registered_charity_number', 'fin_start_year'],
-    how='left'
-).merge(
-    df_ar,
-    left_on=['transferor_number', 'merger_year_next'],
-    right_on=['registered_charity_number', 'fin_start_year'],
-    how='left',
-    suffixes=['_current', '_next']
-)
+# annual return of transferors in the financial period of the merger and the next
+df_merged_transferor = merged_annual_returns(df, df_ar, 'transferor')
 
 df_merged_transferor.head()
 
 # %%
-df_merged_transferee.loc[df_merged_transferee['transferee_number'].str.contains('275946')]
+df_merged_transferee.iloc[graph.mergers('275946', 'transferee')]
 
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # #### Effect
 
 # %%
-# drop null income values
-df_merged_transferee = df_merged_transferee.dropna(
-    subset=['total_gross_income_current', 'total_gross_income_next'],
-    how='all'
-)
-
-# %%
-# fill empty incomes with 0
-df_merged_transferee[
-    ['total_gross_income_current', 'total_gross_income_next']
-] = df_merged_transferee[
-    ['total_gross_income_current', 'total_gross_income_next']
-].fillna(0)
-
-# %%
-# annual return change from year N to N+1
-df_merged_transferee['effect'] = (
-    (
-        df_merged_transferee['total_gross_income_next']
-        - df_merged_transferee['total_gross_income_current']
-    )
-    / df_merged_transferee['total_gross_income_current']
-    * 100
-)
-
-# %%
-# replace incomes appearing or disappearing by +/-100
-df_merged_transferee['effect'] = df_merged_transferee['effect'].replace([-np.inf, np.inf], [-100, 100])
-
-# %%
-# drop null income values
-df_merged_transferor = df_merged_transferor.dropna(
-    subset=['total_gross_income_current', 'total_gross_income_next'],
-    how='all'
-)
+# annual return change from year N to N+1, dropping mergers with no income in either
+# and counting incomes appearing or disappearing as +/-100
+df_merged_transferee = merger_effects(df_merged_transferee)
 
 # %%
-# fill empty incomes with 0
-df_merged_transferor[
-    ['total_gross_income_current', 'total_gross_income_next']
-] = df_merged_transferor[
-    ['total_gross_income_current', 'total_gross_income_next']
-].fillna(0)
-
-# %%
-# annual return change from year N to N+1
-df_merged_transferor['effect'] = (
-    (
-        df_merged_transferor['total_gross_income_next']
-        - df_merged_transferor['total_gross_income_current']
-    )
-    / df_merged_transferor['total_gross_income_current']
-    * 100
-)
-
-# %%
-# replace incomes appearing or disappearing by +/-100
-df_merged_transferor['effect'] = df_merged_transferor['effect'].replace([-np.inf, np.inf], [-100, 100])
+# annual return change from year N to N+1, dropping mergers with no income in either
+# and counting incomes appearing or disappearing as +/-100
+df_merged_transferor = merger_effects(df_merged_transferor)
 
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # ### Effect of mergers on annual return
@@ -1007,7 +828,7 @@ new_charities = new_charities.shape[0] / df_merged_transferee.shape[0]
 print(f'{new_charities:.0%} of mergers result in the creation of new charities')
 
 # %% [markdown]
-# 11% of mergers result in the creation of new charities.
+# The cell above prints the share of mergers that result in the creation of new charities, with transfers matched to the financial period containing the transfer date. When periods were matched by the calendar year they start in, it was 11%.
 #
 # As indicated by the number of unregistered organisations or organisations with an annual return of 0 before merger, and >0 after merger.
 
@@ -1043,7 +864,7 @@ chart = (
     title='Effect of mergers on annual return of transferees'
 )
 
-chart.save('../charts/effect_transferees.png')
+renderer.chart(chart, 'effect_transferees')
 
 chart
 
@@ -1078,7 +899,7 @@ chart = (
     title='Effect of mergers on annual return of transferors'
 )
 
-chart.save('../charts/effect_transferors.png')
+renderer.chart(chart, 'effect_transferors')
 
 chart
 
@@ -1087,6 +908,14 @@ chart
 #
 # This indicates that most transferors either merge into the transferee and cease to exist as an entity (effect -100%), or their merger is largely inconsequential in terms of annual return. However, some transferors declare their first annual return after the merger (effect +100%), which raises questions about the analysis, but a domain expert might be able to explain this. 
 
+# %% [markdown]
+# ### Render charts
+#
+# Renders the queued charts and tables to `../charts` in parallel, without a browser. Outputs whose chart spec or table data have not changed since the last run are skipped.
+
+# %%
+renderer.render()
+
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
 # ## Trustees (draft)
 
@@ -1100,62 +929,69 @@ chart
 # #### Load data
 
 # %%
-# # load trustee data
-# with open(
-#     '../data/publicextract.charity_trustee.json',
-#     'r',
-#     encoding='utf-8-sig',
-# ) as file:
-#     data = json.load(file)
+# # convert archived trustee data to parquet
+# from ccew.extracts import convert_extract, extract_path
 
-# df = pd.DataFrame(data)
-
-# df.to_parquet('../data/publicextract.charity_trustee.parquet')
+# convert_extract(extract_path('charity_trustee'))
 
 # %%
-df = pd.read_parquet('../data/publicextract.charity_trustee.parquet')
+# names and charity numbers are loaded as categoricals, dates as datetimes
+df_trustees = load_trustees()
 
 # %% [markdown]
 # #### Cols
 
 # %%
-df.head()
+df_trustees.head()
 
 # %%
 # drop cols
-df = df.drop(columns='date_of_extract')
+df_trustees = df_trustees.drop(columns='date_of_extract')
 
 # %% [markdown]
 # #### `dtypes`
 
 # %%
-df.dtypes
+df_trustees.dtypes
 
 # %%
-# convert date cols to datetime
-df['trustee_date_of_appointment'] = df['trustee_date_of_appointment'].apply(pd.to_datetime)
+df_trustees['individual_or_organisation'].unique()
 
 # %%
-# convert str col to string
-df['trustee_name'] = df['trustee_name'].apply(str)
+df_trustees['trustee_id'].value_counts()[:15]
 
 # %%
-df['individual_or_organisation'].unique()
+repeat_trustees_ids = df_trustees['trustee_id'].value_counts()[:15].index
 
-# %%
-# convert str col to string
-df['individual_or_organisation'] = df['individual_or_organisation'].apply(str)
+# observed=True to count only the combinations present in the categoricals
+df_trustees.loc[
+    df_trustees['trustee_id'].isin(repeat_trustees_ids)
+].groupby(
+    ['trustee_id', 'trustee_name', 'individual_or_organisation'], observed=True
+).size()
+
+# %% [markdown]
+# #### Trustees per charity
+#
+# Counted in one streaming pass over the trustee extract, without loading it. Counts are exact; quantiles are within 1% (exact below 50 trustees). By appointment year, the quantiles are of the trustees appointed that year by the charities that appointed any.
 
 # %%
-df.dtypes
+trustee_stats = trustee_counts()
+trustee_stats.summary()
 
 # %%
-df['trustee_id'].value_counts()[:15]
+trustee_stats.distribution()
+
+# %% [markdown]
+# #### Repeat trustees
+#
+# The same person can hold several `trustee_id`s with slightly different names (`Mr John A Smith`, `J A SMITH OBE`). `link_trustees` clusters ids whose names match closely within the same surname and first initial, discounting common names and ambiguous initials; `confidence` is the score of the weakest link of an id to its cluster.
 
 # %%
-repeat_trustees_ids = df['trustee_id'].value_counts()[:15].index
+links = link_trustees(df_trustees)
+repeats = repeat_trustees(df_trustees, links)
+repeats.head(15)
 
-df.loc[
-    df['trustee_id'].isin(repeat_trustees_ids),
-    ['trustee_id', 'trustee_name', 'individual_or_organisation']
-].value_counts(sort=False)
+# %%
+# trustee ids merged into each cluster, least confident first
+links.loc[links['cluster'].isin(repeats.index[:15])].sort_values(['cluster', 'confidence'])
@@ -0,0 +1,52 @@
+"""Fixtures: a small register of merged charities and annual return history.
+
+`register_data_dir` is a data directory with the register ingested by
+`ccew.releases` and the annual returns converted to Parquet with the
+schema of `ccew.extracts`, as after a nightly run.
+"""
+
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+import pytest
+
+from ccew.extracts import SCHEMAS, parquet_path
+from ccew.releases import ingest_release
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+REGISTER_CSV = FIXTURES / 'mergers_register.csv'
+ANNUAL_RETURNS_CSV = FIXTURES / 'charity_annual_return_history.csv'
+
+
+def write_extract(name, csv_path, data_dir):
+    """Convert a CSV of some columns of an extract to its Parquet file."""
+    schema = SCHEMAS[name]
+    names = csv.read_csv(csv_path).column_names
+    table = csv.read_csv(
+        csv_path,
+        convert_options=csv.ConvertOptions(
+            column_types={name: schema.field(name).type for name in names},
+            strings_can_be_null=True,
+        ),
+    )
+    path = parquet_path(name, data_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table.cast(pa.schema([schema.field(name) for name in names])), path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the step cache of each test in its own directory."""
+    monkeypatch.setenv('CCEW_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture
+def register_data_dir(tmp_path):
+    data_dir = tmp_path / 'data'
+    ingest_release(REGISTER_CSV, data_dir)
+    write_extract('charity_annual_return_history', ANNUAL_RETURNS_CSV, data_dir)
+    return data_dir
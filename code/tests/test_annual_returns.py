@@ -0,0 +1,49 @@
+"""Financial period lookups of `ccew.annual_returns`."""
+
+import pandas as pd
+
+from ccew.annual_returns import FinancialPeriodIndex
+
+
+def periods(rows):
+    return FinancialPeriodIndex.from_frame(pd.DataFrame(rows, columns=[
+        'registered_charity_number', 'fin_period_start_date', 'fin_period_end_date',
+        'total_gross_income',
+    ]))
+
+
+def test_known_end_preferred_to_missing_end_on_same_start():
+    index = periods([
+        (1, '2010-04-01', '2011-03-31', 100.0),
+        (1, '2010-04-01', None, 1.0),
+        (1, '2011-04-01', '2012-03-31', 200.0),
+    ])
+    matched = index.match(pd.Series([1]), pd.Series(pd.to_datetime(['2010-06-30'])),
+                          offsets=[0, 1], names=['current', 'next'])
+    assert matched['total_gross_income_current'].tolist() == [100.0]
+    assert matched['total_gross_income_next'].tolist() == [200.0]
+
+
+def test_missing_end_is_open_until_next_period():
+    index = periods([
+        (1, '2020-01-01', '2020-12-31', 10.0),
+        (1, '2021-01-01', None, 20.0),
+    ])
+    dates = pd.Series(pd.to_datetime(['2021-06-30', '2024-01-01', '2019-06-30']))
+    pos = index.positions(pd.Series([1, 1, 1]), dates, offsets=[0])[:, 0]
+    assert index.values['total_gross_income'][pos[:2]].tolist() == [20.0, 20.0]
+    assert pos[2] == -1
+
+
+def test_duplicate_periods_are_one_offset():
+    index = periods([
+        (1, '2010-04-01', '2011-03-31', 100.0),
+        (1, '2011-04-01', '2012-03-31', 150.0),
+        (1, '2011-04-01', '2012-03-31', 200.0),
+        (1, '2012-04-01', '2013-03-31', 300.0),
+    ])
+    matched = index.match(pd.Series([1]), pd.Series(pd.to_datetime(['2012-06-30'])),
+                          offsets=[-2, -1, 0], names=['before', 'previous', 'current'])
+    assert matched['total_gross_income_previous'].tolist() == [200.0]
+    assert matched['total_gross_income_before'].tolist() == [100.0]
+    assert len(index) == 3
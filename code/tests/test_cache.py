@@ -0,0 +1,33 @@
+"""Cache keys of `ccew.cache` for input files and path arguments."""
+
+import os
+
+import pandas as pd
+
+from ccew.cache import cached
+
+
+def test_missing_inputs_and_str_paths(tmp_path):
+    created, source = tmp_path / 'created.txt', tmp_path / 'source.txt'
+    calls = []
+
+    @cached(inputs=[created])
+    def read(path):
+        calls.append(path)
+        created.write_text('written by the step')
+        with open(path) as file:
+            return pd.DataFrame({'text': [file.read()]})
+
+    source.write_text('one')
+    # the input does not exist before the first call, which creates it: the
+    # second call recomputes once, with the new input, and the third is a hit
+    assert read(str(source))['text'][0] == 'one'
+    assert read(str(source))['text'][0] == 'one'
+    assert read(str(source))['text'][0] == 'one'
+    assert len(calls) == 2
+
+    # a str path is keyed on the content of its file rather than on the path
+    source.write_text('two')
+    os.utime(source, ns=(0, 1))
+    assert read(str(source))['text'][0] == 'two'
+    assert len(calls) == 3
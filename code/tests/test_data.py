@@ -0,0 +1,75 @@
+"""Charity number dictionary and sorted extracts of `ccew.data`."""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ccew.data import SORT_KEYS, CharityNumbers, main, sort_extract, sorted_on
+from ccew.extracts import parquet_path
+
+
+def test_codes_are_kept_across_processes(tmp_path):
+    pq.write_table(pa.table({'registered_charity_number': [5, 3, 9]}),
+                   parquet_path('charity', tmp_path))
+    numbers = CharityNumbers.load(tmp_path)
+    assert list(numbers.categories) == [3, 5, 9]
+
+    # a number seen first while encoding is stored with its code
+    assert list(numbers.encode([7, 3, None]).codes) == [3, 0, -1]
+    assert list(CharityNumbers.load(tmp_path).categories) == [3, 5, 9, 7]
+
+    # rebuilding appends new numbers instead of sorting them in
+    pq.write_table(pa.table({'registered_charity_number': [1, 5, 3, 9]}),
+                   parquet_path('charity', tmp_path))
+    assert list(CharityNumbers.build(tmp_path).categories) == [3, 5, 9, 7, 1]
+
+
+def _encode_numbers(data_dir, first):
+    # codes a process hands out for new numbers, one batch at a time
+    numbers = CharityNumbers.load(data_dir)
+    encoded = {}
+    for number in range(first, first + 20):
+        encoded[number] = int(numbers.encode([number]).codes[0])
+    return encoded
+
+
+def test_processes_do_not_share_codes(tmp_path):
+    pq.write_table(pa.table({'registered_charity_number': [1]}), parquet_path('charity', tmp_path))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(4, mp_context=context) as pool:
+        results = list(pool.map(_encode_numbers, [tmp_path] * 4, [100, 200, 300, 400]))
+    stored = CharityNumbers.load(tmp_path).categories
+    assert len(stored) == 81
+    for encoded in results:
+        for number, code in encoded.items():
+            assert stored[code] == number
+
+
+def test_external_sort_matches_in_memory_sort(tmp_path):
+    rng = np.random.default_rng(0)
+    starts = pd.Series(pd.to_datetime('2010-01-01') + pd.to_timedelta(
+        rng.integers(0, 3000, 5000), unit='D'
+    ))
+    starts[rng.random(5000) < 0.05] = pd.NaT
+    table = pa.Table.from_pandas(pd.DataFrame({
+        'fin_period_start_date': starts,
+        'registered_charity_number': rng.integers(0, 500, 5000),
+    }), preserve_index=False)
+    path = parquet_path('charity_annual_return_history', tmp_path)
+    pq.write_table(table, path)
+
+    sort_extract('charity_annual_return_history', tmp_path, row_group_size=300, run_size=700)
+    ordering = [(key, 'ascending') for key in SORT_KEYS['charity_annual_return_history']]
+    assert pq.read_table(path).equals(table.sort_by(ordering))
+    assert sorted_on(path) == SORT_KEYS['charity_annual_return_history']
+
+
+def test_main_skips_extracts_without_sort_keys(tmp_path, capsys):
+    pq.write_table(pa.table({'registered_charity_number': [2, 1]}),
+                   parquet_path('charity', tmp_path))
+    main(['charity', '--data-dir', str(tmp_path)])
+    assert 'sorted' not in capsys.readouterr().out
@@ -0,0 +1,27 @@
+"""Windows of annual returns around mergers, from `ccew.effects`."""
+
+import numpy as np
+import pandas as pd
+
+from ccew.annual_returns import FinancialPeriodIndex
+from ccew.effects import effect_panel
+
+
+def test_pro_forma_combines_every_transferor_of_a_merger():
+    index = FinancialPeriodIndex.from_frame(pd.DataFrame({
+        'registered_charity_number': [1, 1, 2, 2, 3, 3],
+        'fin_period_start_date': pd.to_datetime(['2019-01-01', '2021-01-01'] * 3),
+        'fin_period_end_date': pd.to_datetime(['2019-12-31', '2021-12-31'] * 3),
+        'total_gross_income': [10, np.nan, 20, np.nan, 100, 200],
+    }))
+    events = pd.DataFrame({
+        # a consolidation of 1 and 2 into 3, with a duplicated row for 2
+        'transferor_number': ['1', '2', '2', '1'],
+        'transferee_number': ['3', '3', '3', 'exempt'],
+        'date_transferred': pd.to_datetime(['2020-06-01'] * 4),
+    })
+    panel = effect_panel(events, index, pre=1, post=1, columns=['total_gross_income'])
+    assert panel['pro_forma_total_gross_income_pre'].tolist()[:3] == [130.0] * 3
+    assert panel['pro_forma_total_gross_income_post'].tolist()[:3] == [200.0] * 3
+    # a transferee that is not a charity is not grouped with anything
+    assert panel['pro_forma_total_gross_income_pre'].iloc[3] == 10.0
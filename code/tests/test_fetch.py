@@ -0,0 +1,109 @@
+"""Resumed downloads of `ccew.fetch`, against the local stand-in server."""
+
+import json
+import shutil
+import threading
+import zipfile
+
+import pytest
+
+from ccew import fetch as fetch_module
+from ccew.extracts import extract_path
+from ccew.fetch import ArchiveHandler, fetch, load_state, serve_archive
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    with zipfile.ZipFile(extract_path('charity', remote), 'w') as archive:
+        archive.writestr('publicextract.charity.json', json.dumps([{'a': i} for i in range(500)]))
+    monkeypatch.setattr(ArchiveHandler, 'log_message', lambda *args: None)
+    server = serve_archive(remote, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield remote, f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def _fetch(base_url, archive_dir):
+    return fetch(['charity'], base_url, archive_dir, retries=1)
+
+
+@pytest.mark.parametrize('known_length', [True, False])
+def test_complete_part_file_is_installed(server, tmp_path, known_length):
+    remote, base_url = server
+    archive_dir = tmp_path / 'archive'
+    [result] = _fetch(base_url, archive_dir)
+    assert result.status == 'downloaded'
+
+    # a run that got the whole body but stopped before installing it
+    state = load_state(archive_dir)
+    part = extract_path('charity', archive_dir).with_suffix('.zip.part')
+    shutil.copy(extract_path('charity', remote), part)
+    extract_path('charity', archive_dir).unlink()
+    state['charity']['partial'] = {'etag': state['charity']['etag']}
+    if known_length:
+        state['charity']['partial']['length'] = part.stat().st_size
+    (archive_dir / 'fetch_state.json').write_text(json.dumps(state))
+
+    [result] = _fetch(base_url, archive_dir)
+    assert (result.status, result.attempts) == ('downloaded', 1)
+    assert not part.exists()
+    assert extract_path('charity', archive_dir).read_bytes() == (
+        extract_path('charity', remote).read_bytes()
+    )
+    assert 'partial' not in load_state(archive_dir)['charity']
+
+
+def _cut_off_part(remote, archive_dir, partial):
+    # half of the remote zip in the `.part` file, with `partial` as its saved state
+    part = extract_path('charity', archive_dir).with_suffix('.zip.part')
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    data = extract_path('charity', remote).read_bytes()
+    part.write_bytes(data[:len(data) // 2])
+    (archive_dir / 'fetch_state.json').write_text(json.dumps({'charity': {'partial': partial}}))
+    return part
+
+
+def test_part_file_without_validators_is_downloaded_again(server, tmp_path):
+    remote, base_url = server
+    archive_dir = tmp_path / 'archive'
+    # a server that sent neither an ETag nor a Last-Modified to resume against
+    size = extract_path('charity', remote).stat().st_size
+    part = _cut_off_part(remote, archive_dir, {'length': size})
+
+    [result] = _fetch(base_url, archive_dir)
+    assert (result.status, result.attempts, result.resumed_from) == ('downloaded', 1, 0)
+    assert not part.exists()
+    assert extract_path('charity', archive_dir).read_bytes() == (
+        extract_path('charity', remote).read_bytes()
+    )
+
+
+class Killed(BaseException):
+    """The fetching process being killed."""
+
+
+def test_killed_run_resumes(server, tmp_path, monkeypatch):
+    remote, base_url = server
+    archive_dir = tmp_path / 'archive'
+    copy_body = fetch_module._copy_body
+
+    async def cut_off(reader, headers, file):
+        file.write(await reader.read(100))
+        file.flush()
+        raise Killed
+
+    monkeypatch.setattr(fetch_module, '_copy_body', cut_off)
+    with pytest.raises(Killed):
+        _fetch(base_url, archive_dir)
+    assert 'etag' in load_state(archive_dir)['charity']['partial']
+
+    monkeypatch.setattr(fetch_module, '_copy_body', copy_body)
+    [result] = _fetch(base_url, archive_dir)
+    assert (result.status, result.resumed_from) == ('downloaded', 100)
+    assert extract_path('charity', archive_dir).read_bytes() == (
+        extract_path('charity', remote).read_bytes()
+    )
@@ -0,0 +1,99 @@
+"""Nightly ingestion of changed charities by `ccew.incremental`."""
+
+import json
+import zipfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ccew.data import CharityNumbers, sorted_on
+from ccew.extracts import extract_path, parquet_path
+from ccew.incremental import extend_numbers, ingest, row_hashes
+
+
+def write_zip(archive_dir, names, linked=None, first=0):
+    records = [
+        {
+            'date_of_extract': '2024-09-10T00:00:00',
+            'organisation_number': first + i,
+            'registered_charity_number': number,
+            'linked_charity_number': (linked or {}).get(number, 0),
+            'charity_name': name,
+        }
+        for i, (number, name) in enumerate(names)
+    ]
+    archive_dir.mkdir(exist_ok=True)
+    with zipfile.ZipFile(extract_path('charity', archive_dir), 'w') as archive:
+        archive.writestr('publicextract.charity.json', json.dumps(records))
+
+
+def table_rows(data_dir):
+    table = pq.read_table(parquet_path('charity', data_dir))
+    return sorted(zip(table['registered_charity_number'].to_pylist(),
+                      table['charity_name'].to_pylist()), key=str)
+
+
+def test_rows_without_a_number_are_tracked(tmp_path):
+    archive_dir, data_dir = tmp_path / 'archive', tmp_path / 'data'
+    write_zip(archive_dir, [(1, 'A'), (2, 'B'), (None, 'X')])
+    ingest(['charity'], archive_dir, data_dir)
+
+    # the last charity and a row without a number change
+    names = [(1, 'A'), (2, 'B2'), (None, 'Y')]
+    write_zip(archive_dir, names)
+    [changes] = ingest(['charity'], archive_dir, data_dir,
+                       on_change=[lambda changes, path: extend_numbers(changes, data_dir)])
+    assert sorted(changes.updated) == [-1, 2]
+    assert table_rows(data_dir) == sorted(names, key=str)
+
+    write_zip(archive_dir, names + [(3, 'C')])
+    ingest(['charity'], archive_dir, data_dir,
+           on_change=[lambda changes, path: extend_numbers(changes, data_dir)])
+    assert 3 in CharityNumbers.load(data_dir).categories
+
+
+def test_row_hashes_do_not_depend_on_the_batch():
+    batch = pa.record_batch({
+        'x': pa.array([1, None], pa.int64()),
+        'c': pa.array([True, None]),
+        'name': pa.array(['A', None]),
+    })
+    assert row_hashes(batch)[0] == row_hashes(batch.slice(0, 1))[0]
+
+
+def test_nulls_moving_across_batches_change_nothing(tmp_path):
+    archive_dir, data_dir = tmp_path / 'archive', tmp_path / 'data'
+    names = [(number, f'Charity {number}') for number in range(1, 8)]
+    # a null linked number, in a batch of two rows whose boundaries move below
+    linked = {number: 1 for number, _ in names} | {4: None}
+    write_zip(archive_dir, names, linked)
+    ingest(['charity'], archive_dir, data_dir, row_group_size=2)
+
+    write_zip(archive_dir, names[1:], linked, first=1)
+    [changes] = ingest(['charity'], archive_dir, data_dir, row_group_size=2)
+    assert list(changes.removed) == [1]
+    assert not len(changes.inserted) and not len(changes.updated)
+
+
+def test_rewritten_tables_stay_sorted(tmp_path):
+    archive_dir, data_dir = tmp_path / 'archive', tmp_path / 'data'
+    trustees = [(3, 'C'), (1, 'A'), (2, 'B')]
+
+    def write_trustees(rows):
+        records = [
+            {'organisation_number': number, 'registered_charity_number': number,
+             'linked_charity_number': 0, 'trustee_id': number, 'trustee_name': name}
+            for number, name in rows
+        ]
+        archive_dir.mkdir(exist_ok=True)
+        with zipfile.ZipFile(extract_path('charity_trustee', archive_dir), 'w') as archive:
+            archive.writestr('publicextract.charity_trustee.json', json.dumps(records))
+
+    write_trustees(trustees)
+    ingest(['charity_trustee'], archive_dir, data_dir)
+    # the changed charity is appended to the table, then sorted back into place
+    write_trustees([(3, 'C'), (1, 'A2'), (2, 'B')])
+    ingest(['charity_trustee'], archive_dir, data_dir)
+    path = parquet_path('charity_trustee', data_dir)
+    assert pq.read_table(path)['registered_charity_number'].to_pylist() == [1, 2, 3]
+    assert sorted_on(path) == ['registered_charity_number']
@@ -0,0 +1,24 @@
+"""Charity numbers parsed from register names by `ccew.numbers`."""
+
+from ccew.numbers import extract_charity_number
+
+
+def test_numbers_suffixes_and_notes():
+    parsed = extract_charity_number([
+        'Crisis UK (1082947)',
+        'Parish Trust (1053467.01)',
+        'Small Charity 1000009',
+        'Chapel (Exempt)',
+        'Typo Trust (12345678901234567890)',
+    ]).to_pylist()
+    assert [row['number'] for row in parsed] == [1082947, 1053467, 1000009, None, None]
+    assert parsed[1]['suffix'] == '01'
+    # too long for a charity number, or an int64: kept as a note instead of failing
+    assert parsed[4]['note'] == '12345678901234567890'
+
+
+def test_unmatched_notes_keep_their_text():
+    parsed = extract_charity_number([
+        'Chapel (Exempt)', 'Trust (CIO)', 'Fund (Herne Bay Branch)', 'Hall (Awaiting Number)',
+    ]).to_pylist()
+    assert [row['status'] for row in parsed] == ['exempt', 'other', 'other', 'awaiting number']
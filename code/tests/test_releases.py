@@ -0,0 +1,20 @@
+"""Incremental ingestion of register releases by `ccew.releases`."""
+
+import pandas as pd
+
+from ccew.releases import count_by_year, ingest_release, load_counts, load_table
+from tests.conftest import REGISTER_CSV
+
+
+def test_counts_follow_a_changed_transferee(tmp_path):
+    ingest_release(REGISTER_CSV, tmp_path)
+    release = pd.read_csv(REGISTER_CSV, encoding='cp1252')
+    # the same merger with the transferee in capitals: a change, not an insert
+    transferee = release.columns[1]
+    row = release.index[release[transferee].str.contains('Omega')][0]
+    release.loc[row, transferee] = release.loc[row, transferee].upper()
+    release.to_csv(tmp_path / 'release.csv', index=False, encoding='cp1252')
+
+    changes = ingest_release(tmp_path / 'release.csv', tmp_path)
+    assert (len(changes.inserted), len(changes.changed), len(changes.withdrawn)) == (0, 1, 0)
+    pd.testing.assert_frame_equal(load_counts(tmp_path), count_by_year(load_table(tmp_path)))
@@ -0,0 +1,31 @@
+"""Name search labels, and their resolution from merger register labels."""
+
+import pandas as pd
+
+from ccew.resolve import resolve_queries
+from ccew.search import NameIndex, normalise_labels
+
+NAMES = pd.DataFrame({
+    'registered_charity_number': [1053467, 1053467, 1082947],
+    'linked_charity_number': [0, 1, 0],
+    'charity_name': ['St Peter Parish Trust', 'St Peter Church Hall Fund', 'Crisis UK'],
+    'name_type': 'Register name',
+})
+
+
+def test_linked_labels_match_the_register():
+    index = NameIndex.from_names(NAMES)
+    assert list(index.labels) == ['1053467', '1053467-01', '1082947']
+    assert index.best('Saint Peter Church Hall Fund')[0] == '1053467-01'
+    assert list(normalise_labels(['1053467-1', '1053467-001', '1082947', 'exempt', None])) == [
+        '1053467-01', '1053467-01', '1082947', 'exempt', None,
+    ]
+
+
+def test_register_labels_resolve_by_number():
+    index = NameIndex.from_names(NAMES)
+    resolved = resolve_queries(
+        index, ['Church Hall Fund', 'Church Hall Fund'], ['1053467-01', '1053467-1']
+    )
+    assert list(resolved['resolution']) == ['number', 'number']
+    assert list(resolved['resolved']) == ['1053467-01', '1053467-01']
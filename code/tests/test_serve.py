@@ -0,0 +1,67 @@
+"""Queries of `ccew.serve` on the fixture register, without a server socket."""
+
+import json
+import math
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from ccew.serve import QueryError, QueryService, dumps, make_server
+
+
+@pytest.fixture
+def service(register_data_dir, tmp_path):
+    # no trustee extract and no mergers CSV: the service starts without them
+    return QueryService(register_data_dir, mergers_csv=tmp_path / 'missing.csv')
+
+
+def test_missing_tables_are_reported(service):
+    health = service.query('/health')
+    assert set(health['missing']) == {'trustees'}
+    assert health['rows']['mergers'] > 0
+    assert health['rows']['annual_returns'] > 0
+
+
+def test_charity_without_trustee_table(service):
+    result = service.query('/charity/1000100')
+    assert result['trustees'] is None
+    assert result['annual_returns']
+    assert result['mergers_as_transferee']
+
+
+def test_unknown_endpoint(service):
+    with pytest.raises(QueryError):
+        service.query('/nowhere')
+
+
+def test_dumps_writes_nan_as_null():
+    assert json.loads(dumps({'income': math.nan, 'rows': [{'x': math.inf}]})) == {
+        'income': None, 'rows': [{'x': None}],
+    }
+
+
+def test_service_without_any_table(tmp_path):
+    service = QueryService(tmp_path / 'data', mergers_csv=tmp_path / 'missing.csv')
+    assert set(service.query('/health')['missing']) == {'annual_returns', 'trustees', 'mergers'}
+    assert service.query('/mergers/years') == {}
+    assert service.query('/charity/1000100')['mergers_as_transferor'] == []
+
+
+def test_server_answers_failures_with_json(service, monkeypatch):
+    def fail(url):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(service, 'query', fail)
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/health')
+        assert error.value.code == 500
+        assert 'boom' in json.loads(error.value.read())['error']
+    finally:
+        server.shutdown()
+        server.server_close()
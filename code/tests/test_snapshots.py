@@ -0,0 +1,71 @@
+"""Days of an extract stored by `ccew.snapshots` and read back."""
+
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ccew import snapshots
+from ccew.extracts import parquet_path
+
+
+def write_day(path, day, names):
+    table = pa.table({
+        'date_of_extract': pa.array([datetime.fromisoformat(day)] * len(names), pa.timestamp('ms')),
+        'organisation_number': pa.array(range(len(names)), pa.int64()),
+        'registered_charity_number': pa.array([1000000 + i for i in range(len(names))], pa.int64()),
+        'linked_charity_number': pa.array([0] * len(names), pa.int64()),
+        'charity_name': pa.array(names, pa.string()),
+    })
+    pq.write_table(table, path)
+    return path
+
+
+def test_days_are_rebuilt_from_deltas(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, 'ROW_GROUP_SIZE', 2)
+    store_dir, data_dir = tmp_path / 'snapshots', tmp_path / 'data'
+    days = {
+        '2024-09-09': ['A', 'B', 'C', 'D', 'E'],
+        '2024-09-10': ['A', 'B', 'C', 'D', 'E2'],
+        '2024-09-11': ['A', 'B', 'C', 'D', 'E2', 'F'],
+    }
+    kinds = [
+        snapshots.add_snapshot(
+            'charity', write_day(tmp_path / f'{day}.parquet', day, names),
+            store_dir=store_dir, data_dir=data_dir,
+        ).kind
+        for day, names in days.items()
+    ]
+    assert kinds == ['keyframe', 'delta', 'delta']
+    for day, names in days.items():
+        table = snapshots.snapshot('charity', day, store_dir)
+        assert table['charity_name'].to_pylist() == names
+
+    rows, path = snapshots.materialise('charity', store_dir=store_dir, data_dir=data_dir)
+    assert path == parquet_path('charity', data_dir)
+    assert rows == 6
+    assert pq.read_table(path)['charity_name'].to_pylist() == days['2024-09-11']
+
+
+def test_nulls_do_not_force_keyframes(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, 'ROW_GROUP_SIZE', 3)
+    store_dir, data_dir = tmp_path / 'snapshots', tmp_path / 'data'
+    chair = [i % 2 == 0 for i in range(10)]
+    chair[4] = None
+    table = pa.table({
+        'organisation_number': pa.array(range(10), pa.int64()),
+        'trustee_id': pa.array(range(100, 110), pa.int64()),
+        'trustee_is_chair': pa.array(chair, pa.bool_()),
+    })
+    first = tmp_path / 'first.parquet'
+    pq.write_table(table, first)
+    # deleting the first row moves every batch boundary, and the null with them
+    second = tmp_path / 'second.parquet'
+    pq.write_table(table.slice(1), second)
+    snapshots.add_snapshot('charity_trustee', first, '2024-09-09', store_dir, data_dir)
+    # ids of the stored keyframe, as read back, rather than the cached head
+    snapshots._heads_path('charity_trustee', data_dir).unlink()
+    added = snapshots.add_snapshot('charity_trustee', second, '2024-09-10', store_dir, data_dir)
+    assert (added.kind, added.added, added.removed) == ('delta', 0, 1)
+    stored = snapshots.snapshot('charity_trustee', '2024-09-10', store_dir)
+    assert stored['trustee_is_chair'].to_pylist() == chair[1:]
@@ -0,0 +1,34 @@
+"""The DuckDB targets of `ccew.sql` against the pandas steps of `ccew.mergers`."""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('duckdb')
+
+from ccew import sql  # noqa: E402
+
+
+@pytest.fixture
+def results(register_data_dir):
+    targets = list(sql.TARGETS)
+    con = sql.connect(register_data_dir, threads=1)
+    return sql.run(targets, con), sql.pandas_targets(targets, register_data_dir)
+
+
+@pytest.mark.parametrize('target', list(sql.TARGETS))
+def test_target_matches_pandas(results, target):
+    actual, expected = results
+    assert len(expected[target]), 'the fixture should give every target some rows'
+    pd.testing.assert_frame_equal(
+        sql._canonical(actual[target], target),
+        sql._canonical(expected[target], target),
+        check_dtype=False,
+        check_index_type=False,
+        check_column_type=False,
+        check_names=False,
+        rtol=1e-9,
+    )
+
+
+def test_compare_backends(register_data_dir):
+    assert sql.compare_backends(data_dir=register_data_dir) == {}
@@ -0,0 +1,47 @@
+"""Streaming trustee counts of `ccew.trustees`."""
+
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from ccew.data import sort_extract
+from ccew.extracts import parquet_path
+from ccew.trustees import TrusteeCounts, trustee_counts
+
+
+def trustees(numbers):
+    return pa.table({
+        'registered_charity_number': pa.array(numbers, pa.int64()),
+        'trustee_date_of_appointment': pa.array(
+            [datetime(2020, 1, 1)] * len(numbers), pa.timestamp('ms')
+        ),
+        'individual_or_organisation': pa.array(['P'] * len(numbers), pa.string()),
+    })
+
+
+def test_charity_seen_again_is_counted_once():
+    counts = TrusteeCounts()
+    for numbers in ([1, 1, 2], [2, 3], [1, 3]):
+        counts.update(trustees(numbers))
+    assert counts.by_charity()['trustees'].to_dict() == {1: 3, 2: 2, 3: 2}
+    assert counts.summary().loc['all', 'charities'] == 3
+
+
+def test_sorted_counter_rejects_batches_out_of_order():
+    counts = TrusteeCounts(sorted=True)
+    counts.update(trustees([1, 1, 2]))
+    counts.update(trustees([2, 3]))
+    with pytest.raises(ValueError):
+        counts.update(trustees([1, 3]))
+
+
+def test_sorted_extract_is_streamed(tmp_path):
+    path = parquet_path('charity_trustee', tmp_path)
+    pq.write_table(trustees([3, 1, 2, 1, 3, 3]), path)
+    assert not trustee_counts(path, batch_size=2).sorted
+    sort_extract('charity_trustee', tmp_path, row_group_size=2)
+    counts = trustee_counts(path, batch_size=2)
+    assert counts.sorted
+    assert counts.by_charity()['trustees'].to_dict() == {1: 2, 2: 1, 3: 3}
@@ -0,0 +1,16 @@
+"""Charity lookups in the tables of `ccew.warehouse`."""
+
+import pyarrow as pa
+
+from ccew.warehouse import charity_slice
+
+
+def test_charity_slice():
+    schema = pa.schema([('registered_charity_number', pa.int64()), ('name', pa.string())])
+    assert charity_slice(pa.Table.from_batches([], schema=schema), 1).num_rows == 0
+
+    first = pa.record_batch([pa.array([1, 2]), pa.array(['a', 'b'])], schema=schema)
+    second = pa.record_batch([pa.array([2, 3]), pa.array(['c', 'd'])], schema=schema)
+    assert charity_slice(pa.Table.from_batches([first]), 2)['name'].to_pylist() == ['b']
+    table = pa.Table.from_batches([first, second])
+    assert charity_slice(table, 2)['name'].to_pylist() == ['b', 'c']